@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+from telegram import Chat, Message, Update, User
+
+from benchmarks.load import percentile
+from src.updates import ChatOrderedUpdateProcessor
+
+
+@dataclass
+class BotLevelResult:
+    concurrency: int
+    updates: int
+    p50_ms: float
+    p95_ms: float
+    updates_per_s: float
+    max_chat_overlap: int
+    out_of_order: int
+
+
+def make_update(update_id: int, chat_id: int, sequence: int) -> Update:
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    user = User(id=chat_id, first_name=f"user{chat_id}", is_bot=False)
+    message = Message(message_id=sequence, date=datetime.now(), chat=chat, from_user=user, text=str(sequence))
+    return Update(update_id=update_id, message=message)
+
+
+def make_updates(chats: int, updates_per_chat: int) -> List[Update]:
+    """
+    Photo-like messages of `chats` private chats, interleaved as they would arrive (each chat in order).
+    """
+    pending = {chat_id: list(range(updates_per_chat)) for chat_id in range(1, chats + 1)}
+    updates = []
+    while pending:
+        chat_id = random.choice(list(pending))
+        sequence = pending[chat_id].pop(0)
+        if not pending[chat_id]:
+            del pending[chat_id]
+        updates.append(make_update(len(updates) + 1, chat_id, sequence))
+    return updates
+
+
+async def run_level(updates: List[Update], concurrency: int, handler_ms: float) -> BotLevelResult:
+    """
+    Feeds the updates to a `ChatOrderedUpdateProcessor` the way the `Application` does (one task per update), the
+    handler standing in for the card creation by sleeping `handler_ms`.
+    """
+    processor = ChatOrderedUpdateProcessor(concurrency)
+    running: Dict[int, int] = defaultdict(int)
+    handled: Dict[int, List[int]] = defaultdict(list)
+    latencies: List[float] = []
+    max_chat_overlap = 0
+
+    async def _handler(update: Update, received: float):
+        nonlocal max_chat_overlap
+        chat_id = update.effective_chat.id
+        running[chat_id] += 1
+        max_chat_overlap = max(max_chat_overlap, running[chat_id])
+        await asyncio.sleep(handler_ms / 1000)
+        handled[chat_id].append(update.message.message_id)
+        running[chat_id] -= 1
+        latencies.append((time.perf_counter() - received) * 1000)
+
+    start = time.perf_counter()
+    async with processor:
+        await asyncio.gather(*[processor.process_update(update, _handler(update, time.perf_counter()))
+                               for update in updates])
+    elapsed = time.perf_counter() - start
+
+    return BotLevelResult(
+        concurrency=concurrency,
+        updates=len(updates),
+        p50_ms=round(percentile(latencies, 50), 1),
+        p95_ms=round(percentile(latencies, 95), 1),
+        updates_per_s=round(len(updates) / elapsed, 2),
+        max_chat_overlap=max_chat_overlap,
+        out_of_order=sum(sequence != sorted(sequence) for sequence in handled.values()),
+    )
+
+
+def print_report(results: List[BotLevelResult]) -> None:
+    print(f"{'concurrency':>11} {'updates':>7} {'p50 ms':>9} {'p95 ms':>9} {'updates/s':>9} {'chat overlap':>12} {'out of order':>12}")
+    for r in results:
+        print(f"{r.concurrency:>11} {r.updates:>7} {r.p50_ms:>9} {r.p95_ms:>9} {r.updates_per_s:>9} "
+              f"{r.max_chat_overlap:>12} {r.out_of_order:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark of the bot update processing with simulated updates")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency limits")
+    parser.add_argument("--chats", type=int, default=32)
+    parser.add_argument("--updates-per-chat", type=int, default=3)
+    parser.add_argument("--handler-ms", type=float, default=200, help="simulated handling time of an update")
+    parser.add_argument("--json", type=Path, help="also write the results to this file")
+    args = parser.parse_args()
+
+    updates = make_updates(args.chats, args.updates_per_chat)
+    results = [asyncio.run(run_level(updates, int(level), args.handler_ms)) for level in args.concurrency.split(",")]
+    print_report(results)
+    if args.json:
+        args.json.write_text(json.dumps([asdict(r) for r in results], indent=2))
+
+
+if __name__ == "__main__":
+    main()
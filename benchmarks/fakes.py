@@ -0,0 +1,375 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from tests.fixtures import (CARD_DATA, CONTACT_CARD, REVERSE_GEOCODE_DATA, SERPAPI_SEARCH_BY_PLACE_ID,
+                            SERPAPI_SEARCH_BY_UULE, VISION_TRANSCRIPTION, VISION_VENUE_DATA)
+
+
+@dataclass
+class UpstreamProfile:
+    """
+    Latency and error distribution of a fake upstream.
+
+    Latencies follow a log-normal distribution around `latency_ms` (the median), with `jitter` as its sigma.
+    A fraction `error_rate` of the calls fails with `error_status`.
+    """
+
+    latency_ms: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 500
+
+    @classmethod
+    def parse(cls, spec: str) -> "UpstreamProfile":
+        """
+        Parses a "latency_ms[:jitter[:error_rate[:error_status]]]" specification (e.g. "800:0.3:0.01:429").
+        """
+        parts = spec.split(":")
+        return cls(
+            latency_ms=float(parts[0]),
+            jitter=float(parts[1]) if len(parts) > 1 else 0.0,
+            error_rate=float(parts[2]) if len(parts) > 2 else 0.0,
+            error_status=int(parts[3]) if len(parts) > 3 else 500,
+        )
+
+    def sample_latency(self) -> float:
+        if self.latency_ms <= 0:
+            return 0.0
+        return random.lognormvariate(0, self.jitter) * self.latency_ms / 1000
+
+    def sample_error(self) -> bool:
+        return random.random() < self.error_rate
+
+
+@dataclass
+class UpstreamProfiles:
+    azure: UpstreamProfile = field(default_factory=UpstreamProfile)
+    serpapi: UpstreamProfile = field(default_factory=UpstreamProfile)
+    geoapify: UpstreamProfile = field(default_factory=UpstreamProfile)
+    # optional per deployment overrides of the azure profile
+    deployments: Dict[str, UpstreamProfile] = field(default_factory=dict)
+
+
+async def _simulate(profile: UpstreamProfile) -> Optional[JSONResponse]:
+    await asyncio.sleep(profile.sample_latency())
+    if profile.sample_error():
+        return JSONResponse({"error": {"code": str(profile.error_status), "message": "fake upstream error"}},
+                            status_code=profile.error_status)
+    return None
+
+
+def _is_vision_request(messages: list) -> bool:
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            return True
+    return False
+
+
+def _estimate_prompt_tokens(messages: list) -> int:
+    tokens = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += len(part["text"]) // 4
+            elif part.get("type") == "image_url":
+                tokens += 765 if part["image_url"].get("detail") == "high" else 85
+    return tokens
+
+
+def create_upstream_app(profiles: UpstreamProfiles) -> FastAPI:
+    """
+    Single app standing in for the Azure OpenAI chat completions, Serpapi `google_local` and Geoapify reverse
+    geocoding (single and batch jobs) APIs, answering with the canned responses used by the tests, and for the
+    LangSmith runs ingestion (counting the traces and bytes uploaded).
+    """
+    app = FastAPI()
+    app.state.calls = {"azure": 0, "serpapi": 0, "geoapify": 0, "geoapify_batch": 0}
+    app.state.tracing = {"runs": 0, "traces": 0, "bytes": 0}
+    app.state.batch_jobs = {}
+
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, request: Request):
+        app.state.calls["azure"] += 1
+        if error := await _simulate(profiles.deployments.get(deployment, profiles.azure)):
+            return error
+        body = await request.json()
+        messages = body.get("messages", [])
+        is_vision = _is_vision_request(messages)
+        prompt_tokens = _estimate_prompt_tokens(messages)
+        if body.get("tools"):
+            # structured output, answered as a call of the (single) schema tool
+            arguments = json.dumps(VISION_TRANSCRIPTION if is_vision else CONTACT_CARD, ensure_ascii=False)
+            prompt_tokens += len(json.dumps(body["tools"])) // 4
+            completion_tokens = len(arguments) // 4
+            tool_call = {"id": "call_fake", "type": "function",
+                         "function": {"name": body["tools"][0]["function"]["name"], "arguments": arguments}}
+            choice = {"index": 0, "message": {"role": "assistant", "content": None, "tool_calls": [tool_call]},
+                      "finish_reason": "tool_calls"}
+        else:
+            content = VISION_VENUE_DATA if is_vision else CARD_DATA
+            completion_tokens = len(content) // 4
+            choice = {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model") or "gpt-4o-mini",
+            "choices": [choice],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    @app.get("/openai/models")
+    async def models():
+        return {"object": "list", "data": []}
+
+    @app.get("/search")
+    async def serpapi_search(request: Request):
+        app.state.calls["serpapi"] += 1
+        if error := await _simulate(profiles.serpapi):
+            return error
+        if "ludocid" in request.query_params:
+            return {"local_results": SERPAPI_SEARCH_BY_PLACE_ID}
+        return {"local_results": SERPAPI_SEARCH_BY_UULE}
+
+    @app.get("/v1/geocode/reverse")
+    async def geoapify_reverse(request: Request):
+        app.state.calls["geoapify"] += 1
+        if error := await _simulate(profiles.geoapify):
+            return error
+        data = json.loads(json.dumps(REVERSE_GEOCODE_DATA))
+        data["query"] = {"lat": float(request.query_params["lat"]), "lon": float(request.query_params["lon"])}
+        return data
+
+    @app.post("/v1/batch")
+    async def geoapify_batch_create(request: Request):
+        app.state.calls["geoapify_batch"] += 1
+        if error := await _simulate(profiles.geoapify):
+            return error
+        body = await request.json()
+        job_id = f"job-{len(app.state.batch_jobs) + 1}"
+        # the job stays pending for the first poll
+        app.state.batch_jobs[job_id] = {"body": body, "polls": 0}
+        url = f"{str(request.base_url).rstrip('/')}/v1/batch?id={job_id}&apiKey={request.query_params.get('apiKey')}"
+        return JSONResponse({"id": job_id, "status": "pending", "url": url}, status_code=202)
+
+    @app.get("/v1/batch")
+    async def geoapify_batch_result(id: str):
+        job = app.state.batch_jobs[id]
+        job["polls"] += 1
+        if job["polls"] == 1:
+            return JSONResponse({"id": id, "status": "pending"}, status_code=202)
+        properties = REVERSE_GEOCODE_DATA["features"][0]["properties"]
+        results = [{"params": item["params"], "result": {"results": [properties], "query": item["params"]}}
+                   for item in job["body"]["inputs"]]
+        return {"id": id, "api": job["body"]["api"], "status": "finished", "results": results}
+
+    def _ingest(runs: list, size: int) -> None:
+        app.state.tracing["runs"] += len(runs)
+        app.state.tracing["traces"] += sum(1 for run in runs if not run.get("parent_run_id"))
+        app.state.tracing["bytes"] += size
+
+    @app.get("/info")
+    async def langsmith_info():
+        # no batch ingest config, the client posts the runs to /runs/batch
+        return {}
+
+    @app.post("/runs/batch")
+    async def langsmith_batch(request: Request):
+        body = await request.body()
+        _ingest(json.loads(body).get("post") or [], len(body))
+        return {}
+
+    @app.post("/runs")
+    async def langsmith_create_run(request: Request):
+        body = await request.body()
+        _ingest([json.loads(body)], len(body))
+        return {}
+
+    @app.patch("/runs/{run_id}")
+    async def langsmith_update_run(run_id: str, request: Request):
+        app.state.tracing["bytes"] += len(await request.body())
+        return {}
+
+    return app
+
+
+class BackgroundServer:
+    """
+    Runs an ASGI app with uvicorn in a daemon thread, e.g. `with BackgroundServer(app) as server: server.url`.
+    """
+
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 0):
+        self._server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.servers[0].sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "BackgroundServer":
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self) -> None:
+        self._server.should_exit = True
+        self._thread.join()
+
+    def __enter__(self) -> "BackgroundServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+class FakeRedisServer:
+    """
+    Stand-in Redis server (RESP2 over TCP) run in a daemon thread, with the commands used by `RemoteCache`:
+    GET, MGET, SET (with EX/PX), DEL, DBSIZE, INFO, FLUSHDB, PING, AUTH and SELECT.
+    It evicts the oldest keys beyond `max_keys`, so evictions can be observed through INFO.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, max_keys: Optional[int] = None):
+        self._address = (host, port)
+        self._max_keys = max_keys
+        # key -> (value, expiry time)
+        self.data: Dict[bytes, tuple] = {}
+        self.stats = {"evicted_keys": 0, "expired_keys": 0}
+        self.commands: Dict[str, int] = defaultdict(int)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"redis://{host}:{port}"
+
+    def start(self) -> "FakeRedisServer":
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._serve, *self._address), self._loop).result()
+        return self
+
+    def stop(self) -> None:
+        self._server.close()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self) -> "FakeRedisServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                args = []
+                for _ in range(int(line[1:])):
+                    length = int((await reader.readline())[1:])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                writer.write(self._encode(self._execute(args[0].decode().upper(), args[1:])))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            del self.data[key]
+            self.stats["expired_keys"] += 1
+            return None
+        return value
+
+    def _execute(self, command: str, args: list):
+        self.commands[command] += 1
+        if command == "GET":
+            return self._get(args[0])
+        if command == "MGET":
+            return [self._get(key) for key in args]
+        if command == "SET":
+            options = [arg.decode().upper() for arg in args[2:]]
+            expires_at = None
+            if "PX" in options:
+                expires_at = time.time() + int(options[options.index("PX") + 1]) / 1000
+            elif "EX" in options:
+                expires_at = time.time() + int(options[options.index("EX") + 1])
+            self.data.pop(args[0], None)
+            self.data[args[0]] = (args[1], expires_at)
+            while self._max_keys is not None and len(self.data) > self._max_keys:
+                del self.data[next(iter(self.data))]
+                self.stats["evicted_keys"] += 1
+            return "OK"
+        if command == "DEL":
+            return sum(self.data.pop(key, None) is not None for key in args)
+        if command == "DBSIZE":
+            return len(self.data)
+        if command == "INFO":
+            used_memory = sum(len(key) + len(value) for key, (value, _) in self.data.items())
+            info = {"used_memory": used_memory, **self.stats}
+            return "\r\n".join(f"{name}:{value}" for name, value in info.items()).encode()
+        if command == "FLUSHDB":
+            self.data.clear()
+            return "OK"
+        if command == "PING":
+            return "PONG"
+        if command in ("AUTH", "SELECT"):
+            return "OK"
+        return Exception(f"ERR unknown command '{command}'")
+
+    @classmethod
+    def _encode(cls, reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, Exception):
+            return b"-%s\r\n" % str(reply).encode()
+        if isinstance(reply, str):
+            return b"+%s\r\n" % reply.encode()
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        return b"*%d\r\n" % len(reply) + b"".join(cls._encode(item) for item in reply)
+
+
+def redirect_upstreams(base_url: str) -> None:
+    """
+    Points the Serpapi and Geoapify SDKs, whose hosts are hardcoded, to `base_url`.
+    Azure OpenAI is redirected through the `AZURE_OPENAI_API_BASE` setting instead.
+    """
+    import geobatchpy.batch
+    import geobatchpy.client
+    from serpapi.serp_api_client import SerpApiClient
+
+    def get_api_url(api: str, api_key: str = None, version: int = None) -> str:
+        if version is not None:
+            api = f"/v{version}/" + "/".join(api.split("/")[2:])
+        return f"{base_url}{api}?apiKey={api_key}"
+
+    SerpApiClient.BACKEND = base_url
+    geobatchpy.client.get_api_url = get_api_url
+    geobatchpy.batch.get_api_url = get_api_url
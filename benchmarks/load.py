@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+import piexif
+from PIL import Image
+
+from benchmarks.fakes import BackgroundServer, UpstreamProfile, UpstreamProfiles, create_upstream_app
+
+
+@dataclass
+class LevelResult:
+    concurrency: int
+    requests: int
+    errors: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    rps: float
+    peak_rss_mb: Optional[float]
+    loop_lag_avg_ms: Optional[float] = None
+    loop_lag_max_ms: Optional[float] = None
+    # traced with --env TRACE_MEMORY=1, only attributable to each request at concurrency 1
+    request_peak_mb: Optional[float] = None
+    # with --langsmith, the traces uploaded to the LangSmith stand-in and their size
+    traces: Optional[int] = None
+    trace_mb: Optional[float] = None
+    # share of the Azure OpenAI requests sent on an already open connection
+    azure_reuse: Optional[float] = None
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def make_photo(width: int, height: int, lat: float = 39.8883636, lon: float = 4.2652852) -> bytes:
+    """
+    Noisy (hence poorly compressible, like a real photo) JPEG carrying GPS EXIF data.
+    """
+    def _to_rational(value: float):
+        degrees = int(value)
+        minutes = int((value - degrees) * 60)
+        seconds = round(((value - degrees) * 60 - minutes) * 60 * 100)
+        return ((degrees, 1), (minutes, 1), (seconds, 100))
+
+    gps = {
+        piexif.GPSIFD.GPSLatitudeRef: "N" if lat >= 0 else "S",
+        piexif.GPSIFD.GPSLatitude: _to_rational(abs(lat)),
+        piexif.GPSIFD.GPSLongitudeRef: "E" if lon >= 0 else "W",
+        piexif.GPSIFD.GPSLongitude: _to_rational(abs(lon)),
+    }
+    img = Image.merge("RGB", [Image.effect_noise((width, height), 64) for _ in range(3)])
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=90, exif=piexif.dump({"GPS": gps}))
+    return buffer.getvalue()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _peak_rss_mb(pid: int) -> Optional[float]:
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class ApiProcess:
+    """
+    `src.api` running in a subprocess wired to the stand-in upstreams, so its memory can be measured in isolation.
+    """
+
+    def __init__(self, upstream_url: str, verbose: bool = False, settings: Optional[Dict[str, str]] = None):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        env = os.environ.copy()
+        env.pop("LANGSMITH_API_KEY", None)
+        env |= {
+            "AZURE_OPENAI_API_KEY": "fake",
+            "AZURE_OPENAI_API_BASE": upstream_url,
+            "SERPAPI_API_KEY": "fake",
+            "GEOAPIFY_API_KEY": "fake",
+            "TELEGRAM_TOKEN": "fake",
+        } | (settings or {})
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.serve_api", "--upstream-url", upstream_url, "--port", str(self.port)],
+            env=env,
+            stdout=None if verbose else subprocess.DEVNULL,
+            stderr=None if verbose else subprocess.DEVNULL,
+        )
+
+    def wait_ready(self, timeout: float = 60) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError("API process exited before being ready")
+            try:
+                if httpx.get(f"{self.url}/health", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        raise TimeoutError("API process not ready")
+
+    def summaries(self) -> Dict[str, Dict[str, float]]:
+        """
+        Summaries (count, sum, avg, max) of the values observed by the API since it started.
+        """
+        return self.metrics()["summaries"]
+
+    def metrics(self) -> Dict:
+        return httpx.get(f"{self.url}/metrics", timeout=10).json()
+
+    @property
+    def peak_rss_mb(self) -> Optional[float]:
+        return _peak_rss_mb(self._process.pid)
+
+    def stop(self) -> None:
+        self._process.terminate()
+        self._process.wait(timeout=10)
+
+
+async def run_level(api_url: str, photo: bytes, concurrency: int, requests: int,
+                    detail: str = "low") -> tuple[List[float], int, float]:
+    latencies: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _upload(client: httpx.AsyncClient):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(f"{api_url}/get_ics_card/", params={"detail": detail},
+                                             files={"photo": ("photo.jpg", photo, "image/jpeg")})
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[_upload(client) for _ in range(requests)])
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def run(profiles: UpstreamProfiles, photo: bytes, levels: List[int], requests: int,
+        verbose: bool = False, env: Optional[Dict[str, str]] = None, detail: str = "low",
+        langsmith: bool = False) -> List[LevelResult]:
+    results = []
+    upstream_app = create_upstream_app(profiles)
+    with BackgroundServer(upstream_app) as upstream:
+        if langsmith:
+            env = {"LANGSMITH_API_KEY": "fake", "LANGSMITH_ENDPOINT": upstream.url} | (env or {})
+        for concurrency in levels:
+            # a fresh process per level, so the peak memory is not carried over from the previous level
+            api = ApiProcess(upstream.url, verbose, env)
+            try:
+                api.wait_ready()
+                tracing = dict(upstream_app.state.tracing)
+                latencies, errors, elapsed = asyncio.run(run_level(api.url, photo, concurrency, requests, detail))
+                api_metrics = api.metrics()
+                summaries = api_metrics["summaries"]
+                lag = summaries.get("event_loop.lag_ms")
+                request_peak = summaries.get("memory.request.peak_bytes")
+                results.append(LevelResult(
+                    concurrency=concurrency,
+                    requests=requests,
+                    errors=errors,
+                    p50_ms=round(percentile(latencies, 50), 1),
+                    p95_ms=round(percentile(latencies, 95), 1),
+                    p99_ms=round(percentile(latencies, 99), 1),
+                    rps=round(requests / elapsed, 2),
+                    peak_rss_mb=api.peak_rss_mb,
+                    loop_lag_avg_ms=round(lag["avg"], 1) if lag else None,
+                    loop_lag_max_ms=round(lag["max"], 1) if lag else None,
+                    request_peak_mb=round(request_peak["max"] / 1024 / 1024, 1) if request_peak else None,
+                    traces=upstream_app.state.tracing["traces"] - tracing["traces"] if langsmith else None,
+                    trace_mb=round((upstream_app.state.tracing["bytes"] - tracing["bytes"]) / 1024 / 1024, 1)
+                    if langsmith else None,
+                    azure_reuse=api_metrics["connections"]["azure_openai"]["reuse_rate"],
+                ))
+            finally:
+                api.stop()
+    return results
+
+
+def print_report(results: List[LevelResult]) -> None:
+    print(f"{'concurrency':>11} {'requests':>8} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'rps':>7} {'peak MB':>8} "
+          f"{'lag avg ms':>10} {'lag max ms':>10} {'req peak MB':>11} {'traces':>6} {'trace MB':>8} {'azure reuse':>11}")
+    for r in results:
+        peak = f"{r.peak_rss_mb:.1f}" if r.peak_rss_mb is not None else "n/a"
+        print(f"{r.concurrency:>11} {r.requests:>8} {r.errors:>6} {r.p50_ms:>9} {r.p95_ms:>9} {r.p99_ms:>9} {r.rps:>7} {peak:>8} "
+              f"{r.loop_lag_avg_ms if r.loop_lag_avg_ms is not None else 'n/a':>10} "
+              f"{r.loop_lag_max_ms if r.loop_lag_max_ms is not None else 'n/a':>10} "
+              f"{r.request_peak_mb if r.request_peak_mb is not None else 'n/a':>11} "
+              f"{r.traces if r.traces is not None else 'n/a':>6} {r.trace_mb if r.trace_mb is not None else 'n/a':>8} "
+              f"{r.azure_reuse if r.azure_reuse is not None else 'n/a':>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark of src.api against local stand-in upstreams")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=50, help="requests per concurrency level")
+    parser.add_argument("--detail", default="low", choices=["low", "high", "adaptive"], help="vision detail")
+    parser.add_argument("--image-size", default="3000x4000", help="WIDTHxHEIGHT of the uploaded JPEG")
+    parser.add_argument("--azure", default="800:0.3", help="latency_ms[:jitter[:error_rate[:error_status]]]")
+    parser.add_argument("--serpapi", default="300:0.3")
+    parser.add_argument("--geoapify", default="80:0.2")
+    parser.add_argument("--deployment", action="append", default=[],
+                        help="DEPLOYMENT=spec overriding the azure profile for one deployment (e.g. instruct=300:0.2)")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE setting for the API (e.g. CARD_GENERATION_ROUTE=vision)")
+    parser.add_argument("--langsmith", action="store_true",
+                        help="trace to a LangSmith stand-in, e.g. with --env LANGSMITH_SAMPLE_RATE=0.1")
+    parser.add_argument("--json", type=Path, help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the API logs")
+    args = parser.parse_args()
+
+    profiles = UpstreamProfiles(
+        azure=UpstreamProfile.parse(args.azure),
+        serpapi=UpstreamProfile.parse(args.serpapi),
+        geoapify=UpstreamProfile.parse(args.geoapify),
+        deployments={name: UpstreamProfile.parse(spec) for name, spec in (d.split("=", 1) for d in args.deployment)},
+    )
+    env = dict(item.split("=", 1) for item in args.env)
+    width, height = (int(value) for value in args.image_size.split("x"))
+    photo = make_photo(width, height)
+    print(f"photo: {len(photo) / 1024 / 1024:.1f} MB")
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    results = run(profiles, photo, levels, args.requests, args.verbose, env, args.detail, args.langsmith)
+    print_report(results)
+    if args.json:
+        args.json.write_text(json.dumps([asdict(r) for r in results], indent=2))
+
+
+if __name__ == "__main__":
+    main()
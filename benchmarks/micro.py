@@ -0,0 +1,148 @@
+import argparse
+import atexit
+import base64
+import json
+import os
+import sys
+import tempfile
+import timeit
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from PIL import Image
+
+from benchmarks.load import make_photo
+from tests.fixtures import CONTACT_CARD, SERPAPI_SEARCH_BY_UULE
+
+BASELINES_PATH = Path(__file__).parent / "baselines.json"
+DEFAULT_THRESHOLD = 0.25
+
+
+def _calibration():
+    # fixed mix of interpreter and memory bound work, used to scale the baselines to the current machine
+    sum(i * i for i in range(20_000))
+    base64.b64encode(bytes(200_000))
+
+
+def _local_results(count: int = 20) -> List[Dict]:
+    results = []
+    for idx in range(count):
+        local = dict(SERPAPI_SEARCH_BY_UULE[idx % len(SERPAPI_SEARCH_BY_UULE)])
+        local["position"] = idx + 1
+        local["title"] = f"{local['title']} {idx}"
+        local["address"] = f"{(idx + 1) * 0.7:.1f} km · {idx} Main Street"
+        results.append(local)
+    return results
+
+
+def build_cases(photo: bytes) -> Dict[str, Callable[[], object]]:
+    from src.api import _normalize_fn, _normalize_tel, _normalize_vcf
+    from src.imaging import EXIFHelper, encode_image
+    from src.llm.places import SerpapiHelper
+    from src.llm.schemas import ContactCard
+
+    photo_file = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
+    photo_file.write(photo)
+    photo_file.close()
+    atexit.register(os.remove, photo_file.name)
+
+    local_results = _local_results()
+    contact_card = ContactCard(**CONTACT_CARD)
+    card = contact_card.to_vcard()
+    card_digits = card.replace("TEL;TYPE=work,voice:", "TEL;")
+
+    class CannedSerpapiHelper(SerpapiHelper):
+        @classmethod
+        def _search(cls, settings, additional_args: Dict, hedger=None) -> List[Dict]:
+            return local_results
+
+    return {
+        "exif_extract_coordinates": lambda: EXIFHelper.extract_coordinates(Image.open(BytesIO(photo))),
+        "encode_image": lambda: encode_image(photo_file.name),
+        "serpapi_normalize_distance": lambda: [SerpapiHelper._normalize_distance(local) for local in local_results],
+        "serpapi_normalize_address": lambda: [SerpapiHelper._normalize_address(local) for local in local_results],
+        "serpapi_search_by_uule": lambda: CannedSerpapiHelper.search_by_uule(None, "query", "uule"),
+        "vcard_render": contact_card.to_vcard,
+        "vcard_normalizers": lambda: (_normalize_tel(card), _normalize_tel(card_digits), _normalize_fn(card),
+                                      _normalize_vcf(card)),
+    }
+
+
+def _number(timer: timeit.Timer, min_time: float) -> int:
+    # calls per round, so a round takes at least `min_time` seconds
+    number, _ = timer.autorange()
+    return max(number, int(number * min_time / 0.2))
+
+
+def measure(fn: Callable[[], object], repeat: int = 7, min_time: float = 0.5) -> Tuple[float, float]:
+    """
+    Best (minimum) time per call in microseconds of `fn` and of the calibration workload, over `repeat` rounds of
+    at least `min_time` seconds each. The rounds of both alternate, so a change of the machine speed during the
+    run (e.g. other workloads on a shared host) affects both alike.
+    """
+    timers = [timeit.Timer(_calibration), timeit.Timer(fn)]
+    numbers = [_number(timer, min_time) for timer in timers]
+    best = [float("inf"), float("inf")]
+    for _ in range(repeat):
+        for index, (timer, number) in enumerate(zip(timers, numbers)):
+            best[index] = min(best[index], timer.timeit(number) / number * 1e6)
+    return best[0], best[1]
+
+
+def run(photo: bytes, selected: List[str] = None, repeat: int = 7, min_time: float = 0.5) -> Dict[str, float]:
+    """
+    Time per call of each case, in microseconds of the machine speed given by the overall calibration time: each
+    case is scaled by its calibration (measured alongside it) to the overall one.
+    """
+    cases = {name: fn for name, fn in build_cases(photo).items() if not selected or name in selected}
+    measured = {name: measure(fn, repeat, min_time) for name, fn in cases.items()}
+    calibration = min(calibration for calibration, _ in measured.values())
+    return {"calibration": calibration} | {name: value * calibration / case_calibration
+                                           for name, (case_calibration, value) in measured.items()}
+
+
+def compare(results: Dict[str, float], baselines: Dict[str, float], threshold: float) -> List[str]:
+    """
+    Returns the cases slower than their baseline by more than `threshold`, once the baselines are scaled by the
+    ratio between the current and the baseline calibration times.
+    """
+    scale = results["calibration"] / baselines["calibration"]
+    regressions = []
+    for name, value in results.items():
+        if name == "calibration" or name not in baselines:
+            continue
+        expected = baselines[name] * scale
+        if value > expected * (1 + threshold):
+            regressions.append(f"{name}: {value:.1f} us > {expected:.1f} us (+{value / expected - 1:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the CPU-side hot paths")
+    parser.add_argument("cases", nargs="*", help="cases to run (default: all)")
+    parser.add_argument("--update", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown (0.25 = 25%%)")
+    parser.add_argument("--baselines", type=Path, default=BASELINES_PATH)
+    parser.add_argument("--repeat", type=int, default=7, help="rounds of each case")
+    parser.add_argument("--min-time", type=float, default=0.5, help="minimum seconds of each round")
+    args = parser.parse_args()
+
+    results = run(make_photo(4000, 3000), args.cases, args.repeat, args.min_time)
+    for name, value in results.items():
+        print(f"{name:>28}: {value:12.1f} us")
+
+    if args.update:
+        baselines = json.loads(args.baselines.read_text()) if args.baselines.exists() and args.cases else {}
+        args.baselines.write_text(json.dumps(baselines | {k: round(v, 2) for k, v in results.items()}, indent=2) + "\n")
+        print(f"baselines written to {args.baselines}")
+        return
+
+    regressions = compare(results, json.loads(args.baselines.read_text()), args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
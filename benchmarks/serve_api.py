@@ -0,0 +1,21 @@
+import argparse
+
+import uvicorn
+
+from benchmarks.fakes import redirect_upstreams
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs src.api against the benchmark stand-in upstreams")
+    parser.add_argument("--upstream-url", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    redirect_upstreams(args.upstream_url)
+    from src.api import app
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
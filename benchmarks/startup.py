@@ -0,0 +1,83 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from benchmarks.fakes import BackgroundServer, UpstreamProfiles, create_upstream_app
+from benchmarks.load import ApiProcess
+
+# milliseconds
+DEFAULT_BUDGETS = {"src.api": 2000, "src.bot": 1000, "ready": 4000}
+FAKE_ENV = {
+    "AZURE_OPENAI_API_KEY": "fake",
+    "AZURE_OPENAI_API_BASE": "http://127.0.0.1:9",
+    "TELEGRAM_TOKEN": "fake",
+}
+
+
+def import_times(module: str) -> Tuple[float, Dict[str, float]]:
+    """
+    Imports `module` in a fresh interpreter (`python -X importtime`), returning its total import time and the
+    self time aggregated by top-level package, both in milliseconds.
+    """
+    env = os.environ.copy() | FAKE_ENV
+    env.pop("LANGSMITH_API_KEY", None)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             env=env, capture_output=True, text=True, check=True)
+    packages: Dict[str, float] = defaultdict(float)
+    total = 0.0
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        packages[name.strip().split(".")[0]] += int(self_us) / 1000
+        if name.strip() == module:
+            total = int(cumulative_us) / 1000
+    return total, dict(packages)
+
+
+def time_to_ready() -> float:
+    """
+    Milliseconds from spawning the API until its readiness probe passes (agent built and warmed up).
+    """
+    with BackgroundServer(create_upstream_app(UpstreamProfiles())) as upstream:
+        start = time.perf_counter()
+        api = ApiProcess(upstream.url)
+        try:
+            api.wait_ready()
+            return (time.perf_counter() - start) * 1000
+        finally:
+            api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup budget report: import times and time to ready")
+    parser.add_argument("--budget", action="append", default=[],
+                        help="NAME=MS overriding a budget, NAME being a module or 'ready' (default: %s)" % DEFAULT_BUDGETS)
+    parser.add_argument("--top", type=int, default=10, help="packages to show per module")
+    args = parser.parse_args()
+
+    budgets = DEFAULT_BUDGETS | {name: float(ms) for name, ms in (budget.split("=") for budget in args.budget)}
+    measured: Dict[str, float] = {}
+    for module in [name for name in budgets if name != "ready"]:
+        total, packages = import_times(module)
+        measured[module] = total
+        print(f"import {module}: {total:.0f} ms")
+        for package, ms in sorted(packages.items(), key=lambda item: -item[1])[: args.top]:
+            print(f"    {package:<24} {ms:8.1f} ms")
+    if "ready" in budgets:
+        measured["ready"] = time_to_ready()
+        print(f"time to ready: {measured['ready']:.0f} ms")
+
+    over_budget: List[str] = [f"{name}: {ms:.0f} ms > {budgets[name]:.0f} ms"
+                              for name, ms in measured.items() if ms > budgets[name]]
+    for line in over_budget:
+        print(f"OVER BUDGET {line}")
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
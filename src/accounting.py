@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from threading import Lock
+from typing import Dict, Iterator, List, Optional
+
+from src.metrics import metrics
+
+
+@dataclass
+class Usage:
+    """
+    Upstream calls and tokens used to create a card.
+
+    The instance is bound to the current context with `activate`, so any code running on behalf of the card
+    (including langchain callbacks and the places helpers run in thread pools) can record usage through
+    `record_usage`.
+    """
+
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    serpapi_searches: int = 0
+    geoapify_calls: int = 0
+    geoapify_batch_jobs: int = 0
+
+    def __post_init__(self):
+        self._lock = Lock()
+
+    def add(self, **counts: int) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return asdict(self)
+
+    def over_budget(self, budget: "Usage") -> List[str]:
+        """
+        The counts above their budget, e.g. ["prompt_tokens: 1200 > 1000"].
+        """
+        usage = self.as_dict()
+        return [f"{name}: {value} > {getattr(budget, name)}" for name, value in usage.items()
+                if value > getattr(budget, name)]
+
+    def header(self) -> str:
+        """
+        Formats the counts as a header value (e.g. "llm_calls=2, prompt_tokens=1210, ...").
+        """
+        return ", ".join(f"{name}={value}" for name, value in self.as_dict().items())
+
+    @contextmanager
+    def activate(self) -> Iterator["Usage"]:
+        token = _current_usage.set(self)
+        try:
+            yield self
+        finally:
+            _current_usage.reset(token)
+
+
+_current_usage: ContextVar[Optional[Usage]] = ContextVar("usage", default=None)
+
+
+def current_usage() -> Optional[Usage]:
+    return _current_usage.get()
+
+
+def record_usage(**counts: int) -> None:
+    """
+    Adds the counts to the active `Usage`, if any, and to the process totals (`usage.{count}` counters).
+    """
+    for name, value in counts.items():
+        metrics.increment(f"usage.{name}", value)
+    usage = current_usage()
+    if usage is not None:
+        usage.add(**counts)
+
+
+@contextmanager
+def track_usage(name: str) -> Iterator[Usage]:
+    """
+    Records the usage of the enclosed block on a new `Usage`, observed as `usage.{name}.{count}` summaries and added
+    to the `Usage` active around it, if any (e.g. the request one).
+    """
+    outer = current_usage()
+    usage = Usage()
+    try:
+        with usage.activate():
+            yield usage
+    finally:
+        counts = usage.as_dict()
+        for count, value in counts.items():
+            metrics.observe(f"usage.{name}.{count}", value)
+        if outer is not None:
+            outer.add(**counts)
@@ -0,0 +1,72 @@
+import asyncio
+import time
+from typing import Any, Dict, Hashable, List, Optional
+
+from telegram import Message
+from telegram.ext import filters
+
+from src.persistence import StateStore
+
+
+class MediaGroupBuffer:
+    """
+    Collects the items of media groups (albums), which Telegram delivers as separate messages with the same
+    `media_group_id`. A group is complete once no new item has arrived for `window` seconds.
+
+    The items are kept in a `StateStore`, so the messages of an album received by different bot replicas end up in
+    the same group; the group is handled by the replica that received its first message (see `collect`). The items
+    are written through, and the group is claimed with `StateStore.pop_all`, so every item added before the claim is
+    collected, whichever replica added it. Items of groups never collected expire after `ttl` seconds.
+    """
+
+    def __init__(self, store: StateStore, window: float = 1.0, ttl: Optional[float] = None):
+        self._store = store
+        self._window = window
+        self._ttl = ttl
+
+    @staticmethod
+    def _namespace(key: Hashable) -> str:
+        parts = key if isinstance(key, tuple) else (key,)
+        return "media_group:" + ":".join(str(part) for part in parts)
+
+    def _entries(self, key: Hashable) -> Dict[int, dict]:
+        return {int(message_id): entry for message_id, entry in self._store.get_all(self._namespace(key)).items()}
+
+    def add(self, key: Hashable, message_id: int, item: Any) -> bool:
+        """
+        Adds the item of a message to the group, returning whether it is the first one (no earlier message of the
+        group has been seen).
+        """
+        # wall clock time, compared across replicas
+        self._store.set(self._namespace(key), str(message_id), {"item": item, "at": time.time()}, self._ttl)
+        self._store.flush()
+        return min(self._entries(key)) == message_id
+
+    def __contains__(self, key: Hashable) -> bool:
+        return bool(self._entries(key))
+
+    async def collect(self, key: Hashable, message_id: Optional[int] = None) -> List[Any]:
+        """
+        Waits until the group is complete and returns its items, in message order, removing them. Given the
+        `message_id` added, the items are only returned (and removed) when it is the first message of the group, so
+        a group is collected once even when several replicas wait for it.
+        """
+        while entries := self._entries(key):
+            remaining = max(entry["at"] for entry in entries.values()) + self._window - time.time()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        if not entries or (message_id is not None and min(entries) != message_id):
+            return []
+        # the items added since the last read are claimed too
+        entries = {int(entry_id): entry for entry_id, entry in self._store.pop_all(self._namespace(key)).items()}
+        return [entries[entry_id]["item"] for entry_id in sorted(entries)]
+
+
+class MediaGroupFilter(filters.MessageFilter):
+    """
+    Messages that belong to a media group (album).
+    """
+
+    def filter(self, message: Message) -> bool:
+        return message.media_group_id is not None
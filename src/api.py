@@ -1,20 +1,57 @@
+import asyncio
+import secrets
+from contextlib import asynccontextmanager, nullcontext
+from dataclasses import asdict
 from pathlib import Path
-from typing import Annotated, Optional
-from fastapi import Depends, FastAPI, File, UploadFile, BackgroundTasks, middleware
-from fastapi.responses import FileResponse
-from PIL import Image
+import re
+import time
+from typing import Annotated, List, Literal, Optional, Tuple
+from fastapi import Depends, FastAPI, File, Header, HTTPException, Query, UploadFile, BackgroundTasks, middleware
+from fastapi.responses import FileResponse, StreamingResponse
 import os
 import tempfile
+import tracemalloc
 from loguru import logger
 from fastapi.middleware.cors import CORSMiddleware
+import randomname
 
+from src.cache import get_cache
+from src.deadline import DeadlineExceeded
+from src.degradation import DegradationLevel
+from src.imaging import ImageExecutor, get_image_executor, read_coordinates
 from src.llm.agent import CardAgent, build_agent
-from src.llm.places import EXIFHelper
+from src.accounting import Usage
+from src.metrics import metrics, monitor_event_loop_lag, track_peak_memory
+from src.profiling import ProfileMode, ProfileStore, get_profile_store
+from src.progress import CARD, ERROR, RECEIVED, Progress
+from src.settings import get_settings
+from src.timing import StageTimings, track_stage
 from src.utils import is_empty
 from pydantic import BaseModel
 from loguru import logger
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # peak memory of each request, traced at the cost of slowing the API down
+    if os.getenv("TRACE_MEMORY"):
+        tracemalloc.start()
+    # build the agent and open its connections before accepting requests, so the first user does not pay for it
+    start = time.perf_counter()
+    agent = build_agent()
+    await agent.warmup()
+    logger.info(f"Agent warmed up in {(time.perf_counter() - start) * 1000:.0f} ms")
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    # keeps the Azure OpenAI connections open while idle, so the first card after a pause does not set them up again
+    keep_warm = asyncio.create_task(agent.keep_warm())
+    yield
+    lag_monitor.cancel()
+    keep_warm.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 # Add CORS middleware
 app.add_middleware(
@@ -30,42 +67,53 @@ class Location(BaseModel):
     latitude: float
     longitude: float
 
-async def call_agent(agent: CardAgent, image_url, detail: str = "low", location: Optional[Location] = None):
+
+def _normalize_fn(text: str):
+    term = "FN:"
+    idx = text.find(term)
+    idx_end = text.find("\n", idx)
+    return text[idx + len(term) : idx_end]
+
+def _normalize_tel(text: str):
+    for term in ["TEL:", "TEL;"]:
+        idx = text.find(term)
+        if idx > -1:
+            break
+    if idx == -1:
+        return "111 222 333"
+    idx_end = text.find("\n", idx)
+    sub_text = text[idx + len(term) : idx_end]
+    if sub_text.find(":") > -1:
+        return sub_text.split(":")[-1]
+    else:
+        return "".join(re.findall(r"\d", sub_text))
+
+def _normalize_vcf(vcf: str):
+    return vcf.encode('latin-1', errors='ignore').decode('latin-1')
+
+
+async def call_agent(agent: CardAgent, image_url, detail: str = "low", location: Optional[Location] = None,
+                     run_name: Optional[str] = None, level: Optional[DegradationLevel] = None,
+                     place: Optional[dict] = None):
     logger.info("Calling agent ...")
-    kwargs = {}
+    kwargs = {"level": level} if level is not None else {}
+    if place:
+        kwargs["place"] = place
     if location:
         kwargs["lat"] = location.latitude
         kwargs["lon"] = location.longitude
-    event = await agent.create_card(image_url, detail=detail, **kwargs)
+    event = await agent.create_card(image_url, detail=detail, run_name=run_name, **kwargs)
     return event
 
 
-async def handle_image(agent: CardAgent, image_path: str, detail: str = "low", location: Optional[Location] = None):
-    def _normalize_fn(text: str):
-        term = "FN:"
-        idx = text.find(term)
-        idx_end = text.find("\n", idx)
-        return text[idx + len(term) : idx_end]
-
-    def _normalize_tel(text: str):
-        for term in ["TEL:", "TEL;"]:
-            idx = text.find(term)
-            if idx > -1:
-                break
-        if idx == -1:
-            return "111 222 333"
-        idx_end = text.find("\n", idx)
-        sub_text = text[idx + len(term) : idx_end]
-        if sub_text.find(":") > -1:
-            return sub_text.split(":")[-1]
-        else:
-            return "".join(re.findall("\d", sub_text))
-
-    def _normalize_vcf(vcf: str):
-        return vcf.encode('latin-1', errors='ignore').decode('latin-1')
-
+async def handle_image(agent: CardAgent, image_path: str, detail: str = "low", location: Optional[Location] = None,
+                       run_name: Optional[str] = None, level: Optional[DegradationLevel] = None,
+                       place: Optional[dict] = None):
     # Process the image and generate the ICS file
-    vcf_data = await call_agent(agent, image_path, detail, location)
+    vcf_data = await call_agent(agent, image_path, detail, location, run_name, level, place)
+    if vcf_data is None:
+        # the agent gives up (and logs why) once the request deadline is exceeded or the upstreams fail
+        raise DeadlineExceeded("No se pudo generar la tarjeta a tiempo.")
     vcf_data = vcf_data.encode("utf7", "ignore").decode("utf7")
     logger.debug(f"vcf_data: {vcf_data}")
 
@@ -81,6 +129,51 @@ async def handle_image(agent: CardAgent, image_path: str, detail: str = "low", l
         raise ValueError("No se pudo generar la tarjeta.")
 
 
+def image_executor() -> ImageExecutor:
+    settings = get_settings()
+    return get_image_executor(settings.IMAGE_EXECUTOR, settings.IMAGE_WORKERS)
+
+
+@app.get("/health")
+async def health():
+    # served once the lifespan warm-up is done, hence usable as readiness probe
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+async def get_metrics(agent: CardAgent = Depends(build_agent)):
+    snapshot = metrics.snapshot()
+    cache = get_cache(get_settings().CACHE_URL)
+    if cache:
+        snapshot["cache"] = asdict(cache.stats())
+    connections = agent.connections
+    snapshot["connections"] = {connections.name: connections.report()}
+    return snapshot
+
+
+def profile_store(x_admin_token: Optional[str] = Header(default=None)) -> ProfileStore:
+    """
+    Profiles of the API requests, only for the callers with the `PROFILE_TOKEN` (sent in the `X-Admin-Token` header).
+    """
+    settings = get_settings()
+    if not settings.PROFILE_TOKEN or not secrets.compare_digest(x_admin_token or "", settings.PROFILE_TOKEN):
+        raise HTTPException(status_code=403, detail="Profiling not allowed")
+    return get_profile_store(settings.PROFILE_DIR, settings.PROFILE_KEEP)
+
+
+@app.get("/profiles")
+async def list_profiles(store: ProfileStore = Depends(profile_store)):
+    return [asdict(profile) for profile in store.list()]
+
+
+@app.get("/profiles/{name}")
+async def get_profile(name: str, store: ProfileStore = Depends(profile_store)):
+    path = store.path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(str(path), media_type="application/octet-stream", filename=name)
+
+
 def delete_file(file_path: Path):
     if file_path.exists():
         logger.info(f"Deleting file: {file_path}")
@@ -91,17 +184,67 @@ async def get_ics_card(background_tasks: BackgroundTasks,
                        # location: Optional[Location],
                        latitude: Optional[float] = None,
                        longitude: Optional[float] = None,
+                       detail: Literal["low", "high", "adaptive"] = "low",
                        photo: UploadFile = File(...), 
                        # location: Optional[Location] = Depends(),
-                       agent: CardAgent = Depends(build_agent)):
+                       agent: CardAgent = Depends(build_agent),
+                       images: ImageExecutor = Depends(image_executor),
+                       x_profile: Optional[ProfileMode] = Header(default=None),
+                       x_admin_token: Optional[str] = Header(default=None)):
+    run_name = randomname.get_name()
+    # only requests asking for it are profiled, checked (and the settings read) only then
+    profiling = profile_store(x_admin_token).profile(run_name, x_profile) if x_profile else nullcontext()
+    timings = StageTimings()
+    usage = Usage()
+    peak = None
+    try:
+        with profiling as profile, timings.activate(), usage.activate(), timings.stage("total"), \
+                track_peak_memory("request") as peak:
+            try:
+                response = await _get_ics_card(background_tasks, latitude, longitude, detail, photo, agent, images,
+                                               run_name)
+            except DeadlineExceeded as e:
+                raise HTTPException(status_code=504, detail=str(e))
+        response.headers["Server-Timing"] = timings.server_timing()
+        response.headers["X-Upstream-Usage"] = usage.header()
+        if profile:
+            response.headers["X-Profile"] = profile.name
+        return response
+    finally:
+        logger.bind(run_name=run_name, timings=timings.durations, peak_memory=peak and peak.bytes,
+                    usage=usage.as_dict()).info(
+            f"Card {run_name} timings: {timings.durations}")
+
+async def _save_upload(photo: UploadFile, photo_file) -> None:
+    with track_stage("upload"):
+        # copied in chunks, the upload is already spooled by starlette
+        while chunk := await photo.read(UPLOAD_CHUNK_SIZE):
+            photo_file.write(chunk)
+        photo_file.flush()
+
+
+async def _create_vcard(agent: CardAgent, images: ImageExecutor, image_path: str, latitude: Optional[float],
+                        longitude: Optional[float], detail: str, run_name: str,
+                        place: Optional[dict] = None) -> Tuple[str, str, DegradationLevel]:
+    # the image is decoded in the image executor, the event loop only does I/O
+    with track_stage("exif"):
+        lat, lon = await images.run(read_coordinates, image_path)
+    location = Location(latitude=lat or latitude, longitude=lon or longitude)
+    # picked here, so the response can tell which pipeline created the card
+    level = agent.degradation_level()
+    _, first_name, vcf_data = await handle_image(agent, image_path, detail, location=location, run_name=run_name,
+                                                 level=level, place=place)
+    return first_name, vcf_data, level
+
+
+async def _get_ics_card(background_tasks: BackgroundTasks, latitude: Optional[float], longitude: Optional[float],
+                        detail: str, photo: UploadFile, agent: CardAgent, images: ImageExecutor,
+                        run_name: str) -> FileResponse:
     # Save the uploaded image file using a temporary directory
     with tempfile.NamedTemporaryFile() as photo_file:
-        photo_file.write(await photo.read())
-
-        img = Image.open(photo_file)
-        lat, lon = EXIFHelper.extract_coordinates(img)
-        location = Location(latitude=lat or latitude, longitude=lon or longitude)
-        _, first_name, vcf_data = await handle_image(agent, photo_file.name, location=location)
+        await _save_upload(photo, photo_file)
+        first_name, vcf_data, level = await _create_vcard(agent, images, photo_file.name, latitude, longitude, detail,
+                                                          run_name)
 
         # Create a new temporary directory
         vcf_file_name = f"{first_name or 'event'}.vcf"
@@ -115,7 +258,122 @@ async def get_ics_card(background_tasks: BackgroundTasks,
         # Add the file deletion task to the background tasks
         background_tasks.add_task(delete_file, vcf_file_path)
 
-        return FileResponse(str(vcf_file_path), media_type='text/calendar', filename=vcf_file_name)
+        return FileResponse(str(vcf_file_path), media_type='text/calendar', filename=vcf_file_name,
+                            headers={"X-Degradation-Level": level.label})
+
+
+@app.post("/get_ics_card/stream")
+async def stream_ics_card(latitude: Optional[float] = None,
+                          longitude: Optional[float] = None,
+                          detail: Literal["low", "high", "adaptive"] = "low",
+                          photo: UploadFile = File(...),
+                          agent: CardAgent = Depends(build_agent),
+                          images: ImageExecutor = Depends(image_executor)):
+    """
+    Same as `/get_ics_card/`, streaming server-sent events as the card is built: `received`, `transcribed` (the
+    venue name read), `place` (the place found, if any) and finally `card` (with the vCard) or `error`.
+    """
+    run_name = randomname.get_name()
+    # the upload is copied before streaming, starlette closes it once the endpoint returns
+    photo_file = tempfile.NamedTemporaryFile()
+    await _save_upload(photo, photo_file)
+    progress = Progress()
+    progress.report(RECEIVED, run_name=run_name)
+
+    async def _create_card():
+        timings = StageTimings()
+        usage = Usage()
+        try:
+            with photo_file, progress.activate(), timings.activate(), usage.activate(), timings.stage("total"):
+                first_name, vcf_data, level = await _create_vcard(agent, images, photo_file.name, latitude, longitude,
+                                                                  detail, run_name)
+            progress.report(CARD, vcard=vcf_data, filename=f"{first_name or 'event'}.vcf", level=level.label)
+        except Exception as e:
+            logger.exception(f"Error creating card {run_name}")
+            progress.report(ERROR, detail=str(e))
+        finally:
+            progress.close()
+            logger.bind(run_name=run_name, timings=timings.durations, usage=usage.as_dict()).info(
+                f"Card {run_name} timings: {timings.durations}")
+
+    task = asyncio.create_task(_create_card())
+
+    async def _events():
+        try:
+            async for event in progress.events():
+                yield event.encode()
+        finally:
+            # the client went away
+            task.cancel()
+
+    return StreamingResponse(_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/get_ics_cards/stream")
+async def stream_ics_cards(latitude: Optional[float] = None,
+                           longitude: Optional[float] = None,
+                           detail: List[Literal["low", "high", "adaptive"]] = Query(default=["low"]),
+                           photos: List[UploadFile] = File(...),
+                           agent: CardAgent = Depends(build_agent),
+                           images: ImageExecutor = Depends(image_executor)):
+    """
+    Cards of many photos (e.g. an album), streaming server-sent events: `received` (with the number of photos), then
+    a `card` (as in `/get_ics_card/stream`) or `error` event per photo, with its `index`, as each one is ready.
+    `detail` is given once for every photo, or once per photo.
+
+    The EXIF coordinates of the photos are reverse geocoded together with a Geoapify batch job, the photos without
+    them use the given location.
+    """
+    if len(detail) not in (1, len(photos)):
+        raise HTTPException(status_code=422, detail="detail must be given once, or once per photo")
+    details = detail * len(photos) if len(detail) == 1 else detail
+    run_name = randomname.get_name()
+    photo_files = []
+    for photo in photos:
+        photo_files.append(tempfile.NamedTemporaryFile())
+        await _save_upload(photo, photo_files[-1])
+    progress = Progress()
+    progress.report(RECEIVED, run_name=run_name, photos=len(photos))
+
+    async def _create_card(index: int, photo_file, places: dict):
+        # the progress of each card is not streamed, only its result
+        card_run_name = f"{run_name}-{index}"
+        try:
+            first_name, vcf_data, level = await _create_vcard(agent, images, photo_file.name, latitude, longitude,
+                                                              details[index], card_run_name,
+                                                              places.get(photo_file.name))
+            progress.report(CARD, index=index, vcard=vcf_data, filename=f"{first_name or 'event'}.vcf",
+                            level=level.label)
+        except Exception as e:
+            logger.exception(f"Error creating card {card_run_name}")
+            progress.report(ERROR, index=index, detail=str(e))
+
+    async def _create_cards():
+        timings = StageTimings()
+        usage = Usage()
+        try:
+            with timings.activate(), usage.activate(), timings.stage("total"):
+                places = await agent.reverse_geocode_images([photo_file.name for photo_file in photo_files])
+                await asyncio.gather(*[_create_card(index, photo_file, places)
+                                       for index, photo_file in enumerate(photo_files)])
+        finally:
+            for photo_file in photo_files:
+                photo_file.close()
+            progress.close()
+            logger.bind(run_name=run_name, timings=timings.durations, usage=usage.as_dict()).info(
+                f"Cards {run_name} ({len(photo_files)} photos) timings: {timings.durations}")
+
+    task = asyncio.create_task(_create_cards())
+
+    async def _events():
+        try:
+            async for event in progress.events():
+                yield event.encode()
+        finally:
+            task.cancel()
+
+    return StreamingResponse(_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 if __name__ == "__main__":
     import uvicorn
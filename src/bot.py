@@ -1,3 +1,4 @@
+import asyncio
 import html
 import json
 import re
@@ -6,13 +7,13 @@ import traceback
 import aiohttp
 from enum import IntEnum
 from io import BytesIO
-from typing import Optional
+from contextlib import ExitStack
+from typing import Awaitable, Callable, List, Optional
 
-import requests
 from loguru import logger
-from PIL import Image
 from telegram import Location, ReplyKeyboardRemove, Update
 from telegram.constants import ChatAction, ParseMode
+from telegram.error import TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -22,8 +23,12 @@ from telegram.ext import (
     filters,
 )
 
-from src.llm.places import EXIFHelper
+from src.albums import MediaGroupBuffer
+from src.imaging import read_coordinates
+from src.persistence import SharedConversationHandler, StoreMapping, create_state_store
+from src.progress import CARD, ERROR, PLACE, RECEIVED, TRANSCRIBED, ProgressEvent, read_events
 from src.settings import get_settings
+from src.updates import ChatOrderedUpdateProcessor
 from src.utils import is_empty
 
 settings = get_settings()
@@ -39,30 +44,106 @@ class States(IntEnum):
 PHOTO = 1
 NO_GPS = 2
 
-async def call_agent(image_path: str, location: Optional[Location] = None):
+# state shared by the bot replicas (kept in memory when no BOT_STATE_PATH is set)
+state_store = create_state_store(settings.BOT_STATE_PATH, settings.BOT_STATE_FLUSH_INTERVAL)
+# last location ({"latitude": ..., "longitude": ...}) shared by each user, reused for the next photos until it expires
+locations = StoreMapping(state_store, "location", ttl=settings.BOT_LOCATION_TTL)
+# photo ({"file_id": ...}) or album ({"album": media group id}) of each chat waiting for the location, dropped when
+# the location does not arrive in time (the chat is asked for the photo again)
+pending_photos = StoreMapping(state_store, "pending_photo", ttl=settings.BOT_PENDING_PHOTO_TTL)
+# photos of the albums being received, by (chat id, media group id), whichever replica receives them
+album_buffer = MediaGroupBuffer(state_store, settings.TELEGRAM_MEDIA_GROUP_WINDOW, ttl=settings.BOT_PENDING_PHOTO_TTL)
+
+def _user_location(user_id: int) -> Optional[Location]:
+    location = locations.get(user_id)
+    return Location(longitude=location["longitude"], latitude=location["latitude"]) if location else None
+
+async def call_agent(image_path: str, detail: str = "low", location: Optional[Location] = None,
+                     on_progress: Optional[Callable[[ProgressEvent], Awaitable[None]]] = None) -> Optional[str]:
+    """
+    Creates the card with the API streaming endpoint, awaiting `on_progress` with each event until the card is ready.
+    """
     logger.info("Calling agent via API ...")
-    api_url = f"{settings.API_URL}/get_ics_card/"
+    api_url = f"{settings.API_URL}/get_ics_card/stream"
     
     async with aiohttp.ClientSession() as session:
         data = aiohttp.FormData()
         data.add_field('photo', open(image_path, 'rb'))
+        # the API reads everything but the photo from the query string
+        params = {"detail": detail}
         if location:
-            data.add_field('latitude', str(location.latitude))
-            data.add_field('longitude', str(location.longitude))
+            params["latitude"] = str(location.latitude)
+            params["longitude"] = str(location.longitude)
         
-        async with session.post(api_url, data=data) as response:
-            if response.status == 200:
-                return await response.text()
-            else:
+        async with session.post(api_url, data=data, params=params) as response:
+            if response.status != 200:
                 logger.error(f"API call failed with status {response.status}")
                 return None
+            async for event in read_events(response.content):
+                if event.event == CARD:
+                    return event.data["vcard"]
+                if event.event == ERROR:
+                    logger.error(f"API call failed: {event.data.get('detail')}")
+                    return None
+                if on_progress:
+                    await on_progress(event)
+    logger.error("API stream ended without a card")
+    return None
+
+async def call_agent_album(image_paths: List[str], details: List[str], location: Location,
+                           on_card: Optional[Callable[[], Awaitable[None]]] = None) -> List[Optional[str]]:
+    """
+    Creates the cards of an album with the API streaming endpoint (its places reverse geocoded together), awaiting
+    `on_card` as each one is ready. Returns the vCard of each image, in order, None for the failed ones.
+    """
+    logger.info(f"Calling agent via API for {len(image_paths)} images ...")
+    api_url = f"{settings.API_URL}/get_ics_cards/stream"
+    vcards: List[Optional[str]] = [None] * len(image_paths)
+
+    async with aiohttp.ClientSession() as session:
+        data = aiohttp.FormData()
+        for image_path in image_paths:
+            data.add_field('photos', open(image_path, 'rb'))
+        params = [("detail", detail) for detail in details] + [("latitude", str(location.latitude)),
+                                                               ("longitude", str(location.longitude))]
+
+        async with session.post(api_url, data=data, params=params) as response:
+            if response.status != 200:
+                logger.error(f"API call failed with status {response.status}")
+                return vcards
+            async for event in read_events(response.content):
+                if event.event == CARD:
+                    vcards[event.data["index"]] = event.data["vcard"]
+                elif event.event == ERROR:
+                    logger.error(f"API call failed for image {event.data.get('index')}: {event.data.get('detail')}")
+                else:
+                    continue
+                if on_card:
+                    await on_card()
+    return vcards
+
+def _progress_text(event: ProgressEvent) -> Optional[str]:
+    if event.event == RECEIVED:
+        return "Imagen recibida, leyendo..."
+    if event.event == TRANSCRIBED:
+        venue = event.data.get("venue")
+        return f"He leído «{venue}», buscando el lugar..." if venue else "Imagen leída, buscando el lugar..."
+    if event.event == PLACE:
+        return f"Encontrado: {event.data.get('title')}, creando la tarjeta..."
+    return None
+
+async def _edit_status(status, text: str) -> None:
+    # the status only informs the user, the card is sent anyway
+    try:
+        await status.edit_text(text)
+    except TelegramError as e:
+        logger.warning(f"Could not edit the status message: {e}")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("Start command ...")
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    if "location" in context.user_data:
-        del context.user_data["location"]
-        logger.debug("location removed from user_data")
+    if locations.pop(update.effective_user.id, None):
+        logger.debug("location removed")
     await update.message.reply_text("Bienvenido! Para convertir una imagen en una tarjeta de contacto, envíame una imagen.", 
                                     reply_markup=ReplyKeyboardRemove())
 
@@ -71,14 +152,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("Handling photo ...")
 
+    if update.message.media_group_id:
+        return await album_photo(update, context)
+
     if len(update.message.photo) > 0:
         # compressed image -> ask geolocation
         photo = await context.bot.get_file(update.message.photo[-1])
-        if context.user_data.get("location"):
-            await _handle_image(update, context, photo, detail="high", location=context.user_data["location"])
+        if location := _user_location(update.effective_user.id):
+            await _handle_image(update, context, photo, detail="adaptive", location=location)
             # return ConversationHandler.END
             return PHOTO
-        context.chat_data["photo"] = photo
+        pending_photos[update.effective_chat.id] = {"file_id": photo.file_id}
         await update.message.reply_text("¿Puedes compartir tu ubicación?", 
                                         reply_markup=ReplyKeyboardRemove())
         return NO_GPS
@@ -86,32 +170,69 @@ async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         # uncompressed image -> do card
         # TODO: refactor creating TelegramImage class
         photo = await context.bot.get_file(update.message.document)
-        # TODO: change to aiohttp
-        photo_content = BytesIO(requests.get(photo.file_path).content)
-        img = Image.open(photo_content)
-        lat, lon = EXIFHelper.extract_coordinates(img)
+        # downloaded and decoded off the event loop, so the other chats are served meanwhile
+        photo_content = BytesIO()
+        await photo.download_to_memory(photo_content)
+        photo_content.seek(0)
+        lat, lon = await asyncio.to_thread(read_coordinates, photo_content)
         if lat and lon:
             await _handle_image(update, context, photo, detail="low")
             # return ConversationHandler.END
             return PHOTO
-        elif context.user_data.get("location"):
-            await _handle_image(update, context, photo, detail="low", location=context.user_data["location"])
+        elif location := _user_location(update.effective_user.id):
+            await _handle_image(update, context, photo, detail="low", location=location)
             # return ConversationHandler.END
             return PHOTO
         else:
-            context.chat_data["photo"] = photo
+            pending_photos[update.effective_chat.id] = {"file_id": photo.file_id}
             await update.message.reply_text("¿Puedes compartir tu ubicación?", 
                                             reply_markup=ReplyKeyboardRemove())
             return NO_GPS
 
+async def album_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Collects the photos of an album: the first one asks for the location (unless known) and the album is handled
+    once complete, with a single reply.
+    """
+    album_key = (update.effective_chat.id, update.message.media_group_id)
+    # the file id (not the file) is kept, so the photos can be shared with the other replicas
+    if len(update.message.photo) > 0:
+        item = (update.message.photo[-1].file_id, "adaptive")
+    else:
+        item = (update.message.document.file_id, "low")
+
+    if not album_buffer.add(album_key, update.message.message_id, item):
+        # handled along with the first photo of the album
+        pending = pending_photos.get(update.effective_chat.id) or {}
+        return NO_GPS if pending.get("album") == update.message.media_group_id else PHOTO
+
+    if location := _user_location(update.effective_user.id):
+        # handled in the background, so the rest of the album (same chat, processed in order) can be collected
+        context.application.create_task(
+            _handle_album(update, context, album_key, location, update.message.message_id), update=update)
+        return PHOTO
+    pending_photos[update.effective_chat.id] = {"album": update.message.media_group_id}
+    await update.message.reply_text("¿Puedes compartir tu ubicación?", 
+                                    reply_markup=ReplyKeyboardRemove())
+    return NO_GPS
+
 async def location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("Handling location ...")
 
     if update.message.location:
         # location -> do card
-        photo = context.chat_data["photo"]
-        context.user_data["location"] = update.message.location
-        await _handle_image(update, context, photo, detail="high", location=update.message.location)
+        locations[update.effective_user.id] = {"latitude": update.message.location.latitude,
+                                               "longitude": update.message.location.longitude}
+        pending = pending_photos.pop(update.effective_chat.id, None)
+        if pending is None:
+            # expired
+            await update.message.reply_text("Envíame de nuevo la imagen.", reply_markup=ReplyKeyboardRemove())
+            return PHOTO
+        if "album" in pending:
+            await _handle_album(update, context, (update.effective_chat.id, pending["album"]), update.message.location)
+        else:
+            photo = await context.bot.get_file(pending["file_id"])
+            await _handle_image(update, context, photo, detail="adaptive", location=update.message.location)
         return ConversationHandler.END
     else:
         # no location -> ask for location
@@ -119,51 +240,98 @@ async def location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                                         reply_markup=ReplyKeyboardRemove())
         return NO_GPS
 
-async def _handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE, photo, detail: str, location: Optional[Location] = None):
-    def _normalize_fn(text: str):
-        term = "FN:"
+def _normalize_fn(text: str):
+    term = "FN:"
+    idx = text.find(term)
+    idx_end = text.find("\n", idx)
+    return text[idx + len(term) : idx_end]
+
+def _normalize_tel(text: str):
+    for term in ["TEL:", "TEL;"]:
         idx = text.find(term)
-        idx_end = text.find("\n", idx)
-        return text[idx + len(term) : idx_end]
-
-    def _normalize_tel(text: str):
-        for term in ["TEL:", "TEL;"]:
-            idx = text.find(term)
-            if idx > -1:
-                break
-        if idx == -1:
-            return "111 222 333"
-        idx_end = text.find("\n", idx)
-        sub_text = text[idx + len(term) : idx_end]
-        if sub_text.find(":") > -1:
-            return sub_text.split(":")[-1]
-        else:
-            return "".join(re.findall("\d", sub_text))
+        if idx > -1:
+            break
+    if idx == -1:
+        return "111 222 333"
+    idx_end = text.find("\n", idx)
+    sub_text = text[idx + len(term) : idx_end]
+    if sub_text.find(":") > -1:
+        return sub_text.split(":")[-1]
+    else:
+        return "".join(re.findall(r"\d", sub_text))
+
+def _normalize_vcf(vcf: str):
+    return vcf.encode('latin-1', errors='ignore').decode('latin-1')
 
-    def _normalize_vcf(vcf: str):
-        return vcf.encode('latin-1', errors='ignore').decode('latin-1')
+def _is_valid_card(vcf_data: Optional[str]) -> bool:
+    return bool(vcf_data) and not is_empty(_normalize_tel(vcf_data)) and not is_empty(_normalize_fn(vcf_data))
 
+async def _create_card(photo, detail: str, location: Optional[Location] = None,
+                       on_progress: Optional[Callable[[ProgressEvent], Awaitable[None]]] = None) -> Optional[str]:
     # Download the image file and save it to a temporary file
     with tempfile.NamedTemporaryFile(delete=True) as f:
         image_path = f.name
         await photo.download_to_drive(image_path)
-
-        # Process the image and generate the ICS file
-        await update.message.reply_chat_action(action=ChatAction.TYPING)
-        vcf_data = await call_agent(image_path, detail, location)
+        vcf_data = await call_agent(image_path, detail, location, on_progress)
+    if vcf_data:
         vcf_data = vcf_data.encode("utf7", "ignore").decode("utf7")
-        logger.debug(f"vcf_data: {vcf_data}")
+    logger.debug(f"vcf_data: {vcf_data}")
+    return vcf_data
+
+async def _handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE, photo, detail: str, location: Optional[Location] = None):
+    # Process the image and generate the ICS file, showing its progress in a single status message
+    status = await update.message.reply_text("Descargando la imagen...")
+
+    async def _on_progress(event: ProgressEvent):
+        if text := _progress_text(event):
+            await _edit_status(status, text)
+
+    vcf_data = await _create_card(photo, detail, location, _on_progress)
 
     # Send the card (file) to the user
-    if vcf_data:
-        phone_number = _normalize_tel(vcf_data)
-        first_name = _normalize_fn(vcf_data)
-        if is_empty(phone_number) or is_empty(first_name):
-            await update.message.reply_text("No se pudo generar la tarjeta.")
-        else:
-            await update.message.reply_contact(phone_number=phone_number, first_name=first_name, vcard=_normalize_vcf(vcf_data))
+    if _is_valid_card(vcf_data):
+        await _edit_status(status, "Tarjeta lista.")
+        await update.message.reply_contact(phone_number=_normalize_tel(vcf_data), first_name=_normalize_fn(vcf_data),
+                                           vcard=_normalize_vcf(vcf_data))
+    else:
+        await _edit_status(status, "No se pudo generar la tarjeta.")
+
+async def _handle_album(update: Update, context: ContextTypes.DEFAULT_TYPE, album_key, location: Location,
+                        message_id: Optional[int] = None):
+    # given the message of the photo that started it, the album is only handled when no earlier photo was received
+    # (by another replica), which handles it then
+    photos = await album_buffer.collect(album_key, message_id)
+    if not photos:
+        return
+    logger.info(f"Handling album of {len(photos)} photos ...")
+    status = await update.message.reply_text(f"Creando las tarjetas de {len(photos)} imágenes...")
+    done = 0
+
+    async def _on_card():
+        nonlocal done
+        done += 1
+        await _edit_status(status, f"Tarjetas creadas: {done} de {len(photos)}...")
+
+    # the images are sent in a single request (their places reverse geocoded together), processed concurrently,
+    # and all the cards sent in a single reply
+    with ExitStack() as stack:
+        files = [stack.enter_context(tempfile.NamedTemporaryFile(delete=True)) for _ in photos]
+        telegram_files = await asyncio.gather(*[context.bot.get_file(file_id) for file_id, _ in photos])
+        await asyncio.gather(*[file.download_to_drive(f.name) for file, f in zip(telegram_files, files)])
+        vcfs = await call_agent_album([f.name for f in files], [detail for _, detail in photos], location, _on_card)
+    vcfs = [vcf.encode("utf7", "ignore").decode("utf7") if vcf else vcf for vcf in vcfs]
+    cards = [vcf for vcf in vcfs if _is_valid_card(vcf)]
+
+    if not cards:
+        await _edit_status(status, "No se pudo generar la tarjeta.")
+    elif len(cards) == 1:
+        await update.message.reply_contact(phone_number=_normalize_tel(cards[0]), first_name=_normalize_fn(cards[0]),
+                                           vcard=_normalize_vcf(cards[0]))
     else:
-        await update.message.reply_text("No se pudo generar la tarjeta.")
+        names = "\n".join(f"- {_normalize_fn(card)}" for card in cards)
+        document = BytesIO("\n".join(_normalize_vcf(card) for card in cards).encode("utf-8"))
+        await update.message.reply_document(document=document, filename="contactos.vcf",
+                                            caption=f"{len(cards)} tarjetas de {len(photos)} imágenes:\n{names}")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
@@ -194,36 +362,52 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         await context.bot.send_message(chat_id=dev_chat_id, text=message, parse_mode=ParseMode.HTML)
 
 
+async def _close_state_store(app) -> None:
+    state_store.close()
+
+
 async def cancel(update, context):
     """Cancel the current operation and end the conversation"""
     update.message.reply_text("Introduce /start para comenzar de nuevo.")
     return ConversationHandler.END
 
 
-def main():
-    # Set up the Telegram bot
-    app = ApplicationBuilder().token(settings.TELEGRAM_TOKEN).build()
-
-    # Set up the message handler for images
-    # app.add_handler(MessageHandler(filters.PHOTO, handle_image_compressed))
-    # app.add_handler(MessageHandler(filters.Document.IMAGE, handle_image))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo_command))
-    # app.add_handler(CommandHandler("help", help_command))
-
-        # Add conversation handler with the states GENDER, PHOTO, LOCATION and BIO
-    conv_handler = ConversationHandler(
+def build_conversation_handler() -> ConversationHandler:
+    return SharedConversationHandler(
+        name="card",
+        store=state_store,
+        ttl=settings.BOT_CONVERSATION_TTL,
         entry_points=[CommandHandler("start", start)],
         states={
             # GENDER: [MessageHandler(filters.Regex("^(Boy|Girl|Other)$"), gender)],
             PHOTO: [MessageHandler(filters.PHOTO | filters.Document.IMAGE, photo)],
             # PHOTO: [MessageHandler(filters.ALL, photo)],
-            NO_GPS: [MessageHandler(filters.LOCATION, location)],
+            NO_GPS: [
+                MessageHandler(filters.LOCATION, location),
+                # rest of the album whose first photo asked for the location, or a new photo (or album) replacing
+                # the one waiting for it, e.g. abandoned
+                MessageHandler(filters.PHOTO | filters.Document.IMAGE, photo),
+            ],
             # BIO: [MessageHandler(filters.TEXT & ~filters.COMMAND, bio)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
 
-    app.add_handler(conv_handler)
+
+def main():
+    # Set up the Telegram bot
+    # chats are served concurrently, the updates of each chat in order (the conversation states depend on it)
+    update_processor = ChatOrderedUpdateProcessor(settings.TELEGRAM_CONCURRENT_UPDATES)
+    app = (ApplicationBuilder().token(settings.TELEGRAM_TOKEN).concurrent_updates(update_processor)
+           .post_shutdown(_close_state_store).build())
+
+    # Set up the message handler for images
+    # app.add_handler(MessageHandler(filters.PHOTO, handle_image_compressed))
+    # app.add_handler(MessageHandler(filters.Document.IMAGE, handle_image))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo_command))
+    # app.add_handler(CommandHandler("help", help_command))
+
+    app.add_handler(build_conversation_handler())
 
     app.add_error_handler(error_handler)
 
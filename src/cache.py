@@ -0,0 +1,426 @@
+import json
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cache
+from queue import Empty, LifoQueue
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from loguru import logger
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    sets: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    # reads and writes that failed (e.g. the cache server is down)
+    errors: int = 0
+    entries: int = 0
+    size_bytes: int = 0
+
+
+class Cache(ABC):
+    """
+    Cache of JSON values, each one expiring after its `ttl` in seconds (never when None).
+
+    Values are stored as JSON, so callers get their own copy of them. Unlike pickle, reading an entry written by
+    anyone with access to a shared cache (SQLite file, Redis) can not run code; entries that are not valid JSON are
+    misses.
+    """
+
+    def __init__(self):
+        self._stats = CacheStats()
+        self._stats_lock = threading.Lock()
+
+    @abstractmethod
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Values of the keys found; missing and expired keys are left out.
+        """
+
+    @abstractmethod
+    def set_many(self, items: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.get_many([key]).get(key)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self.set_many({key: value}, ttl)
+
+    def get_or_set(self, key: str, fn: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        """
+        Cached value of the key, calling `fn` on a miss. Empty values (no result) are not cached.
+
+        The cache is optional: a failed read (e.g. the cache server is down, or replies garbage) is logged and counted
+        as a miss, and a failed write is logged; neither is raised to the caller.
+        """
+        try:
+            value = self.get(key)
+        except Exception as e:
+            logger.warning(f"Error reading cache entry {key}, counted as a miss: {e!r}")
+            self._count(misses=1, errors=1)
+            value = None
+        if value is None:
+            value = fn()
+            if value:
+                try:
+                    self.set(key, value, ttl)
+                except Exception as e:
+                    logger.warning(f"Error writing cache entry {key}: {e!r}")
+                    self._count(errors=1)
+        return value
+
+    def stats(self) -> CacheStats:
+        with self._stats_lock:
+            return CacheStats(**vars(self._stats))
+
+    def _count(self, **counts: int) -> None:
+        with self._stats_lock:
+            for name, value in counts.items():
+                setattr(self._stats, name, getattr(self._stats, name) + value)
+
+    @staticmethod
+    def _encode(value: Any) -> bytes:
+        return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+    @staticmethod
+    def _decode(blobs: Dict[str, bytes]) -> Dict[str, Any]:
+        values = {}
+        for key, blob in blobs.items():
+            try:
+                values[key] = json.loads(blob)
+            except ValueError:
+                logger.warning(f"Cache entry {key} is not valid JSON, ignored")
+        return values
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryCache(Cache):
+    """
+    Process local LRU cache, evicting the least recently used entries over `max_bytes` (JSON size).
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        super().__init__()
+        self._max_bytes = max_bytes
+        # key -> (JSON value, expiry time)
+        self._entries: OrderedDict[str, Tuple[bytes, Optional[float]]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        found: Dict[str, bytes] = {}
+        misses = expirations = 0
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] is not None and entry[1] <= now:
+                    self._remove(key)
+                    expirations += 1
+                    entry = None
+                if entry is None:
+                    misses += 1
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[0]
+        values = self._decode(found)
+        self._count(hits=len(values), misses=misses + len(found) - len(values), expirations=expirations)
+        return values
+
+    def set_many(self, items: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        blobs = {key: self._encode(value) for key, value in items.items()}
+        evictions = 0
+        with self._lock:
+            for key, blob in blobs.items():
+                self._remove(key)
+                self._entries[key] = (blob, expires_at)
+                self._size += len(blob)
+            while self._size > self._max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                evictions += 1
+        self._count(sets=len(blobs), evictions=evictions)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+
+    def stats(self) -> CacheStats:
+        stats = super().stats()
+        with self._lock:
+            stats.entries, stats.size_bytes = len(self._entries), self._size
+        return stats
+
+
+class SQLiteCache(Cache):
+    """
+    Cache in a SQLite database, shared by the processes (e.g. uvicorn workers) of a host, evicting the least
+    recently used entries over `max_bytes`. Hits, misses and evictions are counted per process.
+
+    The size of the cache is not summed on every write: each process adds the size it writes to the size last summed,
+    and sums it again (evicting the excess) once that estimate is over `max_bytes`, or every `EVICT_EVERY` writes so
+    the writes of the other processes are accounted for.
+    """
+
+    EVICT_EVERY = 100
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        super().__init__()
+        self._path = path
+        self._max_bytes = max_bytes
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                               "size INTEGER NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+            # size last summed plus the size written since (replaced entries are counted twice), and writes since
+            self._size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self._writes = 0
+        self._size_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = sqlite3.connect(self._path, timeout=10)
+        return self._local.connection
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        now = time.time()
+        connection = self._connection()
+        placeholders = ",".join("?" * len(keys))
+        rows = connection.execute(f"SELECT key, value, expires_at FROM cache WHERE key IN ({placeholders})",
+                                  keys).fetchall()
+        found = {key: value for key, value, expires_at in rows if expires_at is None or expires_at > now}
+        expired = [key for key, _, expires_at in rows if key not in found]
+        with connection:
+            if found:
+                connection.execute(f"UPDATE cache SET accessed_at = ? WHERE key IN ({','.join('?' * len(found))})",
+                                   [now, *found])
+            if expired:
+                connection.execute(f"DELETE FROM cache WHERE key IN ({','.join('?' * len(expired))})", expired)
+        values = self._decode(found)
+        self._count(hits=len(values), misses=len(keys) - len(values), expirations=len(expired))
+        return values
+
+    def set_many(self, items: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        rows = [(key, blob, len(blob), expires_at, now) for key, blob in
+                ((key, self._encode(value)) for key, value in items.items())]
+        connection = self._connection()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)", rows)
+            evictions = self._evict(connection, now, sum(size for _, _, size, _, _ in rows), len(rows))
+        self._count(sets=len(rows), evictions=evictions)
+
+    def _evict(self, connection: sqlite3.Connection, now: float, written: int, writes: int) -> int:
+        with self._size_lock:
+            self._size += written
+            self._writes += writes
+            if self._size <= self._max_bytes and self._writes < self.EVICT_EVERY:
+                return 0
+            self._writes = 0
+        connection.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        excess = size - self._max_bytes
+        evicted: List[str] = []
+        if excess > 0:
+            for key, entry_size in connection.execute("SELECT key, size FROM cache ORDER BY accessed_at"):
+                evicted.append(key)
+                size -= entry_size
+                if size <= self._max_bytes:
+                    break
+            connection.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key in evicted])
+        with self._size_lock:
+            self._size = size
+        return len(evicted)
+
+    def delete(self, key: str) -> None:
+        with self._connection() as connection:
+            connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def stats(self) -> CacheStats:
+        stats = super().stats()
+        stats.entries, stats.size_bytes = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        return stats
+
+
+class RemoteCacheError(Exception):
+    pass
+
+
+class _RespConnection:
+    """
+    Connection speaking the Redis serialization protocol (RESP2), with pipelining.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self._sock = socket.create_connection((host, port), timeout)
+        self._reader = self._sock.makefile("rb")
+
+    @staticmethod
+    def _encode(command: Tuple) -> bytes:
+        parts = [part if isinstance(part, bytes) else str(part).encode() for part in command]
+        return b"".join([b"*%d\r\n" % len(parts)] + [b"$%d\r\n%s\r\n" % (len(part), part) for part in parts])
+
+    def execute(self, *commands: Tuple) -> List[Any]:
+        self._sock.sendall(b"".join(self._encode(command) for command in commands))
+        replies = [self._read() for _ in commands]
+        errors = [reply for reply in replies if isinstance(reply, RemoteCacheError)]
+        if errors:
+            raise errors[0]
+        return replies
+
+    def _read(self) -> Any:
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the cache server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            return RemoteCacheError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            return None if length == -1 else self._reader.read(length + 2)[:-2]
+        if kind == b"*":
+            length = int(payload)
+            return None if length == -1 else [self._read() for _ in range(length)]
+        raise RemoteCacheError(f"Unexpected reply from the cache server: {line!r}")
+
+    def close(self) -> None:
+        self._reader.close()
+        self._sock.close()
+
+
+class RemoteCache(Cache):
+    """
+    Cache in a Redis compatible server, shared by every process and host. Entries, size and evictions are the
+    server's (`DBSIZE`, `INFO`), hits and misses are counted per process.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0, password: Optional[str] = None,
+                 timeout: float = 2.0):
+        super().__init__()
+        self._address = (host, port)
+        self._db = db
+        self._password = password
+        self._timeout = timeout
+        self._pool: LifoQueue[_RespConnection] = LifoQueue()
+
+    def _execute(self, *commands: Tuple) -> List[Any]:
+        try:
+            connection = self._pool.get_nowait()
+        except Empty:
+            connection = _RespConnection(*self._address, self._timeout)
+            setup = ([("AUTH", self._password)] if self._password else []) + ([("SELECT", self._db)] if self._db else [])
+            if setup:
+                connection.execute(*setup)
+        try:
+            replies = connection.execute(*commands)
+        except Exception:
+            # the connection may have unread replies
+            connection.close()
+            raise
+        self._pool.put(connection)
+        return replies
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self._execute(("MGET", *keys))[0]
+        found = self._decode({key: value for key, value in zip(keys, values) if value is not None})
+        self._count(hits=len(found), misses=len(keys) - len(found))
+        return found
+
+    def set_many(self, items: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        expiry = ("PX", int(ttl * 1000)) if ttl else ()
+        if items:
+            self._execute(*[("SET", key, self._encode(value), *expiry) for key, value in items.items()])
+        self._count(sets=len(items))
+
+    def delete(self, key: str) -> None:
+        self._execute(("DEL", key))
+
+    def stats(self) -> CacheStats:
+        stats = super().stats()
+        entries, info = self._execute(("DBSIZE",), ("INFO",))
+        fields = dict(line.split(":", 1) for line in info.decode().splitlines() if ":" in line)
+        stats.entries = entries
+        stats.size_bytes = int(fields.get("used_memory", 0))
+        stats.evictions = int(fields.get("evicted_keys", 0))
+        stats.expirations = int(fields.get("expired_keys", 0))
+        return stats
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                return
+
+
+def create_cache(url: Optional[str]) -> Optional[Cache]:
+    """
+    Creates the cache of an URL: "memory://?max_bytes=N", "sqlite:///relative/cache.db?max_bytes=N" (as in
+    SQLAlchemy, "sqlite:////absolute/cache.db" for an absolute path) or "redis://[:password@]host[:port][/db]". No cache
+    when the URL is empty.
+    """
+    if not url:
+        return None
+    parsed = urlparse(url)
+    options = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+    max_bytes = {"max_bytes": int(options["max_bytes"])} if "max_bytes" in options else {}
+    match parsed.scheme:
+        case "memory":
+            return MemoryCache(**max_bytes)
+        case "sqlite":
+            # the path follows the third slash: "/absolute" (four slashes) or "relative" (three)
+            if parsed.netloc or len(parsed.path) < 2:
+                raise ValueError(f"Unsupported cache URL: {url}, expected sqlite:///relative or sqlite:////absolute")
+            return SQLiteCache(parsed.path[1:], **max_bytes)
+        case "redis":
+            return RemoteCache(parsed.hostname or "localhost", parsed.port or 6379, int(parsed.path[1:] or 0),
+                               parsed.password)
+        case _:
+            raise ValueError(f"Unsupported cache URL: {url}")
+
+
+@cache
+def get_cache(url: Optional[str]) -> Optional[Cache]:
+    """
+    Cache of the URL shared by every caching layer of the process.
+    """
+    cache = create_cache(url)
+    if cache:
+        logger.info(f"Using {type(cache).__name__} cache")
+    return cache
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Iterator, Optional, TypeVar
+
+from src.metrics import metrics
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """
+    Point in time by which a request must be answered.
+
+    The deadline is bound to the current context with `deadline`, so every stage and upstream call made on behalf of
+    the request (including langchain runnables executed in a thread pool) can bound its work by `remaining_time`.
+    """
+
+    def __init__(self, timeout: float):
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() == 0
+
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar("deadline", default=None)
+
+
+@contextmanager
+def deadline(timeout: Optional[float]) -> Iterator[Optional[Deadline]]:
+    """
+    Binds a deadline `timeout` seconds away to the enclosed block; an earlier deadline already bound is kept.
+    """
+    current = _current_deadline.get()
+    if timeout is None or (current is not None and current.remaining() <= timeout):
+        yield current
+        return
+    token = _current_deadline.set(Deadline(timeout))
+    try:
+        yield _current_deadline.get()
+    finally:
+        _current_deadline.reset(token)
+
+
+def remaining_time(reserve: float = 0) -> Optional[float]:
+    """
+    Seconds left until the current deadline, less `reserve` seconds kept for later stages; None without deadline.
+    """
+    current = _current_deadline.get()
+    if current is None:
+        return None
+    return max(0.0, current.remaining() - reserve)
+
+
+async def within_deadline(awaitable: Awaitable[T], stage: str, reserve: float = 0) -> T:
+    """
+    Awaits the stage, cancelling it when the current deadline (less `reserve` seconds) expires. The stage is bound to
+    that earlier deadline, so its upstream calls bounded by `remaining_time` time out with it, also those made in
+    threads (which are not cancelled).
+
+    Raises:
+        DeadlineExceeded: if the stage did not finish in time, counted as `deadline.{stage}.exceeded`.
+    """
+    remaining = remaining_time(reserve)
+    if remaining is None:
+        return await awaitable
+    try:
+        with deadline(remaining):
+            return await asyncio.wait_for(awaitable, remaining)
+    except asyncio.TimeoutError:
+        metrics.increment(f"deadline.{stage}.exceeded")
+        raise DeadlineExceeded(f"The {stage} stage did not finish before the deadline") from None
@@ -0,0 +1,92 @@
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Deque, Iterator, Optional, Sequence, Tuple
+
+
+class DegradationLevel(IntEnum):
+    """
+    Pipeline levels, each one cheaper than the previous (and including its savings).
+    """
+    FULL = 0
+    # the place found is not completed with its details (`search_by_place_id`)
+    NO_PLACE_DETAILS = 1
+    # the card is created from the vision transcription alone
+    NO_PLACES = 2
+    # only the low detail vision call, even when "high" or "adaptive" detail is requested
+    LOW_DETAIL = 3
+
+    @property
+    def label(self) -> str:
+        return self.name.lower()
+
+
+class LoadMonitor:
+    """
+    Live load of the card pipeline, picking the degradation level for new cards: a level is entered when the cards
+    in flight reach its `queue_depths` threshold, or the 90th percentile of the durations (seconds) of the cards
+    finished in the last `window` seconds its `latencies` threshold. Thresholds are given in ascending order, for
+    the levels after `FULL`; no thresholds, no degradation.
+
+    Durations older than the window are dropped, so the level recovers once the slow cards are past (even when no
+    new card finishes), and at most `max_samples` are kept.
+
+    Open circuit breakers are not a signal: no upstream call goes through a breaker. A failing upstream is bounded by
+    the request deadline instead (the card falls back to the transcription, see `src.deadline`), whose slower cards
+    raise the latency signal.
+    """
+
+    def __init__(self, queue_depths: Sequence[int] = (), latencies: Sequence[float] = (), window: float = 60,
+                 max_samples: int = 1000):
+        self._queue_depths = list(queue_depths)[:len(DegradationLevel) - 1]
+        self._latencies = list(latencies)[:len(DegradationLevel) - 1]
+        self._window = window
+        # (monotonic time the card finished, duration)
+        self._durations: Deque[Tuple[float, float]] = deque(maxlen=max_samples)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _prune(self, now: float) -> None:
+        while self._durations and self._durations[0][0] <= now - self._window:
+            self._durations.popleft()
+
+    def _observe(self, duration: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._durations.append((now, duration))
+            self._prune(now)
+
+    def latency(self, percentile: float = 90) -> Optional[float]:
+        with self._lock:
+            self._prune(time.monotonic())
+            if not self._durations:
+                return None
+            ordered = sorted(duration for _, duration in self._durations)
+        return ordered[min(len(ordered) - 1, math.ceil(percentile / 100 * len(ordered)) - 1)]
+
+    def level(self) -> DegradationLevel:
+        latency = self.latency() or 0
+        return DegradationLevel(max(sum(self._in_flight >= depth for depth in self._queue_depths),
+                                    sum(latency >= threshold for threshold in self._latencies)))
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """
+        Counts the enclosed card as in flight, and observes its duration.
+        """
+        with self._lock:
+            self._in_flight += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._observe(time.perf_counter() - start)
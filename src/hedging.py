@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Deque, Optional, TypeVar
+
+from src.metrics import metrics
+
+T = TypeVar("T")
+
+
+class Hedger:
+    """
+    Hedged requests to an upstream: when a call has not finished after a delay, an identical one is sent and the
+    first to succeed is kept, the other cancelled. Only for idempotent calls.
+
+    The delay is `delay` seconds, or the `percentile` of the latencies of the first calls (no hedging until
+    `min_samples` are observed). When a hedge wins, the latency observed is the time the first call had been running,
+    a lower bound of its own, so the winning hedges keep the delay from dropping. Hedges are paid from a budget earning
+    `budget` hedges per call (up to `burst`), so they never add more than that fraction of extra calls; a zero budget
+    disables hedging.
+
+    Counts `hedge.{name}.sent`, `hedge.{name}.won` (the hedge finished first) and `hedge.{name}.over_budget`.
+    """
+
+    def __init__(self, name: str, budget: float = 0.0, delay: Optional[float] = None, percentile: float = 90,
+                 min_samples: int = 20, window: int = 200, burst: float = 10):
+        self.name = name
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._min_samples = min_samples
+        self._burst = burst
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self.configure(budget, delay, percentile)
+
+    def configure(self, budget: float, delay: Optional[float] = None, percentile: float = 90) -> None:
+        self._budget = budget
+        self._delay = delay
+        self._percentile = percentile
+
+    def delay(self) -> Optional[float]:
+        """
+        Seconds after which a call is hedged, None when it is not (no budget, or too few latencies observed).
+        """
+        if self._budget <= 0:
+            return None
+        if self._delay is not None:
+            return self._delay
+        with self._lock:
+            if len(self._latencies) < self._min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(self._percentile / 100 * len(ordered)) - 1)]
+
+    def _earn(self) -> None:
+        with self._lock:
+            self._tokens = min(self._burst, self._tokens + self._budget)
+
+    def _spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                metrics.increment(f"hedge.{self.name}.over_budget")
+                return False
+            self._tokens -= 1
+        metrics.increment(f"hedge.{self.name}.sent")
+        return True
+
+    def _observe(self, start: float) -> None:
+        with self._lock:
+            self._latencies.append(time.perf_counter() - start)
+
+    async def run(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Awaits `fn()`, hedged with a second `fn()` when the first is slow.
+        """
+        delay = self.delay()
+        self._earn()
+        start = time.perf_counter()
+        if delay is None:
+            result = await fn()
+            self._observe(start)
+            return result
+
+        primary = asyncio.ensure_future(fn())
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self._spend():
+                result = await primary
+                self._observe(start)
+                return result
+            tasks.append(asyncio.ensure_future(fn()))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            metrics.increment(f"hedge.{self.name}.won")
+                        self._observe(start)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _submit(self, fn: Callable[..., T], *args) -> Future:
+        if self._pool is None:
+            with self._lock:
+                self._pool = self._pool or ThreadPoolExecutor(32, thread_name_prefix=f"hedge-{self.name}")
+        # run in the caller context, e.g. with its request deadline and timings
+        return self._pool.submit(contextvars.copy_context().run, fn, *args)
+
+    def call(self, fn: Callable[..., T], *args) -> T:
+        """
+        Calls `fn(*args)` (blocking), hedged with a second call when the first is slow. Both calls run in a thread
+        pool; the slower one can not be interrupted, its result is discarded.
+        """
+        delay = self.delay()
+        self._earn()
+        start = time.perf_counter()
+        if delay is None:
+            result = fn(*args)
+            self._observe(start)
+            return result
+
+        primary = self._submit(fn, *args)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._spend():
+            result = primary.result()
+            self._observe(start)
+            return result
+        pending, error = {primary, self._submit(fn, *args)}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        metrics.increment(f"hedge.{self.name}.won")
+                    self._observe(start)
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = error or future.exception()
+        raise error
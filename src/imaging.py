@@ -0,0 +1,156 @@
+import asyncio
+import binascii
+import math
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from fractions import Fraction
+from functools import cache, partial
+from typing import Any, BinaryIO, Callable, Literal, Optional, Tuple, Union
+
+import piexif
+from loguru import logger
+from PIL import Image
+
+MIME_TYPES = {"jpeg": "image/jpeg", "jpg": "image/jpeg", "png": "image/png"}
+# bytes of the file base64 encoded at a time, a multiple of 3 so the chunks need no padding
+ENCODE_CHUNK_SIZE = 3 * 64 * 1024
+
+
+@dataclass
+class EncodedImage:
+    url: str
+    size: Tuple[int, int]
+
+
+def encode_image(image_path: str) -> EncodedImage:
+    """
+    Base64 data URL of an image file for the vision prompt. CPU-bound, meant to run with `ImageExecutor.encode`.
+
+    The file is encoded in chunks into a buffer sized for the whole URL, which is decoded once into the URL string:
+    the peak memory is about twice the URL, with no copy of the file nor of the base64 bytes.
+
+    Raises:
+        ValueError: if the image is neither JPEG nor PNG.
+    """
+    with Image.open(image_path) as img:
+        format, size = img.format.lower(), img.size
+    if format not in MIME_TYPES:
+        raise ValueError(f"Unsupported image format: {format}")
+
+    prefix = f"data:{MIME_TYPES[format]};base64,".encode("ascii")
+    url = bytearray(len(prefix) + 4 * math.ceil(os.path.getsize(image_path) / 3))
+    url[:len(prefix)] = prefix
+    position = len(prefix)
+    chunk = bytearray(ENCODE_CHUNK_SIZE)
+    with open(image_path, "rb") as image_file:
+        # buffered reads fill the chunk unless at the end of the file
+        while read := image_file.readinto(chunk):
+            encoded = binascii.b2a_base64(memoryview(chunk)[:read], newline=False)
+            url[position:position + len(encoded)] = encoded
+            position += len(encoded)
+    del url[position:]
+    return EncodedImage(url=url.decode("ascii"), size=size)
+
+
+class EXIFHelper:
+    @classmethod
+    def _convert_to_degrees(cls, value: Union[int, float, Tuple[int, int], Tuple[float, float]]) -> float:
+        if isinstance(value[0], (int, float)):
+            d = Fraction(value[0])
+        else:
+            d = Fraction(value[0][0], value[0][1])
+
+        if isinstance(value[1], (int, float)):
+            m = Fraction(value[1])
+        else:
+            m = Fraction(value[1][0], value[1][1])
+
+        if isinstance(value[2], (int, float)):
+            s = Fraction(value[2])
+        else:
+            s = Fraction(value[2][0], value[2][1])
+
+        return float(d + (m / 60) + (s / 3600))
+
+    @classmethod
+    def extract_coordinates(cls, img: Image.Image) -> Tuple[Optional[float], Optional[float]]:
+        """
+        Extracts the latitude and longitude coordinates from the EXIF data of an image.
+
+        Args:
+            img (PIL.Image.Image): The image from which to extract the coordinates.
+
+        Returns:
+            Tuple[Optional[float], Optional[float]]: A tuple containing the latitude and longitude coordinates.
+                Returns (None, None) if the image does not have EXIF data or if the coordinates are not found.
+        """
+
+        img_exif = img.info.get("exif")  # img.getexif()
+        if not img_exif:
+            return None, None
+        exif = piexif.load(img_exif)
+        exif_gps = exif.get("GPS")
+        if not exif_gps:
+            return None, None
+
+        latitude = cls._convert_to_degrees(exif_gps[piexif.GPSIFD.GPSLatitude])
+        longitude = cls._convert_to_degrees(exif_gps[piexif.GPSIFD.GPSLongitude])
+        if exif_gps[piexif.GPSIFD.GPSLatitudeRef] == "S":
+            latitude = -latitude
+        if exif_gps[piexif.GPSIFD.GPSLongitudeRef] == "W":
+            longitude = -longitude
+        return (latitude, longitude)
+
+
+def read_coordinates(image_path: Union[str, BinaryIO]) -> Tuple[Optional[float], Optional[float]]:
+    """
+    EXIF (latitude, longitude) of an image file (path or file object), (None, None) when missing.
+    """
+    with Image.open(image_path) as img:
+        return EXIFHelper.extract_coordinates(img)
+
+
+class ImageExecutor:
+    """
+    Runs the CPU-bound image work (decoding, EXIF parsing, base64 encoding) off the event loop, in a pool of
+    `workers` processes or threads. Tasks get the path of the image file rather than its bytes, so the image is
+    not copied into the worker processes.
+
+    The base64 encoding always runs in a thread (see `encode`): its result is the multi-MB data URL, which a worker
+    process would pickle back through a pipe, adding copies of it to the API process.
+    """
+
+    def __init__(self, kind: Literal["process", "thread"] = "process", workers: Optional[int] = None):
+        self.kind = kind
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        if kind == "process":
+            # spawned rather than forked, the API process runs threads (uvicorn, the places lookups)
+            self._executor: Executor = ProcessPoolExecutor(self.workers, multiprocessing.get_context("spawn"))
+        else:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="image")
+        self._threads = self._executor if kind == "thread" else ThreadPoolExecutor(self.workers,
+                                                                                   thread_name_prefix="encode")
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(fn, *args, **kwargs))
+
+    async def encode(self, image_path: str) -> EncodedImage:
+        """
+        Data URL of an image file, see `encode_image`. Encoded in chunks, so the event loop gets the GIL between
+        them.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._threads, encode_image, image_path)
+
+    async def warmup(self) -> None:
+        """
+        Starts the workers, so the first images do not pay for the process start-up.
+        """
+        await asyncio.gather(*[self.run(os.getpid) for _ in range(self.workers)])
+        logger.info(f"Image executor ready with {self.workers} {self.kind} workers")
+
+
+@cache
+def get_image_executor(kind: Literal["process", "thread"] = "process", workers: Optional[int] = None) -> ImageExecutor:
+    return ImageExecutor(kind, workers)
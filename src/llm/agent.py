@@ -1,35 +1,74 @@
-import base64
+import asyncio
 import json
+import math
+import time
 from functools import cache
-from typing import Literal, Optional, Protocol
+from typing import Dict, List, Literal, Optional, Protocol
 
+import httpx
 import randomname
 from langchain_core.messages import HumanMessage
-from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
+from langchain_core.exceptions import OutputParserException
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
 from langchain_openai import AzureChatOpenAI
 from loguru import logger
-from PIL import Image
-from langchain_core.runnables import RunnablePassthrough, RunnableParallel, RunnableLambda, RunnableSequence, Runnable
+from langchain_core.runnables import RunnablePassthrough, RunnableParallel, RunnableLambda, RunnableSequence, Runnable, RunnableConfig
 import src.llm.prompt as prompt
+from src.accounting import track_usage
+from src.deadline import DeadlineExceeded, deadline, within_deadline
+from src.degradation import DegradationLevel, LoadMonitor
+from src.hedging import Hedger
+from src.imaging import get_image_executor
+from src.llm.callbacks import UsageCallbackHandler
+from src.llm.connections import ConnectionStats, create_http_client, keep_warm
 from src.llm.places import PlacesTool
+from src.llm.schemas import ContactCard, VisionTranscription
+from src.metrics import metrics
+from src.progress import PLACE, TRANSCRIBED, report_progress
 from src.settings import Settings
+from src.timing import track_stage
 
 class ImageEncoder:
     @staticmethod
-    def encode(image_path: str) -> tuple[str, str]:
-        format = Image.open(image_path).format.lower()
-        match format:
-            case "jpg" | "jpeg":
-                mime_type = "image/jpeg"
-            case "png":
-                mime_type = "image/png"
-            case _:
-                raise ValueError(f"Unsupported image format: {format}")
-
-        with open(image_path, "rb") as image_file:
-            encoded = base64.b64encode(image_file.read()).decode("utf-8")
-        return encoded, mime_type
+    def vision_tokens(size: tuple[int, int], detail: str) -> int:
+        """
+        Prompt tokens billed for an image, following the OpenAI vision pricing rules: "low" detail costs a flat
+        85 tokens, "high" detail adds 170 tokens per 512px tile once the image is scaled to fit 2048x2048 and
+        its shortest side to 768px.
+        """
+        if detail == "low":
+            return 85
+        width, height = size
+        scale = min(1, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1, 768 / min(width, height))
+        width, height = width * scale, height * scale
+        return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def timed(stage: str, runnable: Runnable) -> Runnable:
+    async def _ainvoke(inputs: dict, config: RunnableConfig):
+        with track_stage(stage):
+            return await runnable.ainvoke(inputs, config)
+
+    return RunnableLambda(_ainvoke, name=stage)
+
+def hedged(hedger: Hedger, runnable: Runnable) -> Runnable:
+    """
+    Hedges the (idempotent) runnable calls, see `Hedger`.
+    """
+    async def _ainvoke(inputs: dict, config: RunnableConfig):
+        return await hedger.run(lambda: runnable.ainvoke(inputs, config))
+
+    return RunnableLambda(_ainvoke, name=hedger.name)
+
+def bounded(stage: str, runnable: Runnable, reserve: float = 0) -> Runnable:
+    """
+    Cancels the runnable when the request deadline (less `reserve` seconds) expires, see `within_deadline`.
+    """
+    async def _ainvoke(inputs: dict, config: RunnableConfig):
+        return await within_deadline(runnable.ainvoke(inputs, config), stage, reserve)
+
+    return RunnableLambda(_ainvoke, name=stage)
 
 class LLMChain(Protocol):
     async def ainvoke(self, inputs: dict, config: Optional[dict] = None) -> str:
@@ -49,12 +88,13 @@ class ImageTranscriptionChain:
                 HumanMessage(
                     content=[
                         {"type": "text", "text": prompt.VISION_TOOL},
-                        {"type": "image_url", "image_url": {"url": f"data:{data_dict['format']};base64,{data_dict['image']}", 
+                        # the data URL is built by `encode_image`, it is not copied here
+                        {"type": "image_url", "image_url": {"url": data_dict['image_url'],
                                                             "detail": data_dict['detail']}},
                     ],
                 )
             ]
-        return _prompt_generator | llm | JsonOutputParser()
+        return _prompt_generator | llm.with_structured_output(VisionTranscription)
 
 class VcfGeneratorChain:
     def __init__(self, llm: AzureChatOpenAI):
@@ -70,14 +110,74 @@ class VcfGeneratorChain:
             ("ai", "JSON:\n{vision_transcription}"),
             ("human", prompt.AGENT_TOOL),
         ])
-        return card_prompt | llm | StrOutputParser()
+        return card_prompt | llm.with_structured_output(ContactCard)
 
 class ToolFactory:
-    def __init__(self, settings: Settings):
-        llm = self._create_llm(settings)
-        self._vision_chain = ImageTranscriptionChain(llm)
-        self._agent_chain = VcfGeneratorChain(llm)
+    def __init__(self, settings: Settings, http_client: Optional[httpx.AsyncClient] = None):
+        """
+        Args:
+            http_client: async HTTP client of the Azure OpenAI calls, shared by the deployments; created from the
+                `AZURE_OPENAI_*` pool settings when not given, its connections reported as `http.azure_openai.*`
+                and kept warm (see `keep_warm`). A client given is left as is: its owner can add the
+                `connections.on_request` hook, and keep it warm.
+        """
+        self._connections = ConnectionStats("azure_openai")
+        self._http_client = http_client or create_http_client(
+            self._connections,
+            max_connections=settings.AZURE_OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.AZURE_OPENAI_KEEPALIVE_EXPIRY,
+            http2=settings.AZURE_OPENAI_HTTP2,
+        )
+        self._connect_timeout = settings.AZURE_OPENAI_CONNECT_TIMEOUT
+        # the requests of a client given are not seen, so it would be pinged while busy
+        self._keep_warm_interval = settings.AZURE_OPENAI_KEEP_WARM_INTERVAL if http_client is None else 0
+        self._llms = {
+            "vision": self._create_llm(settings,
+                                       azure_deployment=settings.AZURE_OPENAI_DEPLOYMENT_VISION,
+                                       model_name=settings.AZURE_OPENAI_MODEL_VISION,
+                                       max_tokens=settings.AZURE_OPENAI_MAX_TOKENS_VISION,
+                                       timeout=settings.AZURE_OPENAI_TIMEOUT_VISION),
+            "agent": self._create_llm(settings,
+                                      azure_deployment=settings.AZURE_OPENAI_DEPLOYMENT_AGENT,
+                                      model_name=settings.AZURE_OPENAI_MODEL_AGENT,
+                                      max_tokens=settings.AZURE_OPENAI_MAX_TOKENS_AGENT,
+                                      timeout=settings.AZURE_OPENAI_TIMEOUT_AGENT),
+        }
+        # the image transcription needs a vision model, the (text only) card generation follows the routing policy
+        self._vision_chain = ImageTranscriptionChain(self._llms["vision"])
+        self._agent_chain = VcfGeneratorChain(self._llms[settings.CARD_GENERATION_ROUTE])
+        self._hedgers = {stage: Hedger(stage, settings.HEDGE_BUDGET, settings.HEDGE_DELAY, settings.HEDGE_PERCENTILE)
+                         for stage in ("vision_low", "vision_high", "card")}
         self._venue_processor = VenueProcessor(settings)
+        logger.info(f"Card generation routed to the {settings.CARD_GENERATION_ROUTE} deployment")
+
+    async def warmup(self, timeout: float = 10) -> None:
+        """
+        Opens the connections to Azure OpenAI (DNS, TLS) ahead of the first request, listing the models.
+        """
+        async def _warmup(route: str, llm: AzureChatOpenAI):
+            try:
+                await asyncio.wait_for(llm.root_async_client.models.list(), timeout)
+            except Exception as e:
+                logger.warning(f"Could not warm up the Azure OpenAI {route} connection: {e}")
+
+        await asyncio.gather(*[_warmup(route, llm) for route, llm in self._llms.items()])
+
+    async def keep_warm(self) -> None:
+        """
+        Keeps a connection to Azure OpenAI open during idle periods, see `keep_warm`. Runs until cancelled, returns
+        at once when disabled.
+        """
+        if not self._keep_warm_interval:
+            return
+        # the deployments share the client, hence its connections
+        client = self._llms["vision"].root_async_client
+        await keep_warm(self._connections, client.models.list, self._keep_warm_interval)
+
+    @property
+    def connections(self) -> ConnectionStats:
+        return self._connections
 
     def _get_settings_args(self, settings: Settings) -> dict:
         args = {
@@ -86,9 +186,10 @@ class ToolFactory:
             "azure_endpoint": settings.AZURE_OPENAI_API_BASE,
             "streaming": False,
             "metadata": {"container_app_name": settings.CONTAINER_APP_NAME},
+            "http_async_client": self._http_client,
+            # tokens of every call, hedges included, counted on the card usage
+            "callbacks": [UsageCallbackHandler()],
         }
-        if settings.LANGSMITH_TRACER:
-            args["callbacks"] = [settings.LANGSMITH_TRACER]
         return args
 
     def _create_llm(self, settings: Settings, *args, **kwargs) -> AzureChatOpenAI:
@@ -98,6 +199,9 @@ class ToolFactory:
             "max_tokens": 500,
         }
         common_client_args = self._get_settings_args(settings) | default_args | kwargs
+        # a failed connection setup is retried by the client well before the (long) read timeout
+        common_client_args["timeout"] = httpx.Timeout(common_client_args.get("timeout"),
+                                                      connect=self._connect_timeout)
 
         return AzureChatOpenAI(
             *args,
@@ -112,68 +216,206 @@ class ToolFactory:
     def card_generation(self) -> Runnable:
         return self._agent_chain.chain
 
+    @property
+    def hedgers(self) -> Dict[str, Hedger]:
+        return self._hedgers
+
     @property
     def venue_description(self) -> Runnable:
         return self._venue_processor
+
+    @property
+    def places(self) -> PlacesTool:
+        return self._venue_processor.places
     
 class CardAgent:
+    ADAPTIVE_DETAIL = "adaptive"
+
     def __init__(self, settings: Settings):
         self._tool_factory = ToolFactory(settings)
+        self._images = get_image_executor(settings.IMAGE_EXECUTOR, settings.IMAGE_WORKERS)
+        self._deadline = settings.REQUEST_DEADLINE
+        self._album_geocode_timeout = settings.GEOAPIFY_ALBUM_TIMEOUT
+        self._card_reserve = settings.CARD_GENERATION_RESERVE
+        self._load = LoadMonitor(settings.DEGRADATION_QUEUE_DEPTHS, settings.DEGRADATION_LATENCIES,
+                                 settings.DEGRADATION_WINDOW)
+        # attached to each card rather than to the clients, so a card is traced (or sampled out) as a whole
+        self._tracer = settings.LANGSMITH_TRACER
         self._chain = self._build_chain()
 
+    async def warmup(self) -> None:
+        await asyncio.gather(self._tool_factory.warmup(), self._images.warmup())
+
+    async def keep_warm(self) -> None:
+        await self._tool_factory.keep_warm()
+
+    @property
+    def connections(self) -> ConnectionStats:
+        return self._tool_factory.connections
+
     def _build_chain(self) -> RunnableSequence:
         return (
             {
-                "vision_transcription": self._tool_factory.image_transcription,
+                "vision_transcription": timed("vision", bounded("vision", RunnableLambda(self._transcribe),
+                                                                reserve=self._card_reserve)),
                 "args": RunnablePassthrough(),
             }
-            | self._tool_factory.venue_description
-            | self._tool_factory.card_generation
-            | self._vcf_parser
+            | timed("places", RunnableLambda(self._describe_venue))
+            | timed("card", bounded("card", hedged(self._tool_factory.hedgers["card"],
+                                                   self._tool_factory.card_generation)))
+            | self._render_card
         )
 
-    async def create_card(self, image_path: str, lat: float, lon: float, detail: str = "low") -> Optional[str]:
-        image, format = ImageEncoder.encode(image_path)
-        
+    def degradation_level(self) -> DegradationLevel:
+        """
+        Pipeline level for a new card given the current load, see `LoadMonitor`.
+        """
+        return self._load.level()
+
+    async def create_card(self, image_path: str, lat: float, lon: float, detail: str = "low",
+                          run_name: Optional[str] = None, place: Optional[dict] = None,
+                          timeout: Optional[float] = None, level: Optional[DegradationLevel] = None) -> Optional[str]:
+        """
+        Creates the vCard of the venue or business card in the image.
+
+        Args:
+            detail (str): vision detail, "low", "high" or "adaptive" (low detail first, escalating to high detail
+                only when the transcription has no usable venue or card fields).
+            place (dict): address of the coordinates when already known, e.g. reverse geocoded in bulk with
+                `PlacesTool.reverse_geocode_images`.
+            timeout (float): seconds to create the card, `REQUEST_DEADLINE` by default. Outstanding work is
+                cancelled when it expires, the places search early enough to create the card without it.
+            level (DegradationLevel): pipeline level, given by the current load (`degradation_level`) by default.
+
+        The upstream calls and tokens of the card are added to the `Usage` active in the caller context, if any
+        (see `src.accounting`).
+        """
+        level = self.degradation_level() if level is None else level
+        metrics.increment(f"degradation.{level.label}")
+        if level >= DegradationLevel.LOW_DETAIL:
+            detail = "low"
+        with deadline(timeout or self._deadline), self._load.track(), track_usage("card") as usage:
+            with track_stage("encode"):
+                encoded = await within_deadline(self._images.encode(image_path), "encode")
+            inputs = {"image_url": encoded.url, "size": encoded.size, "detail": detail, "lat": lat, "lon": lon,
+                      "place": place, "level": level}
+
+            try:
+                config: RunnableConfig = {"run_name": run_name or randomname.get_name()}
+                if self._tracer:
+                    config["callbacks"] = [self._tracer]
+                result = await self._chain.ainvoke(inputs, config=config)
+                return result
+            except Exception as e:
+                logger.exception(f"Error creating card: {e}")
+                return None
+            finally:
+                logger.bind(usage=usage.as_dict()).info(f"Card upstream usage: {usage.header()}")
+
+    async def reverse_geocode_images(self, image_paths: List[str]) -> Dict[str, Optional[dict]]:
+        """
+        Addresses of the EXIF coordinates of many images (e.g. an album), reverse geocoded together with a Geoapify
+        batch job (see `PlacesTool.reverse_geocode_images`), to be passed as the `place` of their cards.
+
+        Waits at most `GEOAPIFY_ALBUM_TIMEOUT` seconds; on timeout or error, no address is returned and each card
+        reverse geocodes its own image.
+        """
+        if self.degradation_level() >= DegradationLevel.NO_PLACES:
+            return {}
+        with deadline(self._album_geocode_timeout), track_stage("geocode_batch"):
+            try:
+                # in a thread bound to the deadline, so the batch job polling stops with it
+                return await within_deadline(
+                    asyncio.to_thread(self._tool_factory.places.reverse_geocode_images, image_paths),
+                    "geocode_batch")
+            except Exception as e:
+                logger.warning(f"Could not reverse geocode the images in a batch: {e}")
+                return {}
+
+    async def _transcribe(self, inputs: dict, config: RunnableConfig):
+        if inputs["detail"] != self.ADAPTIVE_DETAIL:
+            return await self._transcribe_with_detail(inputs, inputs["detail"], config)
+
+        low_tokens = ImageEncoder.vision_tokens(inputs["size"], "low")
+        high_tokens = ImageEncoder.vision_tokens(inputs["size"], "high")
+        try:
+            transcription = await self._transcribe_with_detail(inputs, "low", config)
+            if self._is_usable(transcription):
+                metrics.increment("vision.adaptive.low")
+                metrics.increment("vision.adaptive.tokens_saved", high_tokens - low_tokens)
+                return transcription
+        except OutputParserException:
+            logger.warning("Low detail transcription does not follow the schema")
+
+        logger.info("Low detail transcription has no usable fields, escalating to high detail")
+        metrics.increment("vision.adaptive.escalated")
+        metrics.increment("vision.adaptive.tokens_wasted", low_tokens)
+        return await self._transcribe_with_detail(inputs, "high", config)
+
+    async def _transcribe_with_detail(self, inputs: dict, detail: str, config: RunnableConfig):
+        start = time.perf_counter()
+        transcription = await self._tool_factory.hedgers[f"vision_{detail}"].run(
+            lambda: self._tool_factory.image_transcription.ainvoke(inputs | {"detail": detail}, config))
+        metrics.observe(f"vision.{detail}_ms", (time.perf_counter() - start) * 1000)
+        return transcription
+
+    async def _describe_venue(self, inputs: dict, config: RunnableConfig) -> dict:
+        transcription = inputs["vision_transcription"] or VisionTranscription()
+        report_progress(TRANSCRIBED,
+                        venue=transcription.venue_name or transcription.organization or transcription.name)
+        if inputs["args"]["level"] >= DegradationLevel.NO_PLACES:
+            return VenueProcessor.describe_transcription(inputs["vision_transcription"])
+        # the places search is optional, it must leave enough time to generate the card
         try:
-            result = await self._chain.ainvoke({"image": image, "format": format, "detail": detail, "lat": lat, "lon": lon}, 
-                                               config={"run_name": randomname.get_name()})
-            return result
-        except Exception as e:
-            logger.exception(f"Error creating card: {e}")
-            return None
+            return await within_deadline(self._tool_factory.venue_description.ainvoke(inputs, config), "places",
+                                         reserve=self._card_reserve)
+        except DeadlineExceeded:
+            logger.warning("No time left to search the venue, creating the card from the transcription")
+            return VenueProcessor.describe_transcription(inputs["vision_transcription"])
 
     @staticmethod
-    def _vcf_parser(card: str) -> str:
-        BEGIN_CARD, END_CARD = "BEGIN:VCARD", "END:VCARD"
-        idx_start = card.find(BEGIN_CARD)
-        idx_end = card.find(END_CARD)
-        return card[idx_start : idx_end + len(END_CARD)]
+    def _is_usable(transcription: Optional[VisionTranscription]) -> bool:
+        return transcription is not None and transcription.is_usable()
+
+    @staticmethod
+    def _render_card(card: ContactCard) -> str:
+        return card.to_vcard()
 
 class VenueProcessor(Runnable):
     def __init__(self, settings: Settings):
         self._places = PlacesTool(settings)
 
+    @property
+    def places(self) -> PlacesTool:
+        return self._places
+
+    # place fields that do not help building the card, left out of the card prompt
+    PLACE_INTERNAL_FIELDS = ("distance", "place_id", "gps_coordinates")
+
     def invoke(self, inputs: dict, *args) -> dict:
-        vision_transcription = inputs['vision_transcription']
+        vision_transcription: VisionTranscription = inputs['vision_transcription'] or VisionTranscription()
         lat = inputs['args']['lat']
         lon = inputs['args']['lon']
 
-        if isinstance(vision_transcription, str):
-            vision_transcription = json.loads(vision_transcription.strip("`").lstrip("json"))
-
-        if isinstance(vision_transcription, dict):
-            query = " ".join([value for key, value in vision_transcription.items() if "venue" in key])
-
+        query = vision_transcription.venue_query
         if query:
             try:
-                result = self._places.simple_search(query, lat, lon)
+                details = inputs['args'].get('level', DegradationLevel.FULL) < DegradationLevel.NO_PLACE_DETAILS
+                result = self._places.simple_search(query, lat, lon, place=inputs['args'].get('place'),
+                                                    details=details)
                 if result:
-                    return {"vision_transcription": json.dumps(result)}
+                    report_progress(PLACE, title=result.get("title"), address=result.get("address"))
+                    place = {key: value for key, value in result.items() if key not in self.PLACE_INTERNAL_FIELDS}
+                    return {"vision_transcription": json.dumps(place, ensure_ascii=False)}
             except Exception:
-                logger.exception("Error parsing vision")
+                logger.exception("Error searching venue")
         
-        return {"vision_transcription": vision_transcription}
+        return self.describe_transcription(vision_transcription)
+
+    @staticmethod
+    def describe_transcription(vision_transcription: Optional[VisionTranscription]) -> dict:
+        vision_transcription = vision_transcription or VisionTranscription()
+        return {"vision_transcription": vision_transcription.model_dump_json(exclude_none=True)}
 
 @cache
 def build_agent():
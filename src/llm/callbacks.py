@@ -0,0 +1,28 @@
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from src.accounting import record_usage
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """
+    Records the LLM calls and their tokens, as reported by Azure OpenAI, on the active `Usage`.
+    """
+
+    # counted in the caller context, where the usage is bound
+    run_inline = True
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = token_usage.get("prompt_tokens")
+        completion_tokens = token_usage.get("completion_tokens")
+        if prompt_tokens is None:
+            # only reported on the messages by some models and versions
+            metadata = [getattr(generation.message, "usage_metadata", None) or {}
+                        for generations in response.generations for generation in generations
+                        if hasattr(generation, "message")]
+            prompt_tokens = sum(item.get("input_tokens", 0) for item in metadata)
+            completion_tokens = sum(item.get("output_tokens", 0) for item in metadata)
+        record_usage(llm_calls=1, prompt_tokens=prompt_tokens or 0, completion_tokens=completion_tokens or 0)
@@ -0,0 +1,91 @@
+import asyncio
+import importlib.util
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+from loguru import logger
+
+from src.metrics import metrics
+
+
+class ConnectionStats:
+    """
+    Connection reuse of an HTTP client: each request either reuses a pooled connection or opens a new one (DNS, TCP
+    and TLS, seen through the httpcore `trace` extension).
+
+    Counts `http.{name}.requests` and `http.{name}.connections` (new ones), and observes `http.{name}.connect_ms`.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.last_request = time.monotonic()
+
+    async def on_request(self, request: httpx.Request) -> None:
+        self.last_request = time.monotonic()
+        metrics.increment(f"http.{self.name}.requests")
+        started = None
+
+        async def _trace(event: str, info: dict) -> None:
+            nonlocal started
+            if event == "connection.connect_tcp.started":
+                started = time.perf_counter()
+                metrics.increment(f"http.{self.name}.connections")
+            elif started and (event == "connection.start_tls.complete"
+                              or event == "connection.connect_tcp.complete" and request.url.scheme == "http"):
+                metrics.observe(f"http.{self.name}.connect_ms", (time.perf_counter() - started) * 1000)
+
+        request.extensions["trace"] = _trace
+
+    def idle(self) -> float:
+        """
+        Seconds since the last request.
+        """
+        return time.monotonic() - self.last_request
+
+    def report(self) -> Dict[str, Any]:
+        requests = metrics.counter(f"http.{self.name}.requests")
+        connections = metrics.counter(f"http.{self.name}.connections")
+        return {
+            "requests": int(requests),
+            "connections": int(connections),
+            "reuse_rate": round(1 - connections / requests, 3) if requests else None,
+        }
+
+
+def create_http_client(stats: ConnectionStats, max_connections: int = 100, max_keepalive_connections: int = 20,
+                       keepalive_expiry: float = 120, http2: bool = True) -> httpx.AsyncClient:
+    """
+    Async HTTP client shared by the Azure OpenAI deployments, keeping its idle connections `keepalive_expiry`
+    seconds (5 by httpx default, so most requests after a pause paid the connection setup again).
+
+    HTTP/2 multiplexes the concurrent requests on a single connection; it needs the `h2` package, HTTP/1.1 is used
+    without it. The timeouts are set per request by the OpenAI client.
+    """
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning(f"HTTP/2 disabled for {stats.name}, the h2 package is not installed")
+        http2 = False
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections,
+                          keepalive_expiry=keepalive_expiry)
+    return httpx.AsyncClient(limits=limits, http2=http2, event_hooks={"request": [stats.on_request]})
+
+
+async def keep_warm(stats: ConnectionStats, ping: Callable[[], Awaitable[Any]], interval: float,
+                    timeout: float = 10) -> None:
+    """
+    Pings the upstream whenever no request has been sent for `interval` seconds, so a pooled connection is kept open
+    (below the keep-alive expiry of the client and of the upstream) for the first request after a pause. Counts
+    `http.{name}.keep_warm` and logs the connection reuse of the client. Runs until cancelled.
+    """
+    while True:
+        await asyncio.sleep(max(0.0, interval - stats.idle()))
+        if stats.idle() < interval:
+            continue
+        try:
+            await asyncio.wait_for(ping(), timeout)
+            metrics.increment(f"http.{stats.name}.keep_warm")
+        except Exception as e:
+            logger.warning(f"Could not keep the {stats.name} connection warm: {e}")
+        # next ping an interval later, even when this one failed
+        stats.last_request = time.monotonic()
+        logger.debug(f"Connections to {stats.name}: {stats.report()}")
@@ -1,71 +1,27 @@
 import base64
+import hashlib
 import time
-from fractions import Fraction
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import piexif
 from loguru import logger
 from PIL import Image
-from serpapi import GoogleSearch
 
+from src.accounting import record_usage
+from src.cache import Cache, get_cache
+from src.deadline import DeadlineExceeded, remaining_time
+from src.hedging import Hedger
+from src.imaging import EXIFHelper
 from src.settings import Settings
+from src.singleflight import SingleFlight
+from src.timing import track_stage
 from src.utils import get_value, update_if_not_empty, update_key_if_not_empty
 
 
-class EXIFHelper:
-    @classmethod
-    def _convert_to_degrees(cls, value: Union[int, float, Tuple[int, int], Tuple[float, float]]) -> float:
-        if isinstance(value[0], (int, float)):
-            d = Fraction(value[0])
-        else:
-            d = Fraction(value[0][0], value[0][1])
-
-        if isinstance(value[1], (int, float)):
-            m = Fraction(value[1])
-        else:
-            m = Fraction(value[1][0], value[1][1])
-
-        if isinstance(value[2], (int, float)):
-            s = Fraction(value[2])
-        else:
-            s = Fraction(value[2][0], value[2][1])
-
-        return float(d + (m / 60) + (s / 3600))
-
-    @classmethod
-    def extract_coordinates(cls, img: Image.Image) -> Tuple[Optional[float], Optional[float]]:
-        """
-        Extracts the latitude and longitude coordinates from the EXIF data of an image.
-
-        Args:
-            img (PIL.Image.Image): The image from which to extract the coordinates.
-
-        Returns:
-            Tuple[Optional[float], Optional[float]]: A tuple containing the latitude and longitude coordinates.
-                Returns (None, None) if the image does not have EXIF data or if the coordinates are not found.
-        """
-
-        img_exif = img.info.get("exif")  # img.getexif()
-        if not img_exif:
-            return None, None
-        exif = piexif.load(img_exif)
-        exif_gps = exif.get("GPS")
-        if not exif_gps:
-            return None, None
-
-        latitude = cls._convert_to_degrees(exif_gps[piexif.GPSIFD.GPSLatitude])
-        longitude = cls._convert_to_degrees(exif_gps[piexif.GPSIFD.GPSLongitude])
-        if exif_gps[piexif.GPSIFD.GPSLatitudeRef] == "S":
-            latitude = -latitude
-        if exif_gps[piexif.GPSIFD.GPSLongitudeRef] == "W":
-            longitude = -longitude
-        return (latitude, longitude)
-
-
 class SerpapiHelper:
     ENGINE = "google_local"
     DOMAIN = "google.es"
     GOOGLE_SEPARATOR = '·'
+    _flight = SingleFlight("serpapi")
 
     @staticmethod
     def generate_uule_v2(latitude, longitude, radius) -> str:
@@ -93,6 +49,33 @@ class SerpapiHelper:
 
         return "a+" + uule_v2_string_encoded
 
+    @staticmethod
+    def _uule_key(uule: str) -> str:
+        # the uule timestamp changes on every call, it is left out so the same location gives the same key
+        try:
+            decoded = base64.b64decode(uule[2:]).decode()
+        except Exception:
+            return uule
+        start = decoded.find("timestamp:")
+        if start < 0:
+            return decoded
+        end = decoded.find("\n", start)
+        return decoded[:start] + (decoded[end + 1:] if end >= 0 else "")
+
+    @staticmethod
+    def _query_key(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    @classmethod
+    def cache_key(cls, kind: str, query: str, location: str) -> str:
+        """
+        Cache key of a search of the query near a location: an uule ("uule" searches) or a place ID ("ludocid").
+        """
+        if kind == "uule":
+            location = cls._uule_key(location)
+        digest = hashlib.sha1(f"{cls._query_key(query)}\n{location}".encode()).hexdigest()
+        return f"serpapi:{kind}:{digest}"
+
     @classmethod
     def _normalize_distance(cls, local: Dict, default = None) -> Optional[float]:
         distance = default
@@ -123,20 +106,35 @@ class SerpapiHelper:
         }
 
     @classmethod
-    def _search(cls, settings: Settings, additional_args: Dict) -> List[Dict]:
+    def _search(cls, settings: Settings, additional_args: Dict, hedger: Optional[Hedger] = None) -> List[Dict]:
+        if hedger:
+            return hedger.call(cls._request, settings, additional_args)
+        return cls._request(settings, additional_args)
+
+    @classmethod
+    def _request(cls, settings: Settings, additional_args: Dict) -> List[Dict]:
+        from serpapi import GoogleSearch
         params = cls._common_parameters(settings) | additional_args
         search = GoogleSearch(params)
+        # bounded by the request deadline, the client waits (almost) forever otherwise
+        timeout = remaining_time()
+        if timeout is not None:
+            if timeout == 0:
+                raise DeadlineExceeded("No time left to search Serpapi")
+            search.timeout = timeout
+        record_usage(serpapi_searches=1)
         results = search.get_dict()
         return results["local_results"]
 
     @classmethod
-    def search_by_uule(cls, settings: Settings, query: str, uule: str) -> List[Dict]:
+    def search_by_uule(cls, settings: Settings, query: str, uule: str, hedger: Optional[Hedger] = None) -> List[Dict]:
         """
         Search for local results on Google based on the given query and uule.
 
         Args:
             query (str): The search query.
             uule (str): The uule parameter for location-based search.
+            hedger (Optional[Hedger]): Hedges the search when given.
 
         Returns:
             List[Dict]: A list of dictionaries representing the local search results.
@@ -149,7 +147,8 @@ class SerpapiHelper:
 
         """
 
-        local_results = cls._search(settings, {"q": query, "uule": uule})
+        key = ("uule", cls._query_key(query), cls._uule_key(uule))
+        local_results = cls._flight.do(key, cls._search, settings, {"q": query, "uule": uule}, hedger)
 
         locals = []
         for idx, local_result in enumerate(local_results):
@@ -169,13 +168,15 @@ class SerpapiHelper:
         return sorted(locals, key=lambda x: x["distance"])
 
     @classmethod
-    def search_by_place_id(cls, settings: Settings, query: str, place_id: str) -> Dict:
+    def search_by_place_id(cls, settings: Settings, query: str, place_id: str,
+                           hedger: Optional[Hedger] = None) -> Dict:
         """
         Search for a place by its place ID.
 
         Args:
             query (str): The search query.
             place_id (str): The place ID of the location.
+            hedger (Optional[Hedger]): Hedges the search when given.
 
         Returns:
             dict: A dictionary containing information about the place, including phone number, type, title, and GPS coordinates.
@@ -184,7 +185,8 @@ class SerpapiHelper:
             logger.warning("No place ID provided")
             return {}
 
-        local_results = cls._search(settings, {"q": query, "ludocid": place_id})
+        key = ("ludocid", cls._query_key(query), place_id)
+        local_results = cls._flight.do(key, cls._search, settings, {"q": query, "ludocid": place_id}, hedger)
         if len(local_results) == 0:
             logger.warning(f"No results found for place ID {place_id}")
             return {}
@@ -201,52 +203,224 @@ class SerpapiHelper:
 
 
 class GeoapifyHelper:
+    # coordinates rounded to 4 decimals (~11 m tiles) share the reverse geocoding result
+    PRECISION = 4
+    # limit of the Geoapify batch jobs API
+    BATCH_SIZE = 1000
+    # seconds to wait for a request without deadline
+    TIMEOUT = 30.0
+    _flight = SingleFlight("geoapify")
+
     @classmethod
-    def reverse_geocode(cls, settings: Settings, lat: float, lon: float) -> Optional[Dict]:
+    def tile(cls, lat: float, lon: float) -> Tuple[float, float]:
+        return round(lat, cls.PRECISION), round(lon, cls.PRECISION)
+
+    @classmethod
+    def cache_key(cls, lat: float, lon: float) -> str:
+        lat, lon = cls.tile(lat, lon)
+        return f"geoapify:reverse:{lat}:{lon}"
+
+    @staticmethod
+    def _address(properties: Dict) -> Dict:
+        return {
+            "country": properties.get("country"),
+            "state": properties.get("state"),
+            "county": properties.get("county"),
+            "city": properties.get("city"),
+            "postcode": properties.get("postcode"),
+        }
+
+    @classmethod
+    def reverse_geocode(cls, settings: Settings, lat: float, lon: float,
+                        hedger: Optional[Hedger] = None) -> Optional[Dict]:
         """
         Reverse geocoding using Geoapify API.
 
         Args:
             lat (float): The latitude coordinate.
             lon (float): The longitude coordinate.
+            hedger (Optional[Hedger]): Hedges the request when given.
 
         Returns:
             Optional[Dict]: A dictionary containing the address of the location.
         """
-        from geobatchpy import Client
-        client = Client(settings.GEOAPIFY_API_KEY)
-        response = client.reverse_geocode(round(lon,4), round(lat,4))
+        lat, lon = cls.tile(lat, lon)
+        return cls._flight.do((lat, lon), cls._reverse_geocode, settings, lat, lon, hedger)
 
-        properties = response["features"][0]["properties"]
-        return {
-            "country": properties.get("country"),
-            "state": properties.get("state"),
-            "county": properties.get("county"),
-            "city": properties.get("city"),
-            "postcode": properties.get("postcode"),
-        }
+    @classmethod
+    def _reverse_geocode(cls, settings: Settings, lat: float, lon: float,
+                         hedger: Optional[Hedger] = None) -> Optional[Dict]:
+        if hedger:
+            response = hedger.call(cls._request, settings, lat, lon)
+        else:
+            response = cls._request(settings, lat, lon)
+
+        return cls._address(response["features"][0]["properties"])
+
+    @classmethod
+    def _request(cls, settings: Settings, lat: float, lon: float) -> Dict:
+        # the request of `geobatchpy.Client.reverse_geocode`, which has no timeout, bounded by the request deadline
+        import requests
+        from geobatchpy import client
+        timeout = remaining_time()
+        if timeout == 0:
+            raise DeadlineExceeded("No time left to reverse geocode with Geoapify")
+        record_usage(geoapify_calls=1)
+        response = requests.get(client.get_api_url(api=client.API_REVERSE_GEOCODE, api_key=settings.GEOAPIFY_API_KEY),
+                                params={"lat": str(lat), "lon": str(lon)}, headers={"Accept": "application/json"},
+                                timeout=timeout or cls.TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+    @classmethod
+    def batch_reverse_geocode(cls, settings: Settings, coordinates: List[Tuple[float, float]],
+                              cache: Optional[Cache] = None) -> List[Optional[Dict]]:
+        """
+        Reverse geocoding of many coordinates using Geoapify batch jobs: coordinates are deduplicated by tile and
+        submitted as one job (per `BATCH_SIZE` tiles), which is polled until finished.
+
+        Args:
+            coordinates (List[Tuple[float, float]]): The (latitude, longitude) coordinates.
+            cache (Optional[Cache]): Cache of the tile addresses, only the tiles missing from it are submitted.
+
+        Returns:
+            List[Optional[Dict]]: The address of each coordinate, in the same order, or None if not found.
+        """
+        tiles = list(dict.fromkeys(cls.tile(lat, lon) for lat, lon in coordinates))
+        keys = {tile: cls.cache_key(*tile) for tile in tiles}
+        cached = cache.get_many(keys.values()) if cache else {}
+        addresses = {tile: cached[key] for tile, key in keys.items() if key in cached}
+        tiles = [tile for tile in tiles if tile not in addresses]
+        if not tiles:
+            return [addresses.get(cls.tile(lat, lon)) for lat, lon in coordinates]
+
+        from geobatchpy.batch import BatchClient
+        from geobatchpy.utils import API_REVERSE_GEOCODE
+        client = BatchClient(settings.GEOAPIFY_API_KEY)
+        inputs = [{"params": {"lat": lat, "lon": lon}} for lat, lon in tiles]
+        job_urls = client.post_batch_jobs_and_get_job_urls(API_REVERSE_GEOCODE, inputs, batch_len=cls.BATCH_SIZE)
+        record_usage(geoapify_batch_jobs=len(job_urls))
+        logger.info(f"Reverse geocoding {len(coordinates)} coordinates ({len(tiles)} tiles) in {len(job_urls)} batch jobs")
+
+        for job_url in job_urls:
+            for result in cls._wait_batch_job(settings, job_url):
+                matches = (result.get("result") or {}).get("results") or []
+                if matches:
+                    params = result["params"]
+                    addresses[cls.tile(float(params["lat"]), float(params["lon"]))] = cls._address(matches[0])
+        if cache:
+            cache.set_many({keys[tile]: addresses[tile] for tile in tiles if tile in addresses},
+                           settings.CACHE_TTL_GEOCODE)
+        return [addresses.get(cls.tile(lat, lon)) for lat, lon in coordinates]
+
+    @staticmethod
+    def _wait_batch_job(settings: Settings, job_url: str) -> List[Dict]:
+        """
+        Polls the batch job until finished, for at most `GEOAPIFY_BATCH_TIMEOUT` seconds or until the current
+        deadline (see `src.deadline`), each request bounded by the time left; no poll is waited for when it would
+        come after either.
+
+        Raises:
+            DeadlineExceeded: if the deadline expires first.
+            TimeoutError: if the job is not finished after `GEOAPIFY_BATCH_TIMEOUT` seconds.
+        """
+        import requests
+        expires_at = time.monotonic() + settings.GEOAPIFY_BATCH_TIMEOUT
+
+        def _time_left() -> float:
+            remaining = remaining_time()
+            left = expires_at - time.monotonic()
+            return left if remaining is None else min(left, remaining)
+
+        while True:
+            response = requests.get(job_url, headers={"Accept": "application/json"},
+                                    timeout=max(0.1, min(30.0, _time_left())))
+            response.raise_for_status()
+            job = response.json()
+            if "results" in job:
+                return job["results"]
+            if job.get("status") != "pending":
+                raise ValueError(f"Unexpected Geoapify batch job response: {job}")
+            # given up when the next poll would come too late
+            interval = settings.GEOAPIFY_BATCH_POLL_INTERVAL
+            remaining = remaining_time()
+            if remaining is not None and remaining <= interval:
+                raise DeadlineExceeded("Geoapify batch job not finished before the deadline")
+            if _time_left() <= interval:
+                raise TimeoutError(f"Geoapify batch job not finished after {settings.GEOAPIFY_BATCH_TIMEOUT} s")
+            time.sleep(interval)
 
 class PlacesTool():
     RADIUS = 300
 
     def __init__(self, settings: Settings):
         self.settings: Settings = settings
-    
-    def simple_search(self, query: str, latitude: float, longitude: float) -> Optional[Dict]:
+        self._cache: Optional[Cache] = get_cache(settings.CACHE_URL)
+        # owned by the tool, so tools built with different settings do not share their budgets and latencies
+        self.hedgers: Dict[str, Hedger] = {
+            upstream: Hedger(upstream, settings.HEDGE_BUDGET, settings.HEDGE_DELAY, settings.HEDGE_PERCENTILE)
+            for upstream in ("serpapi", "geoapify")
+        }
+
+    def _cached(self, key: str, ttl: float, fn: Callable, *args) -> Any:
+        if self._cache is None:
+            return fn(*args)
+        return self._cache.get_or_set(key, lambda: fn(*args), ttl)
+
+    def simple_search(self, query: str, latitude: float, longitude: float,
+                      place: Optional[Dict] = None, details: bool = True) -> Optional[Dict]:
+        """
+        Searches for a place near the coordinates. `place` is the already known address of the coordinates
+        (see `reverse_geocode_images`), reverse geocoded otherwise. The place found is completed with its
+        details (phone, website...) unless `details` is False.
+        """
         uule = SerpapiHelper.generate_uule_v2(latitude, longitude, self.RADIUS)
         # logger.info(f"uule: {uule}")
-        place = GeoapifyHelper.reverse_geocode(self.settings, latitude, longitude)
+        if place:
+            place = dict(place)
+        else:
+            with track_stage("geocode"):
+                place = self._cached(GeoapifyHelper.cache_key(latitude, longitude),
+                                     self.settings.CACHE_TTL_GEOCODE,
+                                     GeoapifyHelper.reverse_geocode, self.settings, latitude, longitude,
+                                     self.hedgers["geoapify"])
         query += f", {place['city']}, {place['country']}"
-        locals = SerpapiHelper.search_by_uule(self.settings, query, uule)
+        with track_stage("local_search"):
+            locals = self._cached(SerpapiHelper.cache_key("uule", query, uule),
+                                  self.settings.CACHE_TTL_PLACES,
+                                  SerpapiHelper.search_by_uule, self.settings, query, uule, self.hedgers["serpapi"])
         # logger.debug(f"locals:\n{locals}")
         if len(locals) > 0:
             place |= locals[0]
             # if "phone" not in place:
-            place |= SerpapiHelper.search_by_place_id(self.settings, query, place.get("place_id"))
+            if details:
+                with track_stage("place_details"):
+                    place |= self._cached(SerpapiHelper.cache_key("ludocid", query, place.get("place_id")),
+                                          self.settings.CACHE_TTL_PLACES, SerpapiHelper.search_by_place_id,
+                                          self.settings, query, place.get("place_id"), self.hedgers["serpapi"])
             logger.debug(f"place: {place}")
             return place
         return None
 
+    def reverse_geocode_images(self, image_paths: List[str]) -> Dict[str, Optional[Dict]]:
+        """
+        Reverse geocodes the EXIF coordinates of many images with a single batch job.
+
+        Args:
+            image_paths (List[str]): The paths to the images.
+
+        Returns:
+            Dict[str, Optional[Dict]]: The address of each image, None if the image has no coordinates.
+        """
+        coordinates = {}
+        for image_path in image_paths:
+            with Image.open(image_path) as img:
+                latitude, longitude = EXIFHelper.extract_coordinates(img)
+            if latitude and longitude:
+                coordinates[image_path] = (latitude, longitude)
+        addresses = GeoapifyHelper.batch_reverse_geocode(self.settings, list(coordinates.values()), self._cache)
+        return {image_path: None for image_path in image_paths} | dict(zip(coordinates, addresses))
+
     def search(self, image_path: str, query: str, lat: Optional[float], lon: Optional[float]) -> Optional[Dict]:
         """
         Searches for a place based on the given image path and query.
@@ -268,13 +442,14 @@ class PlacesTool():
                 return None
         uule = SerpapiHelper.generate_uule_v2(latitude, longitude, self.RADIUS)
         logger.info(f"uule: {uule}")
-        place = GeoapifyHelper.reverse_geocode(self.settings, latitude, longitude)
+        place = GeoapifyHelper.reverse_geocode(self.settings, latitude, longitude, self.hedgers["geoapify"])
         query += f", {place['city']}, {place['country']}"
-        locals = SerpapiHelper.search_by_uule(self.settings, query, uule)
+        locals = SerpapiHelper.search_by_uule(self.settings, query, uule, self.hedgers["serpapi"])
         logger.debug(f"locals:\n{locals}")
         if len(locals) > 0:
             place |= locals[0]
             # if "phone" not in place:
-            place |= SerpapiHelper.search_by_place_id(self.settings, query, place.get("place_id"))
+            place |= SerpapiHelper.search_by_place_id(self.settings, query, place.get("place_id"),
+                                                      self.hedgers["serpapi"])
             logger.debug(f"place: {place}")
             return place
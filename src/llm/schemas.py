@@ -0,0 +1,66 @@
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from src.utils import is_empty
+
+
+class VisionTranscription(BaseModel):
+    """Venue (facade photo) or contact (business card) in the image. Leave unknown fields empty."""
+
+    venue_name: Optional[str] = Field(default=None, description="venue name, usually the bigger text")
+    venue_type: Optional[str] = Field(default=None, description="venue type, make your best bet")
+    name: Optional[str] = Field(default=None, description="card: person name")
+    organization: Optional[str] = Field(default=None, description="card: company name")
+    phone: Optional[str] = Field(default=None, description="card: phone number")
+    email: Optional[str] = Field(default=None, description="card: email")
+    website: Optional[str] = Field(default=None, description="card: website")
+    address: Optional[str] = Field(default=None, description="card: address")
+
+    @property
+    def venue_query(self) -> str:
+        return " ".join(value for value in [self.venue_name, self.venue_type] if not is_empty(value))
+
+    def is_usable(self) -> bool:
+        """
+        Whether the transcription has venue or card fields worth building a card from.
+        """
+        return any(not is_empty(value) for value in [self.venue_name, self.name, self.organization, self.phone,
+                                                     self.email])
+
+
+class ContactCard(BaseModel):
+    """Contact card (vCard) of the venue or person."""
+
+    formatted_name: str = Field(description="venue or person name")
+    organization: Optional[str] = Field(default=None, description="company name, if different from the name")
+    title: Optional[str] = Field(default=None, description="person job title")
+    category: Optional[str] = Field(default=None, description="venue type")
+    phone: Optional[str] = Field(default=None, description="E.164 phone number, e.g. +34111222333")
+    email: Optional[str] = Field(default=None)
+    website: Optional[str] = Field(default=None)
+    address: Optional[str] = Field(default=None, description="full postal address")
+
+    @staticmethod
+    def _escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace(",", "\\,").replace(";", "\\;").replace("\n", "\\n")
+
+    def to_vcard(self) -> str:
+        """
+        Renders the card as a vCard 3.0 document.
+        """
+        lines = ["BEGIN:VCARD", "VERSION:3.0", f"N:{self._escape(self.formatted_name)};;;;",
+                 f"FN:{self._escape(self.formatted_name)}"]
+        properties = [
+            ("ORG", self.organization),
+            ("TITLE", self.title),
+            ("CATEGORIES", self.category),
+            ("TEL;TYPE=work,voice", self.phone),
+            ("EMAIL;TYPE=work", self.email),
+            ("URL", self.website),
+        ]
+        lines += [f"{name}:{self._escape(value.strip())}" for name, value in properties if not is_empty(value)]
+        if not is_empty(self.address):
+            lines.append(f"ADR;TYPE=work:;;{self._escape(self.address.strip())};;;;")
+        lines.append("END:VCARD")
+        return "\n".join(lines)
@@ -0,0 +1,88 @@
+import asyncio
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, Iterator, Optional
+
+
+class Metrics:
+    """
+    Process-wide counters and summaries (count, sum, max) of observed values, exposed by the API on `/metrics`.
+    """
+
+    def __init__(self):
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._summaries: Dict[str, Dict[str, float]] = {}
+        self._lock = Lock()
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            summary = self._summaries.setdefault(name, {"count": 0, "sum": 0.0, "max": value})
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+
+    def counter(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "summaries": {name: summary | {"avg": summary["sum"] / summary["count"]}
+                              for name, summary in self._summaries.items()},
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+
+
+metrics = Metrics()
+
+
+async def monitor_event_loop_lag(interval: float = 0.05) -> None:
+    """
+    Observes `event_loop.lag_ms`, how late the event loop wakes up a task sleeping `interval` seconds; it grows when
+    blocking work runs on the loop. Runs until cancelled.
+    """
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        metrics.observe("event_loop.lag_ms", max(0.0, time.perf_counter() - expected) * 1000)
+
+
+@dataclass
+class PeakMemory:
+    bytes: Optional[int] = None
+
+
+@contextmanager
+def track_peak_memory(name: str) -> Iterator[PeakMemory]:
+    """
+    Measures the peak of the memory allocated in the block (above the memory allocated at its start) with
+    tracemalloc, observed as `memory.{name}.peak_bytes`. Nothing is measured unless tracemalloc is tracing.
+
+    The peak is process-wide, hence only attributable to the block when it does not overlap with others (e.g. a
+    single request at a time).
+    """
+    peak = PeakMemory()
+    if not tracemalloc.is_tracing():
+        yield peak
+        return
+    start, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    try:
+        yield peak
+    finally:
+        peak.bytes = max(0, tracemalloc.get_traced_memory()[1] - start)
+        metrics.observe(f"memory.{name}.peak_bytes", peak.bytes)
@@ -0,0 +1,278 @@
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import MutableMapping
+from typing import Any, Dict, Hashable, Iterator, Optional, Tuple
+
+from loguru import logger
+from telegram.ext import ConversationHandler
+
+
+class StateStore(ABC):
+    """
+    Key-value store of the bot state, shared by the bot replicas. Values are stored as JSON (so tuples are read back
+    as lists), and expire after `ttl` seconds when given.
+    """
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    def get_all(self, namespace: str) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def pop_all(self, namespace: str) -> Dict[str, Any]:
+        """
+        Removes the entries of a namespace, returning them: atomically, so when several replicas pop the same
+        namespace, each entry is returned to one of them.
+        """
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class MemoryStateStore(StateStore):
+    """
+    Process local store, for a single bot replica (the state is lost on restart).
+    """
+
+    def __init__(self):
+        self._data: Dict[Tuple[str, str], Tuple[str, Optional[float]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            value, expires_at = self._data.get((namespace, key), (None, None))
+        if value is None or (expires_at is not None and expires_at <= time.time()):
+            return None
+        return json.loads(value)
+
+    def get_all(self, namespace: str) -> Dict[str, Any]:
+        with self._lock:
+            keys = [key for ns, key in self._data if ns == namespace]
+        return {key: value for key in keys if (value := self.get(namespace, key)) is not None}
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[(namespace, key)] = (json.dumps(value), expires_at)
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._data.pop((namespace, key), None)
+
+    def pop_all(self, namespace: str) -> Dict[str, Any]:
+        with self._lock:
+            entries = {key: self._data.pop((ns, key)) for ns, key in list(self._data) if ns == namespace}
+        now = time.time()
+        return {key: json.loads(value) for key, (value, expires_at) in entries.items()
+                if expires_at is None or expires_at > now}
+
+
+class SQLiteStateStore(StateStore):
+    """
+    SQLite store, shared by the replicas mounting the same database file.
+
+    Writes are batched: they are kept in memory (and read from there by this replica) and committed in a single
+    transaction every `flush_interval` seconds by a background thread, where expired entries are also purged. Hence the
+    other replicas see a write up to `flush_interval` seconds later, unless it is flushed at once (see `StoreMapping`).
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self._path = path
+        self._flush_interval = flush_interval
+        # (namespace, key) -> (JSON value or None when deleted, expiry time)
+        self._pending: Dict[Tuple[str, str], Tuple[Optional[str], Optional[float]]] = {}
+        self._lock = threading.Lock()
+        # flushes are serialized, so an older snapshot of the pending writes never overwrites a newer one
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS state (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                               "value TEXT NOT NULL, expires_at REAL, PRIMARY KEY (namespace, key))")
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="state-store-flush", daemon=True)
+        self._flusher.start()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = sqlite3.connect(self._path, timeout=10)
+        return self._local.connection
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            pending = self._pending.get((namespace, key))
+        if pending is not None:
+            value, expires_at = pending
+        else:
+            row = self._connection().execute("SELECT value, expires_at FROM state WHERE namespace = ? AND key = ?",
+                                             (namespace, key)).fetchone()
+            value, expires_at = row if row else (None, None)
+        if value is None or (expires_at is not None and expires_at <= time.time()):
+            return None
+        return json.loads(value)
+
+    def get_all(self, namespace: str) -> Dict[str, Any]:
+        rows = self._connection().execute("SELECT key, value, expires_at FROM state WHERE namespace = ?",
+                                          (namespace,)).fetchall()
+        entries = {key: (value, expires_at) for key, value, expires_at in rows}
+        with self._lock:
+            entries |= {key: entry for (ns, key), entry in self._pending.items() if ns == namespace}
+        now = time.time()
+        return {key: json.loads(value) for key, (value, expires_at) in entries.items()
+                if value is not None and (expires_at is None or expires_at > now)}
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._pending[(namespace, key)] = (json.dumps(value), expires_at)
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._pending[(namespace, key)] = (None, None)
+
+    def pop_all(self, namespace: str) -> Dict[str, Any]:
+        with self._flush_lock:
+            with self._lock:
+                pending = {key: entry for (ns, key), entry in self._pending.items() if ns == namespace}
+            connection = self._connection()
+            with connection:
+                # the write lock is taken before reading, so no other replica reads (or writes) the namespace between
+                # the read and the delete
+                connection.execute("BEGIN IMMEDIATE")
+                rows = connection.execute("SELECT key, value, expires_at FROM state WHERE namespace = ?",
+                                          (namespace,)).fetchall()
+                connection.execute("DELETE FROM state WHERE namespace = ?", (namespace,))
+            with self._lock:
+                for key, entry in pending.items():
+                    if self._pending.get((namespace, key)) is entry:
+                        del self._pending[(namespace, key)]
+        entries = {key: (value, expires_at) for key, value, expires_at in rows} | pending
+        now = time.time()
+        return {key: json.loads(value) for key, (value, expires_at) in entries.items()
+                if value is not None and (expires_at is None or expires_at > now)}
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            # entries stay pending (readable) until committed
+            with self._lock:
+                pending = dict(self._pending)
+            connection = self._connection()
+            with connection:
+                for (namespace, key), (value, expires_at) in pending.items():
+                    if value is None:
+                        connection.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+                    else:
+                        connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)",
+                                           (namespace, key, value, expires_at))
+                connection.execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),))
+            with self._lock:
+                for entry_key, entry in pending.items():
+                    if self._pending.get(entry_key) is entry:
+                        del self._pending[entry_key]
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error flushing the bot state")
+
+    def close(self) -> None:
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+
+
+def create_state_store(path: Optional[str], flush_interval: float = 1.0) -> StateStore:
+    """
+    SQLite store when a database path is given, process local store otherwise.
+    """
+    if path:
+        return SQLiteStateStore(path, flush_interval)
+    return MemoryStateStore()
+
+
+class StoreMapping(MutableMapping):
+    """
+    Mapping view of a namespace of a `StateStore`, whose entries expire after `ttl` seconds when given.
+    Keys are ints, strings or tuples of them (e.g. the (chat id, user id) conversation keys).
+
+    With `write_through`, every write flushes the store, committing it along with the writes pending before it (e.g.
+    the photo waiting for the location, written before the conversation moves to the state asking for it).
+    """
+
+    def __init__(self, store: StateStore, namespace: str, ttl: Optional[float] = None, write_through: bool = False):
+        self._store = store
+        self._namespace = namespace
+        self._ttl = ttl
+        self._write_through = write_through
+
+    @staticmethod
+    def _encode(key: Hashable) -> str:
+        parts = key if isinstance(key, tuple) else (key,)
+        return ":".join(f"{type(part).__name__}={part}" for part in parts)
+
+    @staticmethod
+    def _decode(key: str) -> Hashable:
+        parts = tuple(int(value) if kind == "int" else value
+                      for kind, value in (part.split("=", 1) for part in key.split(":")))
+        return parts if len(parts) > 1 else parts[0]
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = self._store.get(self._namespace, self._encode(key))
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self._store.set(self._namespace, self._encode(key), value, self._ttl)
+        if self._write_through:
+            self._store.flush()
+
+    def __delitem__(self, key: Hashable) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._store.delete(self._namespace, self._encode(key))
+        if self._write_through:
+            self._store.flush()
+
+    def __contains__(self, key: object) -> bool:
+        return self._store.get(self._namespace, self._encode(key)) is not None
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter([self._decode(key) for key in self._store.get_all(self._namespace)])
+
+    def __len__(self) -> int:
+        return len(self._store.get_all(self._namespace))
+
+
+class SharedConversationHandler(ConversationHandler):
+    """
+    `ConversationHandler` keeping the state of the conversations in a `StateStore`, so a conversation started on
+    one bot replica can continue on another one (and survives restarts). Conversations expire after `ttl` seconds.
+
+    The state transitions are written through, so the next update of the conversation finds the new state (and the
+    data written before it) whichever replica receives it.
+    """
+
+    def __init__(self, *args, store: StateStore, ttl: Optional[float] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._conversations = StoreMapping(store, f"conversation:{self.name or 'default'}", ttl, write_through=True)
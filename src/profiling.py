@@ -0,0 +1,153 @@
+import cProfile
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+from typing import Counter as CounterType, Iterator, List, Literal, Optional
+
+from loguru import logger
+
+ProfileMode = Literal["sampling", "deterministic"]
+EXTENSIONS = {"sampling": ".folded", "deterministic": ".prof"}
+# profile file names, `{run_name}.{extension}`
+PROFILE_NAME = re.compile(r"^[\w-]+\.(folded|prof)$")
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread (but its own) each `interval` seconds, from a background thread: the event
+    loop and the thread pools running the places lookups. The samples are written in the folded format of flame
+    graphs (`thread;outer frame;...;inner frame count` per line), e.g. for `flamegraph.pl` or speedscope.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: CounterType[str] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self) -> None:
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self._thread.ident:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path: Path) -> None:
+        path.write_text("".join(f"{stack} {count}\n" for stack, count in self.samples.most_common()))
+
+
+@dataclass
+class ProfileFile:
+    name: str
+    run_name: str
+    mode: ProfileMode
+    size: int
+    created_at: float
+
+
+class ProfileStore:
+    """
+    Directory of the latest `keep` profiles, one per profiled request, named after its `run_name`.
+    """
+
+    def __init__(self, directory: str, keep: int = 20):
+        self.directory = Path(directory)
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, run_name: str, mode: ProfileMode = "sampling") -> Iterator[Optional[Path]]:
+        """
+        Profiles the enclosed block, stored as `{run_name}.folded` (sampling) or `{run_name}.prof` (deterministic,
+        `cProfile` of the current thread, i.e. the event loop; read with `pstats` or snakeviz). Yields the path of
+        the profile, or None when not profiled because another block is already being profiled.
+
+        Both see the other requests served meanwhile, so profile when the API is otherwise idle when possible.
+        """
+        if not self._lock.acquire(blocking=False):
+            logger.warning(f"Request {run_name} not profiled, another request is being profiled")
+            yield None
+            return
+        try:
+            with self._profile(run_name, mode) as path:
+                yield path
+        finally:
+            self._lock.release()
+
+    @contextmanager
+    def _profile(self, run_name: str, mode: ProfileMode) -> Iterator[Path]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{run_name}{EXTENSIONS[mode]}"
+        start = time.perf_counter()
+        if mode == "deterministic":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield path
+            finally:
+                profiler.disable()
+                profiler.dump_stats(path)
+        else:
+            sampler = SamplingProfiler()
+            sampler.start()
+            try:
+                yield path
+            finally:
+                sampler.stop()
+                sampler.dump(path)
+        logger.info(f"Request {run_name} profiled ({mode}) in {(time.perf_counter() - start) * 1000:.0f} ms: {path}")
+        self._prune()
+
+    def list(self) -> List[ProfileFile]:
+        """
+        The stored profiles, the latest first.
+        """
+        if not self.directory.exists():
+            return []
+        profiles = []
+        for path in self.directory.iterdir():
+            if PROFILE_NAME.match(path.name):
+                stat = path.stat()
+                mode = "sampling" if path.suffix == EXTENSIONS["sampling"] else "deterministic"
+                profiles.append(ProfileFile(name=path.name, run_name=path.stem, mode=mode, size=stat.st_size,
+                                            created_at=stat.st_mtime))
+        return sorted(profiles, key=lambda profile: profile.created_at, reverse=True)
+
+    def path(self, name: str) -> Optional[Path]:
+        """
+        Path of a stored profile, None if there is none with that name.
+        """
+        path = self.directory / name
+        return path if PROFILE_NAME.match(name) and path.is_file() else None
+
+    def _prune(self) -> None:
+        for profile in self.list()[self.keep:]:
+            (self.directory / profile.name).unlink(missing_ok=True)
+
+
+@cache
+def get_profile_store(directory: str, keep: int = 20) -> ProfileStore:
+    return ProfileStore(directory, keep)
@@ -0,0 +1,91 @@
+import asyncio
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterator, Optional
+
+# events of a card, in order: the image is received, transcribed, its place resolved (only when found) and the
+# card ready (or failed)
+RECEIVED = "received"
+TRANSCRIBED = "transcribed"
+PLACE = "place"
+CARD = "card"
+ERROR = "error"
+
+
+@dataclass
+class ProgressEvent:
+    event: str
+    data: Dict[str, Any] = field(default_factory=dict)
+
+    def encode(self) -> str:
+        """
+        The event as a server-sent event.
+        """
+        return f"event: {self.event}\ndata: {json.dumps(self.data, ensure_ascii=False)}\n\n"
+
+
+async def read_events(lines: AsyncIterable[bytes]) -> AsyncIterator[ProgressEvent]:
+    """
+    Parses the server-sent events of a response, given its lines (e.g. the `content` of an aiohttp response).
+    """
+    event, data = None, []
+    async for line in lines:
+        line = line.decode("utf-8").rstrip("\r\n")
+        if not line:
+            if event is not None:
+                yield ProgressEvent(event, json.loads("\n".join(data)) if data else {})
+            event, data = None, []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+
+
+class Progress:
+    """
+    Progress events of a card, streamed to the client waiting for it.
+
+    The instance is bound to the current context with `activate`, so the stages of the card (including the ones
+    executed in a thread pool) can report their progress through `report_progress`. Must be created in the event
+    loop reading the events.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue[Optional[ProgressEvent]] = asyncio.Queue()
+
+    def report(self, event: str, **data: Any) -> None:
+        # thread-safe, the places are searched in a thread pool
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, ProgressEvent(event, data))
+
+    def close(self) -> None:
+        """
+        Ends the events, once the card is ready or failed.
+        """
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    async def events(self) -> AsyncIterator[ProgressEvent]:
+        while (event := await self._queue.get()) is not None:
+            yield event
+
+    @contextmanager
+    def activate(self) -> Iterator["Progress"]:
+        token = _current_progress.set(self)
+        try:
+            yield self
+        finally:
+            _current_progress.reset(token)
+
+
+_current_progress: ContextVar[Optional[Progress]] = ContextVar("progress", default=None)
+
+
+def report_progress(event: str, **data: Any) -> None:
+    """
+    Reports an event on the active `Progress`, if any (only cards requested with progress have one).
+    """
+    progress = _current_progress.get()
+    if progress is not None:
+        progress.report(event, **data)
@@ -1,11 +1,15 @@
+import os
+import tempfile
 import uuid
 from functools import cache, cached_property
-from typing import Optional, Union
+from typing import TYPE_CHECKING, List, Literal, Optional, Union
 
-from langchain_core.tracers import LangChainTracer
-from pydantic import Field, computed_field
+from pydantic import Field
 from pydantic_settings import BaseSettings
 
+if TYPE_CHECKING:
+    from src.tracing import SampledTracer
+
 
 class Settings(BaseSettings):
     class Config:
@@ -21,13 +25,67 @@ class Settings(BaseSettings):
     AZURE_OPENAI_API_VERSION: str = Field(default="2023-12-01-preview", env="AZURE_OPENAI_API_VERSION")
     AZURE_OPENAI_DEPLOYMENT_VISION: str = Field(default="vision", env="AZURE_OPENAI_DEPLOYMENT_VISION")
     AZURE_OPENAI_DEPLOYMENT_AGENT: str = Field(default="instruct", env="AZURE_OPENAI_DEPLOYMENT_AGENT")
+    AZURE_OPENAI_MODEL_VISION: str = Field(default="gpt-4o-mini", env="AZURE_OPENAI_MODEL_VISION")
+    AZURE_OPENAI_MODEL_AGENT: str = Field(default="gpt-4o-mini", env="AZURE_OPENAI_MODEL_AGENT")
+    AZURE_OPENAI_MAX_TOKENS_VISION: int = Field(default=500, env="AZURE_OPENAI_MAX_TOKENS_VISION")
+    AZURE_OPENAI_MAX_TOKENS_AGENT: int = Field(default=500, env="AZURE_OPENAI_MAX_TOKENS_AGENT")
+    AZURE_OPENAI_TIMEOUT_VISION: float = Field(default=60, env="AZURE_OPENAI_TIMEOUT_VISION")
+    AZURE_OPENAI_TIMEOUT_AGENT: float = Field(default=30, env="AZURE_OPENAI_TIMEOUT_AGENT")
+    # HTTP client shared by the deployments: pool limits, seconds idle connections are kept, HTTP/2 (with the h2
+    # package) and connection setup timeout; a ping keeps a connection open after AZURE_OPENAI_KEEP_WARM_INTERVAL
+    # idle seconds (disabled with 0)
+    AZURE_OPENAI_MAX_CONNECTIONS: int = Field(default=100, env="AZURE_OPENAI_MAX_CONNECTIONS")
+    AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = Field(default=20, env="AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS")
+    AZURE_OPENAI_KEEPALIVE_EXPIRY: float = Field(default=120, env="AZURE_OPENAI_KEEPALIVE_EXPIRY")
+    AZURE_OPENAI_HTTP2: bool = Field(default=True, env="AZURE_OPENAI_HTTP2")
+    AZURE_OPENAI_CONNECT_TIMEOUT: float = Field(default=5, env="AZURE_OPENAI_CONNECT_TIMEOUT")
+    AZURE_OPENAI_KEEP_WARM_INTERVAL: float = Field(default=60, env="AZURE_OPENAI_KEEP_WARM_INTERVAL")
+    # seconds to create a card (no deadline when not set), of which the last CARD_GENERATION_RESERVE are kept for
+    # the card generation: the places search is given up, and the card created from the transcription alone, then
+    REQUEST_DEADLINE: Optional[float] = Field(default=60, env="REQUEST_DEADLINE")
+    CARD_GENERATION_RESERVE: float = Field(default=10, env="CARD_GENERATION_RESERVE")
+    # cheaper pipelines under load: the i-th threshold enters the i-th level (skip the place details, skip the places
+    # search, low detail vision only) when reached by the cards in flight or the p90 of the latest card durations
+    # (seconds), e.g. DEGRADATION_QUEUE_DEPTHS=[16,32,48]; no degradation without thresholds. The latest durations
+    # are those of the cards finished in the last DEGRADATION_WINDOW seconds
+    DEGRADATION_QUEUE_DEPTHS: List[int] = Field(default=[], env="DEGRADATION_QUEUE_DEPTHS")
+    DEGRADATION_LATENCIES: List[float] = Field(default=[], env="DEGRADATION_LATENCIES")
+    DEGRADATION_WINDOW: float = Field(default=60, env="DEGRADATION_WINDOW")
+    # hedged upstream calls (Serpapi, Geoapify, vision and card generation): a second identical call is sent when the
+    # first takes longer than HEDGE_DELAY seconds (or the HEDGE_PERCENTILE of its observed latencies), adding at most
+    # HEDGE_BUDGET (a fraction, e.g. 0.05) extra calls; disabled with a zero budget
+    HEDGE_BUDGET: float = Field(default=0, env="HEDGE_BUDGET")
+    HEDGE_DELAY: Optional[float] = Field(default=None, env="HEDGE_DELAY")
+    HEDGE_PERCENTILE: float = Field(default=90, env="HEDGE_PERCENTILE")
+    # deployment used by the text-only card generation step ("agent" is usually the faster and cheaper one)
+    CARD_GENERATION_ROUTE: Literal["vision", "agent"] = Field(default="agent", env="CARD_GENERATION_ROUTE")
+
+    # pool running the CPU-bound image work (EXIF) off the event loop, `IMAGE_WORKERS` defaults to the CPUs (max 4);
+    # the base64 encoding always runs in threads, see `ImageExecutor.encode`
+    IMAGE_EXECUTOR: Literal["process", "thread"] = Field(default="process", env="IMAGE_EXECUTOR")
+    IMAGE_WORKERS: Optional[int] = Field(default=None, env="IMAGE_WORKERS")
 
     SERPAPI_API_KEY: Optional[str] = Field(default=None, env="SERPAPI_API_KEY")
     GEOAPIFY_API_KEY: Optional[str] = Field(default=None, env="GEOAPIFY_API_KEY")
+    GEOAPIFY_BATCH_POLL_INTERVAL: float = Field(default=3, env="GEOAPIFY_BATCH_POLL_INTERVAL")
+    GEOAPIFY_BATCH_TIMEOUT: float = Field(default=600, env="GEOAPIFY_BATCH_TIMEOUT")
+    # seconds the cards of an album wait for its batch reverse geocoding, each card geocodes its image after that
+    GEOAPIFY_ALBUM_TIMEOUT: float = Field(default=10, env="GEOAPIFY_ALBUM_TIMEOUT")
+
+    # cache of the places lookups, shared by the workers: memory://, sqlite:///relative/cache.db (sqlite:////absolute
+    # for an absolute path) or redis://host:port
+    CACHE_URL: Optional[str] = Field(default=None, env="CACHE_URL")
+    CACHE_TTL_GEOCODE: float = Field(default=30 * 86400, env="CACHE_TTL_GEOCODE")
+    CACHE_TTL_PLACES: float = Field(default=86400, env="CACHE_TTL_PLACES")
 
     LANGSMITH_ENDPOINT: str = Field(default="https://api.smith.langchain.com", env="LANGSMITH_ENDPOINT")
     LANGSMITH_API_KEY: Optional[str] = Field(default=None, env="LANGSMITH_API_KEY")
     LANGSMITH_PROJECT: str = Field(default="img2card", env="LANGSMITH_PROJECT")
+    # fraction of the cards traced, the failed ones are traced anyway with LANGSMITH_TRACE_ERRORS
+    LANGSMITH_SAMPLE_RATE: float = Field(default=1.0, env="LANGSMITH_SAMPLE_RATE")
+    LANGSMITH_TRACE_ERRORS: bool = Field(default=True, env="LANGSMITH_TRACE_ERRORS")
+    # images uploaded with the traces: "keep" (whole), "truncate" (first characters) or "redact"
+    LANGSMITH_IMAGES: Literal["keep", "truncate", "redact"] = Field(default="truncate", env="LANGSMITH_IMAGES")
 
     TELEGRAM_TOKEN: str = Field(env="TELEGRAM_TOKEN")
     TELEGRAM_SECRET: Optional[str] = Field(
@@ -35,15 +93,34 @@ class Settings(BaseSettings):
     )
     TELEGRAM_WEBHOOK_URL: Optional[str] = Field(default=None, env="TELEGRAM_WEBHOOK_URL")
     TELEGRAM_DEV_CHAT_ID: Optional[Union[int, str]] = Field(default=None, env="TELEGRAM_DEV_CHAT_ID")
+    # updates (of different chats) processed concurrently by the bot
+    TELEGRAM_CONCURRENT_UPDATES: int = Field(default=16, env="TELEGRAM_CONCURRENT_UPDATES")
+    # seconds without new photos after which an album (media group) is complete
+    TELEGRAM_MEDIA_GROUP_WINDOW: float = Field(default=1.0, env="TELEGRAM_MEDIA_GROUP_WINDOW")
+
+    # SQLite database shared by the bot replicas (the state is kept in memory when not set)
+    BOT_STATE_PATH: Optional[str] = Field(default=None, env="BOT_STATE_PATH")
+    # seconds the writes are batched before the other replicas see them (conversation state transitions are written
+    # through, along with the writes pending before them)
+    BOT_STATE_FLUSH_INTERVAL: float = Field(default=1.0, env="BOT_STATE_FLUSH_INTERVAL")
+    BOT_LOCATION_TTL: float = Field(default=3600, env="BOT_LOCATION_TTL")
+    BOT_CONVERSATION_TTL: float = Field(default=86400, env="BOT_CONVERSATION_TTL")
+    # seconds a photo (or album) waits for the location, it is dropped after that
+    BOT_PENDING_PHOTO_TTL: float = Field(default=600, env="BOT_PENDING_PHOTO_TTL")
+
+    # on-demand profiling of single API requests (`X-Profile` header), allowed to callers sending this token in the
+    # `X-Admin-Token` header; disabled when not set. The latest PROFILE_KEEP profiles are kept in PROFILE_DIR.
+    PROFILE_TOKEN: Optional[str] = Field(default=None, env="PROFILE_TOKEN")
+    PROFILE_DIR: str = Field(default=os.path.join(tempfile.gettempdir(), "img2card-profiles"), env="PROFILE_DIR")
+    PROFILE_KEEP: int = Field(default=20, env="PROFILE_KEEP")
 
     CONTAINER_APP_NAME: str = Field(default="debug", env="CONTAINER_APP_NAME")
 
     API_URL: str = Field(default="http://localhost:8000", env="API_URL")
     APP_URL: str = Field(default="http://localhost:3000", env="APP_URL")
 
-    @computed_field
     @cached_property
-    def LANGSMITH_TRACER(self) -> Optional[LangChainTracer]:
+    def LANGSMITH_TRACER(self) -> Optional["SampledTracer"]:
         return get_langsmith_tracer(self)
 
 
@@ -52,11 +129,11 @@ def get_settings() -> Settings:
     return Settings()
 
 
-def get_langsmith_tracer(settings) -> Optional[LangChainTracer]:
+def get_langsmith_tracer(settings) -> Optional["SampledTracer"]:
     if settings.LANGSMITH_API_KEY:
-        from langsmith import Client
-        return LangChainTracer(
-            project_name=settings.LANGSMITH_PROJECT,
-            client=Client(api_url=settings.LANGSMITH_ENDPOINT, api_key=settings.LANGSMITH_API_KEY),
-        )
+        # imported lazily, so the bot (which does not use langchain) does not pay for it on startup
+        from src.tracing import create_tracer
+        return create_tracer(settings.LANGSMITH_ENDPOINT, settings.LANGSMITH_API_KEY, settings.LANGSMITH_PROJECT,
+                             settings.LANGSMITH_SAMPLE_RATE, settings.LANGSMITH_TRACE_ERRORS,
+                             settings.LANGSMITH_IMAGES)
     return None
@@ -0,0 +1,57 @@
+import copy
+from concurrent.futures import Future
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, List
+
+from src.metrics import metrics
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the call while the others wait for it and
+    share its result or exception. Nothing is kept once the call finishes (it is not a cache).
+
+    Callers of a shared result get their own (deep) copy of it, so they can update it freely.
+    The number of collapsed calls is counted in the `singleflight.<name>.collapsed` metric.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        # key -> (future of the call, only created once a caller waits for it, number of callers waiting for it)
+        self._calls: Dict[Hashable, List] = {}
+        self._lock = Lock()
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [None, 0]
+            else:
+                if call[0] is None:
+                    call[0] = Future()
+                call[1] += 1
+
+        if not leader:
+            metrics.increment(f"singleflight.{self._name}.collapsed")
+            return copy.deepcopy(call[0].result())
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                future = self._calls.pop(key)[0]
+            if future is not None:
+                future.set_exception(e)
+            raise
+        with self._lock:
+            future = self._calls.pop(key)[0]
+        # without waiters the result is not shared, no copy needed
+        if future is None:
+            return result
+        future.set_result(result)
+        return copy.deepcopy(result)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,69 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Dict, Iterator, Optional
+
+
+class StageTimings:
+    """
+    Wall-clock durations (in milliseconds) of the pipeline stages of a single request.
+
+    The instance is bound to the current context with `activate`, so any code running on behalf of the request
+    (including langchain runnables executed in a thread pool) can record stages through `track_stage`.
+    """
+
+    def __init__(self):
+        self._durations: Dict[str, float] = {}
+        self._lock = Lock()
+
+    def add(self, stage: str, duration_ms: float) -> None:
+        with self._lock:
+            self._durations[stage] = self._durations.get(stage, 0.0) + duration_ms
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, (time.perf_counter() - start) * 1000)
+
+    @contextmanager
+    def activate(self) -> Iterator["StageTimings"]:
+        token = _current_timings.set(self)
+        try:
+            yield self
+        finally:
+            _current_timings.reset(token)
+
+    @property
+    def durations(self) -> Dict[str, float]:
+        with self._lock:
+            return {stage: round(duration, 1) for stage, duration in self._durations.items()}
+
+    def server_timing(self) -> str:
+        """
+        Formats the durations as a `Server-Timing` header value (e.g. "vision;dur=812.3, places;dur=401.0").
+        """
+        return ", ".join(f"{stage};dur={duration}" for stage, duration in self.durations.items())
+
+
+_current_timings: ContextVar[Optional[StageTimings]] = ContextVar("stage_timings", default=None)
+
+
+def current_timings() -> Optional[StageTimings]:
+    return _current_timings.get()
+
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """
+    Records the duration of the enclosed block on the active `StageTimings`, if any.
+    """
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    with timings.stage(stage):
+        yield
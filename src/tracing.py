@@ -0,0 +1,119 @@
+import random
+from typing import Any, Callable, Dict, List, Literal, Optional
+from uuid import UUID
+
+from langchain_core.load import Serializable, dumpd
+from langchain_core.messages import BaseMessage
+from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.tracers import LangChainTracer
+from langchain_core.tracers.schemas import Run
+
+from src.metrics import metrics
+
+
+# base64 characters of each image kept in the traces with the "truncate" mode
+TRUNCATED_IMAGE_CHARS = 100
+
+
+def redact_images(keep_chars: Optional[int]) -> Callable[[Any], Any]:
+    """
+    Copies a run payload with the base64 data of its data URLs (the images of the vision prompt) cut to
+    `keep_chars` (kept whole when None), to be used as the LangSmith client `hide_inputs` / `hide_outputs`.
+
+    Messages and prompt values are serialized here, with their images already cut.
+    """
+    def _redact(value: Any) -> Any:
+        if isinstance(value, str):
+            if keep_chars is not None and value.startswith("data:") and "," in value:
+                header, data = value.split(",", 1)
+                if len(data) > keep_chars:
+                    return f"{header},{data[:keep_chars]}... ({len(data)} chars)"
+            return value
+        if isinstance(value, dict):
+            return {key: _redact(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [_redact(item) for item in value]
+        if isinstance(value, BaseMessage):
+            return dumpd(value.copy(update={"content": _redact(value.content)}))
+        if isinstance(value, ChatPromptValue):
+            return {"messages": [_redact(message) for message in value.messages]}
+        if isinstance(value, Serializable):
+            return _redact(dumpd(value))
+        return value
+
+    return _redact
+
+
+class SampledTracer(LangChainTracer):
+    """
+    LangSmith tracer of a sample of the traces: each trace (a root run and its children) is uploaded with
+    probability `sample_rate`. With `trace_errors`, the finished runs of the traces left out are kept in memory
+    until the root run finishes, and uploaded anyway when it failed.
+
+    Counts `tracing.sampled`, `tracing.skipped` and `tracing.errors` (failed traces uploaded out of the sample).
+
+    Overrides private methods of `LangChainTracer` (no public hook decides whether a run is uploaded), hence
+    langchain-core is pinned in environment.yml; `tests/test_tracing.py` fails when an upgrade changes them.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, trace_errors: bool = True, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.sample_rate = sample_rate
+        self.trace_errors = trace_errors
+        # finished runs of the traces not sampled, by trace id
+        self._skipped: Dict[UUID, List[Run]] = {}
+        self._messages: Dict[UUID, List[List[BaseMessage]]] = {}
+
+    def _start_trace(self, run: Run) -> None:
+        super()._start_trace(run)
+        if run.id == run.trace_id:
+            if random.random() < self.sample_rate:
+                metrics.increment("tracing.sampled")
+            else:
+                self._skipped[run.trace_id] = []
+                metrics.increment("tracing.skipped")
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[BaseMessage]], *, run_id: UUID,
+                            **kwargs: Any) -> Run:
+        # the messages (and their images) are only serialized if the run is uploaded, by the client `redact_images`
+        self._messages[run_id] = messages
+        try:
+            return super().on_chat_model_start(serialized, [[] for _ in messages], run_id=run_id, **kwargs)
+        finally:
+            # taken by `_on_chat_model_start`, unless the run could not be started
+            self._messages.pop(run_id, None)
+
+    def _on_chat_model_start(self, run: Run) -> None:
+        run.inputs = {"messages": self._messages.pop(run.id)}
+        super()._on_chat_model_start(run)
+
+    def _persist_run_single(self, run: Run) -> None:
+        if run.trace_id not in self._skipped:
+            super()._persist_run_single(run)
+
+    def _update_run_single(self, run: Run) -> None:
+        if run.trace_id not in self._skipped:
+            super()._update_run_single(run)
+            return
+        if run.id != run.trace_id:
+            if self.trace_errors:
+                self._skipped[run.trace_id].append(run)
+            return
+        runs = self._skipped.pop(run.trace_id) + [run]
+        if run.error and self.trace_errors:
+            metrics.increment("tracing.errors")
+            # the runs have finished, so each one is uploaded whole (with its outputs or error), parents first
+            for finished in sorted(runs, key=lambda finished: finished.dotted_order):
+                super()._persist_run_single(finished)
+
+
+def create_tracer(api_url: str, api_key: str, project_name: str, sample_rate: float = 1.0,
+                  trace_errors: bool = True,
+                  images: Literal["keep", "truncate", "redact"] = "truncate") -> SampledTracer:
+    """
+    Tracer to LangSmith, with the images of the traces kept whole, truncated or redacted.
+    """
+    from langsmith import Client
+    hide = redact_images({"keep": None, "truncate": TRUNCATED_IMAGE_CHARS, "redact": 0}[images])
+    client = Client(api_url=api_url, api_key=api_key, hide_inputs=hide, hide_outputs=hide)
+    return SampledTracer(sample_rate, trace_errors, project_name=project_name, client=client)
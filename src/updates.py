@@ -0,0 +1,65 @@
+import asyncio
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes the updates of different chats concurrently, at most `max_concurrent_updates` at a time, and the
+    updates of the same chat one at a time in arrival order, so the conversation states stay consistent.
+
+    The chat ordering is applied before the concurrency limit, so the queued updates of a busy chat do not take
+    the slots of the other chats. The base class semaphore only bounds the updates admitted (`max_pending_updates`).
+    """
+
+    # set once the base class is initialized (its semaphore is sized by `max_concurrent_updates`)
+    _concurrency: Optional[int] = None
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = 1024):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        super().__init__(max(max_concurrent_updates, max_pending_updates))
+        self._concurrency = max_concurrent_updates
+        self._workers = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # chat -> (lock, number of updates of the chat admitted)
+        self._chats: Dict[Hashable, list] = {}
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._concurrency or self._max_concurrent_updates
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[Hashable]:
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            async with self._workers:
+                await coroutine
+            return
+
+        chat = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        chat[1] += 1
+        try:
+            # asyncio locks are fair, the updates of the chat run in the order they were admitted
+            async with chat[0]:
+                async with self._workers:
+                    await coroutine
+        finally:
+            chat[1] -= 1
+            if chat[1] == 0:
+                del self._chats[key]
+
+    def pending_chats(self) -> int:
+        return len(self._chats)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
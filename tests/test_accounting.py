@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+LOW_DETAIL_BUDGET = {"llm_calls": 2, "prompt_tokens": 900, "completion_tokens": 100, "serpapi_searches": 2,
+                     "geoapify_calls": 1, "geoapify_batch_jobs": 0}
+
+
+@pytest.mark.parametrize("detail, budget", [
+    ("low", LOW_DETAIL_BUDGET),
+    ("high", LOW_DETAIL_BUDGET | {"prompt_tokens": 1600}),
+    # the transcription is usable, so never escalated to high detail
+    ("adaptive", LOW_DETAIL_BUDGET),
+])
+def test_card_usage_budget(upstream, tmp_path, detail: str, budget: dict):
+    """
+    Replays a card against the stand-in upstreams, failing when a change makes it more expensive.
+    """
+    from benchmarks.load import make_photo
+    from src.accounting import Usage, track_usage
+    from src.llm.agent import CardAgent
+    from src.settings import Settings
+
+    settings = Settings(AZURE_OPENAI_API_KEY="fake", AZURE_OPENAI_API_BASE=upstream.state.url, TELEGRAM_TOKEN="fake",
+                        SERPAPI_API_KEY="fake", GEOAPIFY_API_KEY="fake", LANGSMITH_API_KEY=None,
+                        IMAGE_EXECUTOR="thread", _env_file=None)
+    photo = tmp_path / "photo.jpg"
+    photo.write_bytes(make_photo(640, 480))
+
+    async def create_card():
+        with track_usage("replay") as usage:
+            card = await CardAgent(settings).create_card(str(photo), 39.8883636, 4.2652852, detail=detail)
+        return card, usage
+
+    card, usage = asyncio.run(create_card())
+
+    assert card and "BEGIN:VCARD" in card
+    assert usage.llm_calls == upstream.state.calls["azure"]
+    assert usage.serpapi_searches == upstream.state.calls["serpapi"]
+    assert usage.over_budget(Usage(**budget)) == []
@@ -1,20 +1,153 @@
-import types
-from unittest.mock import AsyncMock
+import asyncio
+import json
+import time
 
 import pytest
 from pytest_mock import MockerFixture
 
 
 @pytest.mark.asyncio
-async def test_generate_vision(mocker: MockerFixture, exif_image_path: str, vision_venue_data: str, mocked_client_ainvoke: AsyncMock):
-    settings = mocker.MagicMock()
-    response = types.SimpleNamespace()
-    response.content = vision_venue_data
-    mocked_client_ainvoke.return_value = response
+async def test_generate_vision(mocker: MockerFixture, settings, vision_venue_data: str):
+    # the vision deployment answers with the structured output (a tool call) of the transcription
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from langchain_openai import AzureChatOpenAI
+    from src.llm.agent import ToolFactory
+    from src.llm.schemas import VisionTranscription
+    venue = json.loads(vision_venue_data.strip("`").removeprefix("json"))
+    message = AIMessage(content="", tool_calls=[{"name": "VisionTranscription", "args": venue, "id": "call"}])
+    generate = mocker.patch.object(AzureChatOpenAI, "_agenerate",
+                                   return_value=ChatResult(generations=[ChatGeneration(message=message)]))
+
+    tool = ToolFactory(settings)
+    vision = await tool.image_transcription.ainvoke({"image_url": "data:image/png;base64,", "detail": "low"})
+
+    generate.assert_awaited_once()
+    assert vision == VisionTranscription(**venue)
+
 
+@pytest.mark.parametrize("route, deployment", [("agent", "instruct"), ("vision", "vision")])
+def test_card_generation_route(settings, route: str, deployment: str):
     from src.llm.agent import ToolFactory
+    settings.CARD_GENERATION_ROUTE = route
+    settings.AZURE_OPENAI_MAX_TOKENS_AGENT = 300
     tool = ToolFactory(settings)
-    vision = await tool.generate_vision(exif_image_path)
 
-    mocked_client_ainvoke.assert_called_once()
-    assert vision == vision_venue_data
+    vision_llm = tool.image_transcription.steps[1]
+    card_llm = tool.card_generation.steps[1]
+    assert vision_llm.deployment_name == "vision"
+    assert card_llm.deployment_name == deployment
+    assert card_llm.max_tokens == (300 if route == "agent" else 500)
+
+
+@pytest.fixture()
+def vision_details(fake_card_tools) -> list:
+    # fake vision chain: empty transcription at low detail, venue found at high detail
+    from src.llm.schemas import VisionTranscription
+    details = []
+
+    async def _transcribe(inputs: dict):
+        details.append(inputs["detail"])
+        return VisionTranscription(venue_name="Forn del St. Cristo" if inputs["detail"] == "high" else "")
+
+    fake_card_tools(image_transcription=_transcribe)
+    return details
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("detail, expected_details", [("adaptive", ["low", "high"]), ("low", ["low"]), ("high", ["high"])])
+async def test_transcribe_detail(settings, vision_details: list, detail: str, expected_details: list):
+    from src.llm.agent import CardAgent
+    from src.metrics import metrics
+    metrics.reset()
+    agent = CardAgent(settings)
+
+    transcription = await agent._transcribe({"detail": detail, "size": (4000, 3000)}, {})
+
+    assert vision_details == expected_details
+    assert metrics.counter("vision.adaptive.escalated") == (1 if detail == "adaptive" else 0)
+    if detail != "low":
+        assert transcription.venue_name == "Forn del St. Cristo"
+
+
+@pytest.mark.parametrize("transcription, usable", [
+    ({"venue_name": "Bakery One", "venue_type": "Bakery"}, True),
+    ({"name": "Ana Parra", "phone": "+34111222333"}, True),
+    ({"venue_name": " ", "venue_type": ""}, False),
+    ({"venue_type": "Bakery"}, False),
+    (None, False),
+])
+def test_is_usable(transcription, usable: bool):
+    from src.llm.agent import CardAgent
+    from src.llm.schemas import VisionTranscription
+    transcription = VisionTranscription(**transcription) if transcription is not None else None
+    assert CardAgent._is_usable(transcription) == usable
+
+
+def test_contact_card_to_vcard():
+    from src.llm.schemas import ContactCard
+    card = ContactCard(formatted_name="Bakery One", category="Cake Shop", phone="+349876543210",
+                       address="123 Main Street, Ciutadella; Menorca", email=" ")
+
+    vcard = card.to_vcard().split("\n")
+
+    assert vcard[0] == "BEGIN:VCARD" and vcard[-1] == "END:VCARD"
+    assert "FN:Bakery One" in vcard
+    assert "TEL;TYPE=work,voice:+349876543210" in vcard
+    assert "ADR;TYPE=work:;;123 Main Street\\, Ciutadella\\; Menorca;;;;" in vcard
+    assert not any(line.startswith("EMAIL") for line in vcard)
+
+
+@pytest.mark.asyncio
+async def test_create_card_places_deadline(settings, fake_card_tools):
+    # the places search outlives the deadline: the card is created from the transcription alone
+    from src.llm.agent import CardAgent
+    from src.llm.schemas import ContactCard, VisionTranscription
+    from src.metrics import metrics
+    card_inputs = []
+
+    async def _search_venue(inputs: dict):
+        await asyncio.sleep(10)
+
+    def _generate_card(inputs: dict):
+        card_inputs.append(inputs)
+        return ContactCard(formatted_name="Bakery One", phone="+34111222333")
+
+    image_path = fake_card_tools(
+        image_transcription=lambda inputs: VisionTranscription(venue_name="Bakery One", phone="+34111222333"),
+        venue_description=_search_venue, card_generation=_generate_card)
+    metrics.reset()
+    settings.IMAGE_EXECUTOR, settings.REQUEST_DEADLINE, settings.CARD_GENERATION_RESERVE = "thread", 1.0, 0.5
+
+    start = time.perf_counter()
+    card = await CardAgent(settings).create_card(image_path, 39.88, 4.26)
+
+    assert time.perf_counter() - start < 1.0
+    assert "FN:Bakery One" in card
+    assert "Bakery One" in card_inputs[0]["vision_transcription"]
+    assert metrics.counter("deadline.places.exceeded") == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("level, detail, expected_details, places", [
+    (0, "adaptive", ["low", "high"], True), (2, "high", ["high"], False), (3, "adaptive", ["low"], False)])
+async def test_create_card_degradation(settings, fake_card_tools, vision_details: list, level: int, detail: str,
+                                       expected_details: list, places: bool):
+    from src.llm.agent import CardAgent
+    from src.llm.schemas import ContactCard
+    venue_inputs = []
+
+    def _search_venue(inputs: dict):
+        venue_inputs.append(inputs)
+        return {"vision_transcription": "{}"}
+
+    image_path = fake_card_tools(venue_description=_search_venue,
+                                 card_generation=lambda inputs: ContactCard(formatted_name="Forn"))
+    settings.IMAGE_EXECUTOR = "thread"
+
+    from src.degradation import DegradationLevel
+    card = await CardAgent(settings).create_card(image_path, 39.88, 4.26, detail, level=DegradationLevel(level))
+
+    assert "FN:Forn" in card
+    assert vision_details == expected_details
+    assert bool(venue_inputs) == places
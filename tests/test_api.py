@@ -0,0 +1,204 @@
+from io import BytesIO
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from src.timing import track_stage
+
+VCARD = "BEGIN:VCARD\nVERSION:3.0\nFN:Bakery One\nTEL;TYPE=work,voice:+349876543210\nEND:VCARD"
+
+
+class FakeAgent:
+    def __init__(self):
+        self.calls = []
+        self.warm = False
+
+    async def warmup(self):
+        self.warm = True
+
+    async def keep_warm(self):
+        pass
+
+    def degradation_level(self):
+        from src.degradation import DegradationLevel
+        return DegradationLevel.NO_PLACES
+
+    async def reverse_geocode_images(self, image_paths):
+        self.geocoded = image_paths
+        return {image_paths[0]: {"name": "Bakery One"}}
+
+    async def create_card(self, image_path: str, lat: float, lon: float, detail: str = "low", run_name=None,
+                          level=None, place=None):
+        from src.progress import TRANSCRIBED, report_progress
+        self.calls.append({"lat": lat, "lon": lon, "detail": detail, "run_name": run_name, "level": level,
+                           "place": place})
+        with track_stage("vision"):
+            pass
+        report_progress(TRANSCRIBED, venue="Bakery One")
+        return VCARD
+
+
+@pytest.fixture()
+def png_bytes() -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (32, 32), "white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture()
+def client_agent():
+    from src.api import app, image_executor
+    from src.imaging import get_image_executor
+    from src.llm.agent import build_agent
+
+    agent = FakeAgent()
+    app.dependency_overrides[build_agent] = lambda: agent
+    app.dependency_overrides[image_executor] = lambda: get_image_executor("thread", 1)
+    yield TestClient(app), agent
+    app.dependency_overrides.clear()
+
+
+def test_get_ics_card_server_timing(client_agent, png_bytes: bytes):
+    client, agent = client_agent
+    response = client.post("/get_ics_card/", params={"latitude": 39.88, "longitude": 4.26},
+                           files={"photo": ("photo.png", png_bytes, "image/png")})
+
+    assert response.status_code == 200
+    assert "FN:Bakery One" in response.text
+    stages = [metric.split(";")[0] for metric in response.headers["Server-Timing"].split(", ")]
+    assert {"total", "upload", "exif", "vision"} <= set(stages)
+    assert agent.calls[0]["run_name"]
+    assert response.headers["X-Degradation-Level"] == "no_places" and agent.calls[0]["level"] == 2
+    assert response.headers["X-Upstream-Usage"].startswith("llm_calls=0, prompt_tokens=0")
+
+
+def test_get_ics_card_timings_log(client_agent, png_bytes: bytes):
+    from loguru import logger
+
+    client, agent = client_agent
+    records = []
+    sink_id = logger.add(lambda message: records.append(message.record), filter=lambda record: "timings" in record["extra"])
+    try:
+        client.post("/get_ics_card/", params={"latitude": 39.88, "longitude": 4.26},
+                    files={"photo": ("photo.png", png_bytes, "image/png")})
+    finally:
+        logger.remove(sink_id)
+
+    assert len(records) == 1
+    assert records[0]["extra"]["run_name"] == agent.calls[0]["run_name"]
+    assert "vision" in records[0]["extra"]["timings"]
+
+
+def test_get_ics_card_agent_gave_up(client_agent, png_bytes: bytes, mocker):
+    client, agent = client_agent
+    # the agent returns None once the deadline is exceeded
+    mocker.patch.object(agent, "create_card", mocker.AsyncMock(return_value=None))
+    response = client.post("/get_ics_card/", params={"latitude": 39.88, "longitude": 4.26},
+                           files={"photo": ("photo.png", png_bytes, "image/png")})
+
+    assert response.status_code == 504
+    assert response.json() == {"detail": "No se pudo generar la tarjeta a tiempo."}
+
+
+def test_lifespan_warms_up_agent(mocker):
+    from src.api import app
+
+    agent = FakeAgent()
+    mocker.patch("src.api.build_agent", return_value=agent)
+    with TestClient(app) as client:
+        assert agent.warm
+        assert client.get("/health").status_code == 200
+
+
+@pytest.mark.parametrize("mode", ["sampling", "deterministic"])
+def test_get_ics_card_profile(client_agent, png_bytes: bytes, settings, mocker, tmp_path, mode: str):
+    client, agent = client_agent
+    settings.PROFILE_TOKEN, settings.PROFILE_DIR = "secret", str(tmp_path)
+    mocker.patch("src.api.get_settings", return_value=settings)
+    admin = {"X-Admin-Token": "secret"}
+
+    response = client.post("/get_ics_card/", params={"latitude": 39.88, "longitude": 4.26},
+                           files={"photo": ("photo.png", png_bytes, "image/png")}, headers={"X-Profile": mode} | admin)
+
+    assert response.status_code == 200
+    name = response.headers["X-Profile"]
+    assert name.startswith(agent.calls[0]["run_name"])
+    profiles = client.get("/profiles", headers=admin).json()
+    assert [(profile["name"], profile["mode"]) for profile in profiles] == [(name, mode)]
+    assert client.get(f"/profiles/{name}", headers=admin).content == (tmp_path / name).read_bytes()
+    assert client.get("/profiles/unknown.prof", headers=admin).status_code == 404
+
+
+def test_get_ics_card_profile_not_allowed(client_agent, png_bytes: bytes, settings, mocker, tmp_path):
+    client, agent = client_agent
+    settings.PROFILE_TOKEN, settings.PROFILE_DIR = "secret", str(tmp_path)
+    mocker.patch("src.api.get_settings", return_value=settings)
+
+    response = client.post("/get_ics_card/", params={"latitude": 39.88, "longitude": 4.26},
+                           files={"photo": ("photo.png", png_bytes, "image/png")},
+                           headers={"X-Profile": "sampling", "X-Admin-Token": "guess"})
+
+    assert response.status_code == 403 and not agent.calls
+    assert client.get("/profiles").status_code == 403
+    assert list(tmp_path.iterdir()) == []
+    # not profiled without the header, the settings are not even read
+    mocker.patch("src.api.get_settings", side_effect=AssertionError)
+    response = client.post("/get_ics_card/", params={"latitude": 39.88, "longitude": 4.26},
+                           files={"photo": ("photo.png", png_bytes, "image/png")})
+    assert response.status_code == 200 and "X-Profile" not in response.headers
+
+
+def test_stream_ics_card(client_agent, png_bytes: bytes):
+    import asyncio
+
+    from src.progress import read_events
+
+    client, agent = client_agent
+    response = client.post("/get_ics_card/stream", params={"latitude": 39.88, "longitude": 4.26},
+                           files={"photo": ("photo.png", png_bytes, "image/png")})
+
+    async def _events():
+        async def _lines():
+            for line in response.content.splitlines(keepends=True):
+                yield line
+        return [event async for event in read_events(_lines())]
+
+    events = asyncio.run(_events())
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert [event.event for event in events] == ["received", "transcribed", "card"]
+    assert events[0].data["run_name"] == agent.calls[0]["run_name"]
+    assert events[1].data == {"venue": "Bakery One"}
+    assert "FN:Bakery One" in events[2].data["vcard"] and events[2].data["filename"] == "Bakery One.vcf"
+
+
+def test_stream_ics_cards(client_agent, png_bytes: bytes):
+    import asyncio
+
+    from src.progress import read_events
+
+    client, agent = client_agent
+    response = client.post("/get_ics_cards/stream",
+                           params=[("latitude", 39.88), ("longitude", 4.26), ("detail", "low"), ("detail", "high")],
+                           files=[("photos", ("one.png", png_bytes, "image/png")),
+                                  ("photos", ("two.png", png_bytes, "image/png"))])
+
+    async def _events():
+        async def _lines():
+            for line in response.content.splitlines(keepends=True):
+                yield line
+        return [event async for event in read_events(_lines())]
+
+    events = asyncio.run(_events())
+    assert [event.event for event in events] == ["received", "card", "card"]
+    assert events[0].data["photos"] == 2
+    assert sorted(event.data["index"] for event in events[1:]) == [0, 1]
+    # both images geocoded in a single batch, each card given its place
+    assert len(agent.geocoded) == 2
+    calls = sorted(agent.calls, key=lambda call: call["run_name"])
+    assert [call["detail"] for call in calls] == ["low", "high"]
+    assert [call["place"] for call in calls] == [{"name": "Bakery One"}, None]
+
+    response = client.post("/get_ics_cards/stream", params=[("detail", "low")] * 3,
+                           files=[("photos", ("one.png", png_bytes, "image/png"))] * 2)
+    assert response.status_code == 422
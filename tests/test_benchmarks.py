@@ -0,0 +1,41 @@
+import subprocess
+import sys
+import types
+
+from benchmarks.fakes import UpstreamProfile
+
+
+def test_upstream_profile_parse():
+    profile = UpstreamProfile.parse("800:0.3:0.01:429")
+    assert profile == UpstreamProfile(latency_ms=800, jitter=0.3, error_rate=0.01, error_status=429)
+    assert UpstreamProfile.parse("80") == UpstreamProfile(latency_ms=80)
+
+
+def test_micro_compare():
+    from benchmarks.micro import compare
+    baselines = {"calibration": 100.0, "encode": 10.0, "parse": 1.0}
+
+    # twice as slow machine: baselines are scaled before applying the threshold
+    assert compare({"calibration": 200.0, "encode": 24.0, "parse": 2.0}, baselines, 0.25) == []
+    regressions = compare({"calibration": 100.0, "encode": 13.0, "parse": 1.0, "new_case": 5.0}, baselines, 0.25)
+    assert len(regressions) == 1 and regressions[0].startswith("encode")
+
+
+def test_micro_gate():
+    # the stored baselines hold on the tree they ship with (shorter rounds than the default, about 30 s)
+    process = subprocess.run([sys.executable, "-m", "benchmarks.micro", "--repeat", "3", "--min-time", "0.2"],
+                             capture_output=True, text=True)
+    assert process.returncode == 0, process.stdout + process.stderr
+
+
+def test_stand_in_upstreams(upstream):
+    settings = types.SimpleNamespace(SERPAPI_API_KEY="fake", GEOAPIFY_API_KEY="fake")
+
+    from src.llm.places import GeoapifyHelper, SerpapiHelper
+    locals = SerpapiHelper.search_by_uule(settings, "bakery", "uule")
+    place = SerpapiHelper.search_by_place_id(settings, "bakery", locals[0]["place_id"])
+    address = GeoapifyHelper.reverse_geocode(settings, 39.8883636, 4.2652852)
+
+    assert locals[0]["title"] == "Bakery One"
+    assert place["type"] == "Restaurant"
+    assert address["country"] == "Spain"
@@ -0,0 +1,102 @@
+import asyncio
+from datetime import datetime
+from unittest.mock import ANY, AsyncMock, MagicMock
+
+import pytest
+
+from benchmarks.startup import FAKE_ENV
+
+
+@pytest.fixture()
+def bot(monkeypatch):
+    from src.albums import MediaGroupBuffer
+    from src.persistence import MemoryStateStore, StoreMapping
+    from src.settings import get_settings
+
+    for name, value in FAKE_ENV.items():
+        monkeypatch.setenv(name, value)
+    get_settings.cache_clear()
+    import src.bot as bot
+
+    # the photos wait 50 ms for the location
+    store = MemoryStateStore()
+    monkeypatch.setattr(bot, "locations", StoreMapping(store, "location"))
+    monkeypatch.setattr(bot, "pending_photos", StoreMapping(store, "pending_photo", ttl=0.05))
+    monkeypatch.setattr(bot, "album_buffer", MediaGroupBuffer(store, window=0.01, ttl=0.05))
+    yield bot
+    get_settings.cache_clear()
+
+
+def _update(message_id: int, media_group_id=None, location=None):
+    update = MagicMock()
+    update.effective_chat.id = 1
+    update.effective_user.id = 7
+    update.message.message_id = message_id
+    update.message.media_group_id = media_group_id
+    update.message.photo = [MagicMock(file_id=f"file-{message_id}")]
+    update.message.location = location
+    update.message.reply_text = AsyncMock()
+    return update
+
+
+@pytest.mark.asyncio
+async def test_album_abandoned_before_location(bot, monkeypatch):
+    from telegram import Location
+
+    handle_album = AsyncMock()
+    monkeypatch.setattr(bot, "_handle_album", handle_album)
+    context = MagicMock()
+
+    assert await bot.album_photo(_update(1, "album"), context) == bot.NO_GPS
+    assert await bot.album_photo(_update(2, "album"), context) == bot.NO_GPS
+    await asyncio.sleep(0.1)
+
+    # the album is dropped, the location is kept for the next photos
+    update = _update(3, location=Location(4.26, 39.88))
+    assert await bot.location(update, context) == bot.PHOTO
+    handle_album.assert_not_awaited()
+    update.message.reply_text.assert_awaited_with("Envíame de nuevo la imagen.", reply_markup=ANY)
+    assert (1, "album") not in bot.album_buffer
+    assert 7 in bot.locations
+
+
+def test_new_photo_while_waiting_for_location(bot):
+    from telegram import Chat, Message, PhotoSize, Update, User
+
+    handler = bot.build_conversation_handler()
+    handler._update_state(bot.NO_GPS, (1, 7))
+    message = Message(1, datetime.now(), Chat(1, Chat.PRIVATE), from_user=User(7, "user", False),
+                      photo=[PhotoSize("file", "unique", 32, 32)])
+
+    # a photo that is not part of the album waiting for the location replaces it
+    assert handler.check_update(Update(1, message=message)) is not None
+
+
+@pytest.mark.asyncio
+async def test_document_read_off_event_loop(bot, monkeypatch):
+    import threading
+
+    from PIL import Image
+
+    def read_coordinates(image):
+        threads.append(threading.current_thread())
+        assert Image.open(image).size == (8, 8)
+        return None, None
+
+    threads = []
+    monkeypatch.setattr(bot, "read_coordinates", read_coordinates)
+
+    async def download_to_memory(out):
+        Image.new("RGB", (8, 8)).save(out, format="PNG")
+
+    file = MagicMock(file_id="document")
+    file.download_to_memory = download_to_memory
+    context = MagicMock()
+    context.bot.get_file = AsyncMock(return_value=file)
+    update = _update(1)
+    update.message.photo = []
+
+    # the document has no GPS and the location is unknown -> asks for it
+    assert await bot.photo(update, context) == bot.NO_GPS
+    assert threads and threads[0] is not threading.main_thread()
+    assert bot.pending_photos[1] == {"file_id": "document"}
@@ -0,0 +1,136 @@
+import time
+
+import pytest
+from pytest_mock import MockerFixture
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def cache(request, tmp_path):
+    from src.cache import create_cache
+    if request.param == "redis":
+        from benchmarks.fakes import FakeRedisServer
+        with FakeRedisServer() as server:
+            cache = create_cache(server.url)
+            yield cache
+            cache.close()
+    else:
+        yield create_cache({"memory": "memory://", "sqlite": f"sqlite:///{tmp_path}/cache.db"}[request.param])
+
+
+def test_cache(cache):
+    cache.set("a", {"city": "Maó"})
+    cache.set_many({"b": [1, 2], "c": "expiring"}, ttl=0.05)
+    cached = cache.get("a")
+    cached["city"] = "changed"
+    time.sleep(0.1)
+
+    assert cache.get("a") == {"city": "Maó"}
+    assert cache.get_many(["a", "b", "c", "d"]) == {"a": {"city": "Maó"}}
+    cache.delete("a")
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert stats.hits == 3 and stats.misses == 4 and stats.sets == 3
+    assert stats.entries == 0
+
+
+def test_cache_not_json(cache):
+    import pickle
+    from src.cache import MemoryCache, SQLiteCache
+
+    # e.g. written by an older version, or by anyone else with access to a shared cache
+    blob = pickle.dumps({"city": "Maó"})
+    if isinstance(cache, MemoryCache):
+        cache._entries["a"] = (blob, None)
+    elif isinstance(cache, SQLiteCache):
+        with cache._connection() as connection:
+            connection.execute("INSERT INTO cache VALUES (?, ?, ?, ?, ?)", ("a", blob, len(blob), None, time.time()))
+    else:
+        cache._execute(("SET", "a", blob))
+
+    assert cache.get("a") is None
+    assert cache.get_or_set("a", lambda: {"city": "Maó"}) == {"city": "Maó"}
+    assert cache.get("a") == {"city": "Maó"}
+    stats = cache.stats()
+    assert stats.hits == 1 and stats.misses == 2
+
+
+def test_remote_cache_down():
+    import socket
+    from src.cache import RemoteCache
+
+    # a port nobody listens on
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    cache = RemoteCache("127.0.0.1", port, timeout=0.5)
+
+    assert cache.get_or_set("place", lambda: {"title": "Bakery One"}) == {"title": "Bakery One"}
+    # the counters of this process, the server ones can not be read
+    stats = super(RemoteCache, cache).stats()
+    assert stats.misses == 1 and stats.errors == 2
+
+
+def test_cache_eviction(tmp_path):
+    from src.cache import create_cache
+    for url in ("memory://?max_bytes=1000", f"sqlite:///{tmp_path}/cache.db?max_bytes=1000"):
+        cache = create_cache(url)
+        for key in range(10):
+            cache.set(str(key), "x" * 200)
+            cache.get("0")
+
+        stats = cache.stats()
+        assert cache.get("0") is not None and cache.get("1") is None
+        assert stats.size_bytes <= 1000 and stats.evictions == 10 - stats.entries
+
+
+def test_create_sqlite_cache_paths(tmp_path, monkeypatch):
+    from src.cache import create_cache
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "relative").mkdir()
+
+    # as in SQLAlchemy: three slashes for a relative path, four for an absolute one
+    create_cache("sqlite:///relative/cache.db").set("a", 1)
+    create_cache(f"sqlite:///{tmp_path}/absolute.db?max_bytes=1000").set("b", 2)  # tmp_path starts with a slash
+
+    assert (tmp_path / "relative" / "cache.db").exists() and (tmp_path / "absolute.db").exists()
+    for url in ("sqlite://host/cache.db", "sqlite://"):
+        with pytest.raises(ValueError):
+            create_cache(url)
+
+
+def test_sqlite_cache_sums_size_seldom(tmp_path):
+    from src.cache import SQLiteCache
+    cache = SQLiteCache(str(tmp_path / "cache.db"), max_bytes=1000)
+    statements = []
+    cache._connection().set_trace_callback(statements.append)
+
+    for key in range(SQLiteCache.EVICT_EVERY - 1):
+        cache.set(str(key % 3), "x")
+    assert not any("SUM(size)" in statement for statement in statements)
+    # every EVICT_EVERY writes, or once the size written is over max_bytes
+    cache.set("3", "x")
+    cache.set("4", "x" * 1000)
+    assert sum("SUM(size)" in statement for statement in statements) == 2
+    assert cache.get("4") is None and cache.stats().size_bytes <= 1000
+
+
+def test_sqlite_cache_shared(tmp_path):
+    from src.cache import SQLiteCache
+    path = str(tmp_path / "cache.db")
+    SQLiteCache(path).set("place", {"title": "Bakery One"})
+
+    assert SQLiteCache(path).get("place") == {"title": "Bakery One"}
+
+
+def test_places_cache(mocker: MockerFixture, settings, serpapi_search_by_uule):
+    mock_search = mocker.patch("src.llm.places.SerpapiHelper._search", return_value=serpapi_search_by_uule)
+    mocker.patch("src.llm.places.SerpapiHelper.search_by_place_id", return_value={})
+    settings.CACHE_URL = "memory://"
+    place = {"city": "Maó", "country": "Spain"}
+
+    from src.llm.places import PlacesTool
+    tool = PlacesTool(settings)
+    results = [tool.simple_search("bakery", 39.8883636, 4.2652852, place=place) for _ in range(2)]
+
+    assert mock_search.call_count == 1
+    assert results[0] == results[1] and results[0]["title"] == "Bakery One"
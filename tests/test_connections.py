@@ -0,0 +1,93 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+from fastapi import FastAPI
+
+from benchmarks.fakes import BackgroundServer
+
+
+# models list requests received
+MODELS_CALLS = []
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping():
+        return {}
+
+    @app.get("/openai/models")
+    async def models():
+        MODELS_CALLS.append(True)
+        return {"object": "list", "data": []}
+
+    with BackgroundServer(app) as server:
+        yield server.url
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("keepalive_expiry, connections", [(120, 1), (0.05, 3)])
+async def test_connection_reuse(server_url: str, keepalive_expiry: float, connections: int):
+    from src.llm.connections import ConnectionStats, create_http_client
+    from src.metrics import metrics
+
+    metrics.reset()
+    stats = ConnectionStats("test")
+    async with create_http_client(stats, keepalive_expiry=keepalive_expiry) as client:
+        for _ in range(3):
+            await client.get(f"{server_url}/ping")
+            await asyncio.sleep(0.1)
+
+    assert stats.report() == {"requests": 3, "connections": connections,
+                              "reuse_rate": round(1 - connections / 3, 3)}
+    assert metrics.snapshot()["summaries"]["http.test.connect_ms"]["count"] == connections
+
+
+@pytest.mark.asyncio
+async def test_keep_warm():
+    from src.llm.connections import ConnectionStats, keep_warm
+    from src.metrics import metrics
+
+    metrics.reset()
+    stats = ConnectionStats("test")
+    ping = AsyncMock()
+    task = asyncio.create_task(keep_warm(stats, ping, interval=0.05))
+    await asyncio.sleep(0.03)
+    # not idle long enough yet
+    assert ping.await_count == 0
+    await asyncio.sleep(0.1)
+    task.cancel()
+
+    assert ping.await_count >= 1
+    assert metrics.counter("http.test.keep_warm") == ping.await_count
+
+
+def test_tool_factory_shared_client(settings):
+    import httpx
+    from src.llm.agent import ToolFactory
+
+    http_client = httpx.AsyncClient()
+    factories = [ToolFactory(settings, http_client=http_client) for _ in range(2)]
+
+    assert all(llm.root_async_client._client is http_client for llm in factories[0]._llms.values())
+    # the client given is not modified, e.g. with a hook per factory
+    assert http_client.event_hooks["request"] == []
+
+
+@pytest.mark.asyncio
+async def test_tool_factory_warmup(server_url: str, settings):
+    # the models list used as ping (warm-up and keep-warm) by the pinned openai client
+    from src.llm.agent import ToolFactory
+    from src.metrics import metrics
+
+    metrics.reset()
+    MODELS_CALLS.clear()
+    factory = ToolFactory(settings.model_copy(update={"AZURE_OPENAI_API_BASE": server_url}))
+    await factory.warmup(timeout=5)
+
+    # both deployments, through the shared client
+    assert len(MODELS_CALLS) == 2
+    assert factory.connections.report()["requests"] == 2
@@ -0,0 +1,81 @@
+import asyncio
+import time
+import types
+
+import pytest
+
+from benchmarks.fakes import UpstreamProfile, UpstreamProfiles
+
+
+def test_deadline_nesting():
+    from src.deadline import deadline, remaining_time
+
+    assert remaining_time() is None
+    with deadline(10):
+        with deadline(60) as inner:
+            # the earlier deadline is kept
+            assert remaining_time() <= 10 and inner.remaining() <= 10
+        with deadline(1):
+            assert remaining_time() <= 1
+            assert remaining_time(reserve=2) == 0
+    assert remaining_time() is None
+
+
+@pytest.mark.asyncio
+async def test_within_deadline_cancels():
+    from src.deadline import DeadlineExceeded, deadline, within_deadline
+    cancelled = asyncio.Event()
+
+    async def _slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with deadline(0.3):
+        assert await within_deadline(asyncio.sleep(0, result="fast"), "fast") == "fast"
+        with pytest.raises(DeadlineExceeded):
+            await within_deadline(_slow(), "slow", reserve=0.2)
+
+    assert cancelled.is_set()
+
+
+@pytest.mark.asyncio
+async def test_within_deadline_bounds_threads():
+    from src.deadline import deadline, remaining_time, within_deadline
+
+    with deadline(10):
+        # the time left seen by the stage (e.g. the timeout of its upstream calls) excludes the reserve
+        assert await within_deadline(asyncio.to_thread(remaining_time), "thread", reserve=9.5) <= 0.5
+        assert remaining_time() > 9
+
+
+def test_batch_reverse_geocode_deadline(upstream):
+    settings = types.SimpleNamespace(GEOAPIFY_API_KEY="fake", GEOAPIFY_BATCH_POLL_INTERVAL=1, GEOAPIFY_BATCH_TIMEOUT=5,
+                                     CACHE_URL=None)
+
+    from src.deadline import DeadlineExceeded, deadline
+    from src.llm.places import GeoapifyHelper
+    started = time.monotonic()
+    # the job is still pending after the first poll, the next one is not waited for
+    with deadline(0.2), pytest.raises(DeadlineExceeded):
+        GeoapifyHelper.batch_reverse_geocode(settings, [(39.88836, 4.26528)])
+
+    assert time.monotonic() - started < 0.9
+    assert upstream.state.batch_jobs["job-1"]["polls"] == 1
+
+
+@pytest.mark.parametrize("upstream", [UpstreamProfiles(geoapify=UpstreamProfile(latency_ms=2000))], indirect=True)
+def test_reverse_geocode_deadline(upstream):
+    settings = types.SimpleNamespace(GEOAPIFY_API_KEY="fake")
+
+    import requests
+    from src.deadline import deadline
+    from src.llm.places import GeoapifyHelper
+    started = time.monotonic()
+    # the request is given up with the deadline, not abandoned in its thread
+    with deadline(0.3), pytest.raises(requests.Timeout):
+        GeoapifyHelper.reverse_geocode(settings, 39.8883636, 4.2652852)
+
+    assert time.monotonic() - started < 1
@@ -0,0 +1,39 @@
+import time
+
+
+def test_load_monitor_levels():
+    from src.degradation import DegradationLevel, LoadMonitor
+    monitor = LoadMonitor(queue_depths=[2, 3], latencies=[0.5, 1.0, 2.0])
+    assert monitor.level() == DegradationLevel.FULL
+
+    with monitor.track(), monitor.track():
+        assert monitor.in_flight == 2
+        assert monitor.level() == DegradationLevel.NO_PLACE_DETAILS
+        with monitor.track():
+            assert monitor.level() == DegradationLevel.NO_PLACES
+
+    for _ in range(10):
+        monitor._observe(2.5)
+    assert monitor.in_flight == 0 and monitor.level() == DegradationLevel.LOW_DETAIL
+
+
+def test_load_monitor_without_thresholds():
+    from src.degradation import DegradationLevel, LoadMonitor
+    monitor = LoadMonitor()
+    for _ in range(10):
+        monitor._observe(60)
+
+    with monitor.track():
+        assert monitor.level() == DegradationLevel.FULL
+
+
+def test_load_monitor_recovers_after_idle():
+    from src.degradation import DegradationLevel, LoadMonitor
+    monitor = LoadMonitor(latencies=[0.5, 1.0], window=0.1)
+    for _ in range(10):
+        monitor._observe(2.5)
+    assert monitor.level() == DegradationLevel.NO_PLACES
+
+    # no card finished since, the slow ones are out of the window
+    time.sleep(0.15)
+    assert monitor.latency() is None and monitor.level() == DegradationLevel.FULL
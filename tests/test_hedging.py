@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_hedged_run():
+    from src.hedging import Hedger
+    from src.metrics import metrics
+    metrics.reset()
+    hedger = Hedger("test", budget=0.5, delay=0.05)
+    calls, cancelled = [], []
+
+    async def _request():
+        calls.append(len(calls))
+        try:
+            # the first call of the slow request is a straggler
+            await asyncio.sleep(1 if len(calls) == 3 else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return len(calls)
+
+    # two calls earn the budget of a hedge
+    assert [await hedger.run(_request) for _ in range(2)] == [1, 2]
+    start = time.perf_counter()
+    assert await hedger.run(_request) == 4
+
+    assert time.perf_counter() - start < 0.5
+    await asyncio.sleep(0)
+    assert cancelled == [True]
+    assert metrics.counter("hedge.test.sent") == 1 and metrics.counter("hedge.test.won") == 1
+    # the slow first call is observed (as long as it lasted), not the faster hedge
+    assert len(hedger._latencies) == 3 and hedger._latencies[-1] >= 0.05
+
+
+def test_hedge_budget():
+    from src.hedging import Hedger
+    from src.metrics import metrics
+    metrics.reset()
+    hedger = Hedger("test", budget=0.1, delay=0.001)
+
+    results = [hedger.call(time.sleep, 0.005) for _ in range(50)]
+
+    assert results == [None] * 50
+    assert 1 <= metrics.counter("hedge.test.sent") <= 5
+
+
+def test_hedge_delay_percentile():
+    from src.hedging import Hedger
+    hedger = Hedger("test", budget=0.1, percentile=90, min_samples=10)
+    assert hedger.delay() is None
+
+    for latency in range(1, 11):
+        hedger._latencies.append(latency / 100)
+
+    assert hedger.delay() == 0.09
+
+
+def test_places_tool_hedgers(settings):
+    from src.llm.places import PlacesTool
+    hedged = settings.model_copy(update={"HEDGE_BUDGET": 0.1, "HEDGE_DELAY": 1.0})
+
+    tools = [PlacesTool(settings), PlacesTool(hedged)]
+
+    # a tool does not reconfigure the hedgers of the others
+    assert [tool.hedgers["serpapi"].delay() for tool in tools] == [None, 1.0]
+    assert tools[0].hedgers["geoapify"] is not tools[1].hedgers["geoapify"]
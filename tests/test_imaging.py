@@ -0,0 +1,45 @@
+import base64
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("kind", ["thread", "process"])
+async def test_image_executor(tmp_path, kind: str):
+    from src.imaging import ImageExecutor, read_coordinates
+    image_path = str(tmp_path / "photo.png")
+    Image.new("RGB", (40, 30), "white").save(image_path, format="PNG")
+    executor = ImageExecutor(kind, 1)
+
+    encoded = await executor.encode(image_path)
+    coordinates = await executor.run(read_coordinates, image_path)
+
+    assert encoded.url.startswith("data:image/png;base64,") and encoded.size == (40, 30)
+    assert Image.open(BytesIO(base64.b64decode(encoded.url.split(",", 1)[1]))).size == (40, 30)
+    assert coordinates == (None, None)
+
+
+@pytest.mark.asyncio
+async def test_encode_image_memory_budget(tmp_path):
+    import tracemalloc
+    from benchmarks.load import make_photo
+    from src.imaging import get_image_executor
+    from src.metrics import track_peak_memory
+    image_path = tmp_path / "photo.jpg"
+    image_path.write_bytes(make_photo(2000, 1500))
+    url_size = 4 * image_path.stat().st_size / 3
+
+    tracemalloc.start()
+    try:
+        with track_peak_memory("encode") as peak:
+            # as the agent does with the default (process) executor
+            encoded = await get_image_executor("process", 1).encode(str(image_path))
+    finally:
+        tracemalloc.stop()
+
+    assert base64.b64decode(encoded.url.split(",", 1)[1]) == image_path.read_bytes()
+    # the URL buffer and the URL string (plus the chunks and the image header), no copy of the file nor of the
+    # base64 bytes, which would take 2.75 times the URL, nor the URL pickled back from a worker process
+    assert peak.bytes < 2 * url_size + 1024 * 1024
@@ -1,3 +1,4 @@
+import types
 from typing import Any, Dict, List
 
 import pytest
@@ -5,7 +6,7 @@ from pytest_mock import MockerFixture
 
 
 def test_extract_coordinates(exif_image):
-    from src.llm.places import EXIFHelper
+    from src.imaging import EXIFHelper
     lat, lon = EXIFHelper.extract_coordinates(exif_image)
     assert pytest.approx(lat) == 39.88816388888889
     assert pytest.approx(lon) == 4.265166666666666
@@ -44,13 +45,19 @@ def test_search_by_placeid(mocker: MockerFixture, serpapi_search_by_place_id: Li
 
 
 def test_reverse_geocode(mocker: MockerFixture, reverse_geocode_data) -> Dict[str, Any]:
-    mock_reverse_geocode = mocker.patch("geobatchpy.Client.reverse_geocode", return_value=reverse_geocode_data)
-    settings = mocker.MagicMock()
+    mock_get = mocker.patch("requests.get")
+    mock_get.return_value.json.return_value = reverse_geocode_data
+    settings = mocker.MagicMock(GEOAPIFY_API_KEY="key")
 
+    from src.deadline import deadline
     from src.llm.places import GeoapifyHelper
-    result = GeoapifyHelper.reverse_geocode(settings, 39.8883636, 4.2652852)
+    with deadline(5):
+        result = GeoapifyHelper.reverse_geocode(settings, 39.8883636, 4.2652852)
 
-    mock_reverse_geocode.assert_called_once_with(4.2653, 39.8884)
+    mock_get.assert_called_once()
+    assert mock_get.call_args.kwargs["params"] == {"lat": "39.8884", "lon": "4.2653"}
+    # bounded by the deadline
+    assert 0 < mock_get.call_args.kwargs["timeout"] <= 5
 
     assert result == {
         "country": "Spain",
@@ -58,4 +65,58 @@ def test_reverse_geocode(mocker: MockerFixture, reverse_geocode_data) -> Dict[st
         "county": "Menorca",
         "city": "Ma\\u00f3",
         "postcode": "07703",
-    }
\ No newline at end of file
+    }
+
+def test_simple_search_known_place(mocker: MockerFixture, settings, serpapi_search_by_uule: List[Dict[str, Any]]):
+    mock_reverse_geocode = mocker.patch("src.llm.places.GeoapifyHelper.reverse_geocode")
+    mocker.patch("src.llm.places.SerpapiHelper._search", return_value=serpapi_search_by_uule)
+    mocker.patch("src.llm.places.SerpapiHelper.search_by_place_id", return_value={})
+    place = {"city": "Maó", "country": "Spain"}
+
+    from src.llm.places import PlacesTool
+    result = PlacesTool(settings).simple_search("bakery", 39.8883636, 4.2652852, place=place)
+
+    mock_reverse_geocode.assert_not_called()
+    assert result["title"] == "Bakery One" and result["city"] == "Maó"
+    assert place == {"city": "Maó", "country": "Spain"}
+
+
+def test_simple_search_without_details(mocker: MockerFixture, settings, serpapi_search_by_uule: List[Dict[str, Any]]):
+    mocker.patch("src.llm.places.SerpapiHelper._search", return_value=serpapi_search_by_uule)
+    mock_search_by_place_id = mocker.patch("src.llm.places.SerpapiHelper.search_by_place_id")
+
+    from src.llm.places import PlacesTool
+    result = PlacesTool(settings).simple_search("bakery", 39.8883636, 4.2652852,
+                                                place={"city": "Maó", "country": "Spain"}, details=False)
+
+    mock_search_by_place_id.assert_not_called()
+    assert result["title"] == "Bakery One"
+
+
+def test_uule_key_ignores_timestamp(mocker: MockerFixture):
+    from src.llm.places import SerpapiHelper
+    mocker.patch("src.llm.places.time.time", side_effect=[1.0, 2.0, 3.0])
+    uule_1 = SerpapiHelper.generate_uule_v2(39.8883636, 4.2652852, 300)
+    uule_2 = SerpapiHelper.generate_uule_v2(39.8883636, 4.2652852, 300)
+    uule_3 = SerpapiHelper.generate_uule_v2(39.5708491, 2.6512442, 300)
+
+    assert uule_1 != uule_2
+    assert SerpapiHelper._uule_key(uule_1) == SerpapiHelper._uule_key(uule_2)
+    assert SerpapiHelper._uule_key(uule_1) != SerpapiHelper._uule_key(uule_3)
+    assert SerpapiHelper._query_key(" Forn del  St. Cristo ") == SerpapiHelper._query_key("forn del st. cristo")
+
+
+def test_batch_reverse_geocode(upstream):
+    settings = types.SimpleNamespace(GEOAPIFY_API_KEY="fake", GEOAPIFY_BATCH_POLL_INTERVAL=0.01,
+                                     GEOAPIFY_BATCH_TIMEOUT=5)
+    # the first two coordinates share a tile
+    coordinates = [(39.88836, 4.26528), (39.888361, 4.265281), (39.5708491, 2.6512442)]
+
+    from src.llm.places import GeoapifyHelper
+    addresses = GeoapifyHelper.batch_reverse_geocode(settings, coordinates)
+
+    assert [address["country"] for address in addresses] == ["Spain"] * 3
+    assert upstream.state.calls["geoapify_batch"] == 1
+    assert upstream.state.calls["geoapify"] == 0
+    job = upstream.state.batch_jobs["job-1"]
+    assert len(job["body"]["inputs"]) == 2 and job["polls"] == 2
@@ -0,0 +1,38 @@
+import pstats
+import time
+
+
+def test_sampling_profiler(tmp_path):
+    from src.profiling import ProfileStore
+
+    def _busy_wait(seconds: float):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    store = ProfileStore(str(tmp_path), keep=2)
+    with store.profile("first-run") as path:
+        _busy_wait(0.1)
+
+    stacks = path.read_text().splitlines()
+    assert path.name == "first-run.folded"
+    assert any("_busy_wait (test_profiling.py" in stack for stack in stacks)
+    assert sum(int(stack.rsplit(" ", 1)[1]) for stack in stacks) > 5
+
+
+def test_profile_store(tmp_path):
+    from src.profiling import ProfileStore
+
+    store = ProfileStore(str(tmp_path), keep=2)
+    for run_name in ["first-run", "second-run", "third-run"]:
+        with store.profile(run_name, "deterministic") as path:
+            # a single request is profiled at a time
+            with store.profile("nested-run") as nested:
+                assert nested is None
+            sum(range(1000))
+        time.sleep(0.01)
+
+    assert [profile.run_name for profile in store.list()] == ["third-run", "second-run"]
+    assert pstats.Stats(str(store.path("third-run.prof"))).total_calls > 0
+    assert store.path("first-run.prof") is None
+    assert store.path("../third-run.prof") is None
@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_progress_events():
+    from src.progress import CARD, PLACE, RECEIVED, Progress, read_events, report_progress
+
+    progress = Progress()
+    # no progress requested, nothing reported
+    report_progress(RECEIVED)
+
+    def _search():
+        report_progress(PLACE, title="Bakery One", address="Carrer de Sant Cristòfol, 1")
+
+    async def _create_card():
+        with progress.activate():
+            # in a thread pool, like the places search
+            await asyncio.to_thread(_search)
+            report_progress(CARD, vcard="BEGIN:VCARD\\nEND:VCARD")
+        progress.close()
+
+    task = asyncio.create_task(_create_card())
+    encoded = "".join([event.encode() async for event in progress.events()])
+    await task
+
+    async def _lines():
+        for line in encoded.encode("utf-8").splitlines(keepends=True):
+            yield line
+
+    events = [event async for event in read_events(_lines())]
+    assert [(event.event, event.data) for event in events] == [
+        (PLACE, {"title": "Bakery One", "address": "Carrer de Sant Cristòfol, 1"}),
+        (CARD, {"vcard": "BEGIN:VCARD\\nEND:VCARD"}),
+    ]
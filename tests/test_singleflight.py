@@ -0,0 +1,51 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    from src.metrics import metrics
+    from src.singleflight import SingleFlight
+    metrics.reset()
+    flight = SingleFlight("test")
+    calls = []
+
+    def _lookup(key: str) -> dict:
+        calls.append(key)
+        time.sleep(0.2)
+        return {"key": key}
+
+    with ThreadPoolExecutor(5) as executor:
+        results = list(executor.map(lambda _: flight.do("venue", _lookup, "venue"), range(5)))
+
+    assert calls == ["venue"]
+    assert results == [{"key": "venue"}] * 5
+    assert len({id(result) for result in results}) == 5
+    assert metrics.counter("singleflight.test.collapsed") == 4
+    assert flight.in_flight() == 0
+    # finished calls are not cached
+    flight.do("venue", _lookup, "venue")
+    assert len(calls) == 2
+
+
+def test_single_flight_propagates_errors():
+    from src.singleflight import SingleFlight
+    flight = SingleFlight("test")
+    started = threading.Event()
+
+    def _failing():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError("upstream error")
+
+    with ThreadPoolExecutor(3) as executor:
+        leader = executor.submit(flight.do, "venue", _failing)
+        started.wait()
+        followers = [executor.submit(flight.do, "venue", _failing) for _ in range(2)]
+        for future in [leader] + followers:
+            with pytest.raises(ValueError, match="upstream error"):
+                future.result()
+
+    assert flight.in_flight() == 0
@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+
+from benchmarks.startup import FAKE_ENV
+
+
+def test_bot_does_not_import_langchain():
+    # the bot only calls the API, langchain (and langsmith) would add most of its startup time
+    code = "import sys, src.bot; print(sorted(m for m in ('langchain_core', 'langsmith') if m in sys.modules))"
+    process = subprocess.run([sys.executable, "-c", code], env=os.environ.copy() | FAKE_ENV, capture_output=True,
+                             text=True, check=True)
+    assert process.stdout.strip() == "[]"
@@ -0,0 +1,91 @@
+import inspect
+from unittest.mock import MagicMock
+
+import pytest
+
+IMAGE_URL = "data:image/jpeg;base64," + "A" * 1000
+
+
+def _card_chain(fail: bool = False):
+    from langchain_core.language_models import FakeListChatModel
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.runnables import RunnableLambda
+
+    def _check(text: str) -> str:
+        if fail:
+            raise ValueError("no card")
+        return text
+
+    prompt = ChatPromptTemplate.from_messages([("user", [{"type": "image_url", "image_url": "{image_url}"}])])
+    return prompt | FakeListChatModel(responses=["BEGIN:VCARD"]) | RunnableLambda(lambda message: message.content) \
+        | RunnableLambda(_check)
+
+
+def test_redact_images():
+    from langchain_core.messages import HumanMessage
+    from src.tracing import redact_images
+
+    message = HumanMessage(content=[{"type": "text", "text": "card"},
+                                    {"type": "image_url", "image_url": {"url": IMAGE_URL}}])
+    payload = {"image_url": IMAGE_URL, "messages": [[message]], "lat": 39.88}
+
+    truncated = redact_images(10)(payload)
+    assert truncated["image_url"] == "data:image/jpeg;base64,AAAAAAAAAA... (1000 chars)"
+    assert truncated["lat"] == 39.88
+    content = truncated["messages"][0][0]["kwargs"]["content"]
+    assert content[0]["text"] == "card" and content[1]["image_url"]["url"].endswith("... (1000 chars)")
+    assert redact_images(0)(payload)["image_url"] == "data:image/jpeg;base64,... (1000 chars)"
+    assert redact_images(None)(payload)["messages"][0][0]["kwargs"]["content"][1]["image_url"]["url"] == IMAGE_URL
+    # the runs traced are not modified
+    assert payload["image_url"] == IMAGE_URL and message.content[1]["image_url"]["url"] == IMAGE_URL
+
+
+@pytest.mark.parametrize("sample_rate, fail, uploaded", [
+    (1.0, False, 5),
+    (0.0, False, 0),
+    # traced anyway, as it failed
+    (0.0, True, 5),
+])
+def test_sampled_tracer(sample_rate: float, fail: bool, uploaded: int):
+    from src.metrics import metrics
+    from src.tracing import SampledTracer
+
+    metrics.reset()
+    client = MagicMock()
+    tracer = SampledTracer(sample_rate, trace_errors=True, client=client, project_name="test")
+
+    try:
+        _card_chain(fail).invoke({"image_url": IMAGE_URL}, config={"callbacks": [tracer]})
+    except ValueError:
+        pass
+
+    assert client.create_run.call_count == uploaded
+    if uploaded:
+        runs = {call.kwargs["name"]: call.kwargs for call in client.create_run.call_args_list}
+        # the chat model messages are passed as is, serialized by the client (see `redact_images`)
+        assert runs["FakeListChatModel"]["inputs"]["messages"][0][0].content[0]["image_url"]["url"] == IMAGE_URL
+        assert runs["RunnableSequence"]["parent_run_id"] is None
+    assert metrics.counter("tracing.sampled" if sample_rate else "tracing.skipped") == 1
+    assert metrics.counter("tracing.errors") == (1 if fail and not sample_rate else 0)
+    assert not tracer._skipped and not tracer._messages
+
+
+def test_sampled_tracer_run_not_started():
+    import uuid
+    from langchain_core.messages import HumanMessage
+    from src.tracing import SampledTracer
+    tracer = SampledTracer(0.0, client=MagicMock(), project_name="test")
+
+    # no run is created for a model without name, its messages are not kept
+    with pytest.raises(Exception):
+        tracer.on_chat_model_start({}, [[HumanMessage(content="card")]], run_id=uuid.uuid4())
+    assert not tracer._messages
+
+
+@pytest.mark.parametrize("method", ["_start_trace", "_on_chat_model_start", "_persist_run_single",
+                                    "_update_run_single"])
+def test_sampled_tracer_overrides(method: str):
+    # private methods of the langchain-core tracer, which an upgrade can rename or drop silently
+    from langchain_core.tracers import LangChainTracer
+
+    assert list(inspect.signature(getattr(LangChainTracer, method)).parameters) == ["self", "run"]
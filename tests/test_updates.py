@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_throughput_scales_with_concurrency():
+    from benchmarks.bot_load import make_updates, run_level
+    updates = make_updates(chats=8, updates_per_chat=2)
+
+    sequential = await run_level(updates, concurrency=1, handler_ms=20)
+    concurrent = await run_level(updates, concurrency=8, handler_ms=20)
+
+    assert concurrent.updates_per_s > 3 * sequential.updates_per_s
+    for result in [sequential, concurrent]:
+        assert result.max_chat_overlap == 1
+        assert result.out_of_order == 0
+
+
+@pytest.mark.asyncio
+async def test_busy_chat_does_not_block_other_chats():
+    from benchmarks.bot_load import make_update
+    from src.updates import ChatOrderedUpdateProcessor
+    processor = ChatOrderedUpdateProcessor(2)
+    updates = [make_update(idx + 1, chat_id=1, sequence=idx) for idx in range(5)] + [make_update(6, chat_id=2, sequence=0)]
+    finished = []
+
+    async def _handler(update):
+        await asyncio.sleep(0.05)
+        finished.append(update.effective_chat.id)
+
+    await asyncio.gather(*[processor.process_update(update, _handler(update)) for update in updates])
+
+    # the other chat is served while the updates of the busy chat wait for their turn
+    assert finished == [1, 2, 1, 1, 1, 1]
+    assert processor.pending_chats() == 0